@@ -1,23 +1,67 @@
-from fastapi import FastAPI, Depends, HTTPException, Request, BackgroundTasks, Body
+from __future__ import annotations
+
+import time
+
+# Время импорта модуля (см. startup_timings)
+_import_started = time.perf_counter()
+
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, Body, Header
 import requests
 import json
 import os
+import asyncio
+import logging
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from cryptography.fernet import Fernet
 from fastapi.security import APIKeyHeader
 import hashlib
 from dotenv import load_dotenv
 import sqlite3
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
 import telegram
 from telegram import Update, Bot, ReplyKeyboardMarkup, KeyboardButton, BotCommand, WebAppInfo
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, ContextTypes
-from telegram.ext import Application, CallbackContext
-import aiohttp
+# telegram.ext импортируется только при создании Application (см. build_telegram_application)
+if TYPE_CHECKING:
+    from telegram.ext import Application, ContextTypes
+import ozon_api
+from ozon_api import (
+    get_ozon_products,
+    get_ozon_analytics,
+    get_ozon_financial_data,
+    get_ozon_advertising_costs,
+    get_ozon_returns_data,
+)
+import services
+import outbox
+import job_ledger
+import refresh_scheduler
+import state_store
+import redis_store
+from bot_router import CommandRouter
+import update_queue
+from update_queue import UpdateDispatcher
+import update_dedup
+import http_cache
+import singleflight
+import projections
+import refresh_progress
+import fast_json
+from fast_json import FastJSONResponse
+import telegram_client
+from telegram_client import PooledTelegramRequest
+import webapp_auth
+from data_versions import bump_data_version, get_data_version, get_snapshot
+from services import perform_abc_analysis, update_top_product
+from logging_setup import setup_logging
+import database
+from database import get_db, PortableCursor
 
 # Функция для нечеткого сравнения строк (расстояние Левенштейна)
 def levenshtein_distance(s1, s2):
@@ -31,6 +75,11 @@ def fuzzy_match(text, possible_matches, threshold=0.7):
 # Загружаем переменные окружения из .env файла
 load_dotenv(verbose=True)
 
+setup_logging("web")
+logger = logging.getLogger(__name__)
+# Отдельный логгер для событий на каждое обновление - для него можно включить выборку (LOG_SAMPLING=webhook=0.1)
+webhook_logger = logging.getLogger("webhook")
+
 # Получаем переменные окружения
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY", "default-key")
@@ -42,46 +91,27 @@ WEB_APP_URL = os.getenv("WEB_APP_URL", "https://t.me/xyezonbot/shmazon")
 def init_db():
     """Инициализирует базу данных - создает таблицу пользователей"""
     try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_tokens (
-                    telegram_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    ozon_api_token TEXT NOT NULL,
-                    ozon_client_id TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            conn.commit()
+        # Таблица пользователей общая для веб-сервиса, бота и воркеров Celery (см. database.py)
+        database.init_db()
         
         # Инициализируем таблицу настроек уведомлений
         init_notification_settings_table()
         return True
     except Exception as e:
-        print(f"Ошибка при инициализации базы данных: {str(e)}")
+        logger.error(f"Ошибка при инициализации базы данных: {str(e)}")
         return False
 
-@contextmanager
-def get_db():
-    conn = sqlite3.connect('user_tokens.db')
-    try:
-        yield conn
-    finally:
-        conn.close()
-
 # Функция для инициализации таблицы настроек уведомлений
 def init_notification_settings_table():
     """Инициализирует таблицу настроек уведомлений в базе данных"""
     try:
         with get_db() as conn:
-            cursor = conn.cursor()
+            cursor = PortableCursor(conn)
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS notification_settings (
-                    telegram_id INTEGER PRIMARY KEY,
-                    margin_threshold REAL DEFAULT 15.0,
-                    roi_threshold REAL DEFAULT 30.0,
+                    telegram_id BIGINT PRIMARY KEY,
+                    margin_threshold DOUBLE PRECISION DEFAULT 15.0,
+                    roi_threshold DOUBLE PRECISION DEFAULT 30.0,
                     daily_report INTEGER DEFAULT 0,
                     sales_alert INTEGER DEFAULT 1,
                     returns_alert INTEGER DEFAULT 1,
@@ -92,35 +122,19 @@ def init_notification_settings_table():
             conn.commit()
         return True
     except Exception as e:
-        print(f"Ошибка при инициализации таблицы настроек уведомлений: {str(e)}")
+        logger.error(f"Ошибка при инициализации таблицы настроек уведомлений: {str(e)}")
         return False
 
-# Инициализируем базу данных при запуске
-init_db()
-init_notification_settings_table()
-
-# Обработка ошибок, если библиотеки не установлены
-try:
-    import telegram
-except ImportError:
-    # Создаем заглушку для telegram бота
-    class TelegramBot:
-        def __init__(self, token):
-            self.token = token
-            print("ВНИМАНИЕ: Модуль telegram не установлен. Используется заглушка.")
-
-        async def send_message(self, chat_id, text):
-            print(f"ЗАГЛУШКА: Отправка сообщения '{text}' в чат {chat_id}")
-            return True
-
-    class telegram:
-        @staticmethod
-        def Bot(token):
-            return TelegramBot(token)
-
 # Генерация ключа для шифрования (в реальном приложении должен храниться в защищенном месте)
-# Для реального приложения используйте переменные окружения или хранилище секретов
-cipher_suite = Fernet(ENCRYPTION_KEY)
+# Для реального приложения используйте переменные окружения или хранилище секретов.
+# Шифр создается при первом использовании, чтобы неверный ключ не мешал запуску сервиса
+_cipher_suite: Optional[Fernet] = None
+
+def get_cipher_suite() -> Fernet:
+    global _cipher_suite
+    if _cipher_suite is None:
+        _cipher_suite = Fernet(ENCRYPTION_KEY)
+    return _cipher_suite
 
 # Модели данных для API
 class UserToken(BaseModel):
@@ -158,11 +172,40 @@ class TelegramUser(BaseModel):
 # Настройки Telegram бота (загружаем из переменных окружения)
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
-if not TELEGRAM_BOT_TOKEN or not CHAT_ID:
-    raise ValueError("Не установлены необходимые переменные окружения: TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID")
+if not TELEGRAM_BOT_TOKEN:
+    logger.warning("TELEGRAM_BOT_TOKEN не установлен - бот работать не будет")
+if not CHAT_ID:
+    logger.warning("TELEGRAM_CHAT_ID не установлен - отправка отчетов через /send_report недоступна")
+
+# Длительность этапов запуска (миллисекунды): импорт модуля, startup, инициализация и настройка бота
+startup_timings: Dict[str, float] = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск и остановка сервиса (startup_event и shutdown_event определены ниже)"""
+    await startup_event()
+    try:
+        yield
+    finally:
+        await shutdown_event()
+
+# Сжатие ответов: небольшие ответы не сжимаются, чтобы не тратить на них CPU
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))  # байты
+GZIP_COMPRESS_LEVEL = int(os.getenv("GZIP_COMPRESS_LEVEL", "5"))
+
+# Создаем приложение (ответы сериализуются через orjson, см. fast_json.py)
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+
+class EventStreamAwareGZipMiddleware(GZipMiddleware):
+    """Не сжимает потоки событий (SSE): сжатие задерживает события до заполнения буфера"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and b"text/event-stream" in dict(scope["headers"]).get(b"accept", b""):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
-# Создаем приложение
-app = FastAPI()
+app.add_middleware(EventStreamAwareGZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=GZIP_COMPRESS_LEVEL)
 
 # Добавляем CORS middleware для работы с фронтендом
 app.add_middleware(
@@ -198,19 +241,27 @@ def update_users_db_reverse():
 def encrypt_tokens(tokens: dict) -> str:
     """Шифрует токены API"""
     tokens_json = json.dumps(tokens)
-    encrypted_tokens = cipher_suite.encrypt(tokens_json.encode())
+    encrypted_tokens = get_cipher_suite().encrypt(tokens_json.encode())
     return encrypted_tokens.decode()
 
 def decrypt_tokens(encrypted_tokens: str) -> dict:
     """Дешифрует токены API"""
     try:
-        decrypted_tokens = cipher_suite.decrypt(encrypted_tokens.encode())
+        decrypted_tokens = get_cipher_suite().decrypt(encrypted_tokens.encode())
         return json.loads(decrypted_tokens)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка расшифровки токенов: {str(e)}")
 
 # Функция для получения токенов из заголовка запроса
 api_key_header = APIKeyHeader(name="X-API-Key")
+optional_api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
+
+async def get_optional_api_key(api_key: Optional[str] = None, header_api_key: Optional[str] = Depends(optional_api_key_header)) -> Optional[str]:
+    """
+    API ключ для эндпоинтов, доступных и по Telegram ID: из заголовка X-API-Key
+    (Mini App) или, для старых клиентов, из параметра api_key
+    """
+    return header_api_key or api_key
 
 async def get_api_tokens(api_key: str = Depends(api_key_header)):
     """Получает токены API из заголовка запроса"""
@@ -247,24 +298,29 @@ async def save_user_token(user_id: int, api_token: str, client_id: str) -> bool:
         save_user_token_db(user_token)
         return True
     except Exception as e:
-        print(f"Ошибка при сохранении токенов: {str(e)}")
+        logger.error(f"Ошибка при сохранении токенов: {str(e)}")
         return False
 
 def save_user_token_db(user_token: UserToken):
     """Сохраняет токены пользователя в базу данных (внутренняя функция)"""
     with get_db() as conn:
-        cursor = conn.cursor()
+        cursor = PortableCursor(conn)
         cursor.execute('''
-            INSERT OR REPLACE INTO user_tokens 
+            INSERT INTO user_tokens 
             (telegram_id, username, ozon_api_token, ozon_client_id, last_updated)
             VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (telegram_id) DO UPDATE SET
+                username = excluded.username,
+                ozon_api_token = excluded.ozon_api_token,
+                ozon_client_id = excluded.ozon_client_id,
+                last_updated = excluded.last_updated
         ''', (user_token.telegram_id, user_token.username, user_token.ozon_api_token, user_token.ozon_client_id))
         conn.commit()
 
 async def get_user_tokens(telegram_id: int) -> Optional[UserToken]:
     """Получает токены пользователя из базы данных с дополнительной информацией"""
     with get_db() as conn:
-        cursor = conn.cursor()
+        cursor = PortableCursor(conn)
         cursor.execute('''
             SELECT 
                 telegram_id, 
@@ -294,26 +350,14 @@ async def delete_user_tokens(telegram_id: int) -> bool:
     """Удаляет токены пользователя из базы данных"""
     try:
         with get_db() as conn:
-            cursor = conn.cursor()
+            cursor = PortableCursor(conn)
             cursor.execute('DELETE FROM user_tokens WHERE telegram_id = ?', (telegram_id,))
             conn.commit()
         return True
     except Exception as e:
-        print(f"Ошибка при удалении токенов: {str(e)}")
+        logger.error(f"Ошибка при удалении токенов: {str(e)}")
         return False
 
-# Инициализация бота
-try:
-    bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
-    print("Telegram бот успешно инициализирован")
-except Exception as e:
-    print(f"Ошибка инициализации Telegram бота: {str(e)}")
-    # Создаем заглушку, если бот не удалось инициализировать
-    class BotStub:
-        async def send_message(self, chat_id, text):
-            print(f"[БОТ-ЗАГЛУШКА] Отправка сообщения в чат {chat_id}: {text}")
-    bot = BotStub()
-
 # Функция для создания клавиатуры с кнопками
 def get_main_keyboard():
     """Создает клавиатуру с основными командами"""
@@ -346,485 +390,491 @@ async def setup_bot_commands():
             BotCommand("notifications", "Настройки уведомлений"),
         ]
         
-        response = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setMyCommands",
-            json={"commands": [{"command": cmd.command, "description": cmd.description} for cmd in commands]}
-        )
-        
-        if response.status_code == 200 and response.json().get("ok"):
-            print("✅ Меню команд успешно настроено!")
-        else:
-            print(f"❌ Ошибка настройки меню команд: {response.json()}")
+        if await get_telegram_bot().set_my_commands(commands):
+            logger.info("✅ Меню команд успешно настроено!")
+            return True
+        logger.error("❌ Ошибка настройки меню команд")
     except Exception as e:
-        print(f"Ошибка настройки меню команд: {str(e)}")
+        logger.error(f"Ошибка настройки меню команд: {str(e)}")
+    return False
+
+# Таблица команд бота: обработчики регистрируются декоратором, а handle_command
+# и handle_message находят нужный обработчик через маршрутизатор (см. bot_router.py)
+bot_router = CommandRouter()
+
+# Ключевые слова для текстовых кнопок и сообщений без слеша (в порядке приоритета)
+COMMAND_KEYWORDS = [
+    ("delete_tokens", r"удалить.*токены"),
+    ("verify", r"проверить.*токены|валидность"),
+    ("set_token", r"установить.*токены|токены"),
+    ("status", r"статус"),
+    ("stats", r"статистика"),
+    ("start", r"запустить|бота"),
+    ("help", r"помощь|справка"),
+    ("cancel", r"отмена"),
+    ("notifications", r"уведомлени"),
+]
+
+NO_TOKENS_MESSAGE = (
+    "❌ У вас не настроены токены API Ozon.\n\n"
+    "Используйте команду /set_token чтобы настроить API токен и Client ID."
+)
 
-# Добавляем простую систему состояний для диалога с пользователем
-user_states = {}  # Хранит текущее состояние диалога пользователя и промежуточные данные
+@bot_router.command("start")
+async def command_start(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Приветствие и кнопка веб-приложения"""
+    # Сбрасываем состояние пользователя
+    await state_store.clear_state(update.effective_user.id)
 
-async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает команды от пользователя"""
-    if not update.message or not update.message.text:
-        print("Ошибка: нет текста сообщения в handle_command")
-        return
-        
-    # Получаем и нормализуем команду
-    command_text = update.message.text.strip()
-    
-    # Извлекаем команду из текста
-    if command_text.startswith('/'):
-        # Если это прямая команда с символом /
-        command = command_text.split()[0][1:].lower()  # удаляем символ / и берем первое слово, приводим к нижнему регистру
-    else:
-        # Если это текстовая команда без символа /
-        command_lower = command_text.lower()
-        
-        # Явное сопоставление с известными командами
-        if "запустить" in command_lower or "бота" in command_lower or "start" in command_lower:
-            command = "start"
-        elif "помощь" in command_lower or "справка" in command_lower or "help" in command_lower:
-            command = "help"
-        elif "установить" in command_lower and "токены" in command_lower or "set_token" in command_lower:
-            command = "set_token"
-        elif "проверить статус" in command_lower or "статус" in command_lower or "status" in command_lower:
-            command = "status"
-        elif "статистика" in command_lower or "stats" in command_lower:
-            command = "stats"
-        elif "удалить" in command_lower and "токены" in command_lower or "delete_tokens" in command_lower:
-            command = "delete_tokens"
-        elif "проверить" in command_lower and "токены" in command_lower or "verify" in command_lower:
-            command = "verify"
-        elif "отмена" in command_lower or "cancel" in command_lower:
-            command = "cancel"
-        elif "notifications" in command_lower or "notifications" in command_lower:
-            command = "notifications"
-        else:
-            print(f"Неизвестная команда без /: {command_text}")
-            command = "unknown"
-    
-    print(f"Обработка команды: '{command}' из текста: '{command_text}'")
-    
+    # Приветственное сообщение
+    await update.message.reply_text(
+        f"👋 Привет! Я бот для мониторинга вашего магазина Ozon.\n\n"
+        "Для доступа к аналитике и управлению магазином вам нужно настроить токены API Ozon.\n\n"
+        "Используйте команду /set_token чтобы настроить API токен и Client ID.\n"
+        "Или нажмите кнопку ниже:",
+        reply_markup=get_main_keyboard()
+    )
+
+    # Создаем инлайн клавиатуру с кнопкой для открытия веб-приложения
+    app_button = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📊 Открыть веб-приложение", web_app=WebAppInfo(url=WEB_APP_URL))]
+    ])
+
+    # Отправляем второе сообщение с кнопкой веб-приложения
+    await update.message.reply_text(
+        "Также вы можете сразу открыть веб-приложение:",
+        reply_markup=app_button
+    )
+
+@bot_router.command("set_token")
+async def command_set_token(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Сохраняет токены из аргументов команды или начинает диалог ввода токенов"""
     user_id = update.effective_user.id
     username = update.effective_user.username
-    
-    print(f"Обрабатываю команду '{command}' от пользователя {user_id}")
-    
-    # Создаем клавиатуру
     reply_markup = get_main_keyboard()
-    
-    # Обработка команд
-    if command == "start":
-        # Сбрасываем состояние пользователя
-        user_states[user_id] = "idle"
-        
-        # Приветственное сообщение
-        await update.message.reply_text(
-            f"👋 Привет! Я бот для мониторинга вашего магазина Ozon.\n\n"
-            "Для доступа к аналитике и управлению магазином вам нужно настроить токены API Ozon.\n\n"
-            "Используйте команду /set_token чтобы настроить API токен и Client ID.\n"
-            "Или нажмите кнопку ниже:",
-            reply_markup=reply_markup
-        )
-        
-        # Создаем инлайн клавиатуру с кнопкой для открытия веб-приложения
-        app_button = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📊 Открыть веб-приложение", web_app=WebAppInfo(url=WEB_APP_URL))]
-        ])
-        
-        # Отправляем второе сообщение с кнопкой веб-приложения
-        await update.message.reply_text(
-            "Также вы можете сразу открыть веб-приложение:",
-            reply_markup=app_button
-        )
-    
-    elif command == "set_token":
-        # Проверяем аргументы команды
-        args = update.message.text.split()
-        
-        if len(args) >= 3:
-            # Пользователь передал токены в команде
-            api_token = args[1]
-            client_id = args[2]
-            
-            print(f"Получены токены от пользователя {user_id}: API token={api_token[:5]}..., Client ID={client_id}")
-            
-            # Создаем объект с токенами
-            user_token = UserToken(
-                telegram_id=user_id,
-                username=username,
-                ozon_api_token=api_token,
-                ozon_client_id=client_id
-            )
-            
-            # Пытаемся сохранить токены в базу данных
-            try:
-                print("Сохраняю токены в базу данных...")
-                # Используем напрямую функцию для сохранения в БД
-                save_user_token_db(user_token)
-                
-                # Проверяем, что токены сохранились
-                saved_token = await get_user_tokens(user_id)
-                if saved_token:
-                    print(f"Токены успешно сохранены для пользователя {user_id}")
-                    
-                    # Отправляем сообщение об успешном сохранении
-                    await update.message.reply_text(
-                        "✅ API токены успешно сохранены!\n\n"
-                        "Теперь вы можете использовать веб-приложение для анализа данных вашего магазина Ozon.",
-                        reply_markup=reply_markup
-                    )
-                else:
-                    print(f"Ошибка: токены не найдены в БД после сохранения для пользователя {user_id}")
-                    
-                    # Отправляем сообщение об ошибке
-                    await update.message.reply_text(
-                        "❌ Произошла ошибка при сохранении токенов.\n\n"
-                        "Пожалуйста, попробуйте еще раз позже или обратитесь в поддержку.",
-                        reply_markup=reply_markup
-                    )
-            except Exception as e:
-                print(f"Ошибка при сохранении токенов: {type(e).__name__} - {str(e)}")
-                
-                # Отправляем сообщение об ошибке
-                await update.message.reply_text(
-                    f"❌ Произошла ошибка при сохранении токенов: {str(e)}\n\n"
-                    "Пожалуйста, попробуйте еще раз позже или обратитесь в поддержку.",
-                    reply_markup=reply_markup
-                )
-                
-            return
-        
-        # Устанавливаем состояние пользователя
-        user_states[user_id] = "waiting_for_api_token"
-        await update.message.reply_text(
-            "🔑 Пожалуйста, отправьте ваш API токен Ozon.\n\n"
-            "Вы можете найти его в личном кабинете Ozon в разделе API.",
-            reply_markup=reply_markup
+
+    if len(args) >= 2:
+        # Пользователь передал токены в команде
+        api_token = args[0]
+        client_id = args[1]
+
+        logger.info(f"Получены токены от пользователя {user_id}, Client ID={client_id}")
+
+        # Создаем объект с токенами
+        user_token = UserToken(
+            telegram_id=user_id,
+            username=username,
+            ozon_api_token=api_token,
+            ozon_client_id=client_id
         )
-    
-    elif command == "status":
-        # Проверяем статус токенов пользователя
-        tokens = await get_user_tokens(user_id)
-        
-        if tokens:
-            # Проверяем валидность токенов
-            is_valid, message = await verify_ozon_tokens(tokens.ozon_api_token, tokens.ozon_client_id)
-            
-            if is_valid:
-                # Форматируем дату последнего использования
-                last_used = tokens.last_used
-                last_used_str = last_used.strftime("%d.%m.%Y %H:%M:%S") if last_used else "никогда"
-                
+
+        # Пытаемся сохранить токены в базу данных
+        try:
+            logger.info("Сохраняю токены в базу данных...")
+            # Используем напрямую функцию для сохранения в БД
+            save_user_token_db(user_token)
+
+            # Проверяем, что токены сохранились
+            saved_token = await get_user_tokens(user_id)
+            if saved_token:
+                logger.info(f"Токены успешно сохранены для пользователя {user_id}")
+
+                # Отправляем сообщение об успешном сохранении
                 await update.message.reply_text(
-                    "✅ *Ваши токены активны и действительны*\n\n"
-                    f"API токен: `{tokens.ozon_api_token[:5]}...{tokens.ozon_api_token[-5:]}`\n"
-                    f"Client ID: `{tokens.ozon_client_id}`\n"
-                    f"Последнее использование: {last_used_str}\n\n"
-                    "Вы можете использовать веб-приложение для анализа данных или нажать /delete_tokens для удаления токенов.",
-                    parse_mode="Markdown",
+                    "✅ API токены успешно сохранены!\n\n"
+                    "Теперь вы можете использовать веб-приложение для анализа данных вашего магазина Ozon.",
                     reply_markup=reply_markup
                 )
             else:
+                logger.error(f"Ошибка: токены не найдены в БД после сохранения для пользователя {user_id}")
+
+                # Отправляем сообщение об ошибке
                 await update.message.reply_text(
-                    f"⚠️ *Ваши токены недействительны*\n\n"
-                    f"Ошибка: {message}\n\n"
-                    "Рекомендуется установить новые токены с помощью команды /set_token",
-                    parse_mode="Markdown",
-                    reply_markup=reply_markup
-                )
-        else:
-            await update.message.reply_text(
-                "❌ У вас не настроены токены API Ozon.\n\n"
-                "Используйте команду /set_token чтобы настроить API токен и Client ID.",
-                reply_markup=reply_markup
-            )
-    
-    elif command == "delete_tokens":
-        # Удаляем токены пользователя из базы данных
-        success = await delete_user_tokens(user_id)
-        
-        if success:
-            # Сбрасываем состояние пользователя
-            user_states[user_id] = "idle"
-            
-            await update.message.reply_text(
-                "✅ Ваши токены успешно удалены.\n\n"
-                "Вы можете установить новые токены с помощью команды /set_token.",
-                reply_markup=reply_markup
-            )
-        else:
-            await update.message.reply_text(
-                "❌ Произошла ошибка при удалении токенов.\n\n"
-                "Возможно, у вас нет сохраненных токенов.",
-                reply_markup=reply_markup
-            )
-    
-    elif command == "verify":
-        # Проверяем токены пользователя
-        tokens = await get_user_tokens(user_id)
-        
-        if tokens:
-            # Отправляем сообщение о проверке
-            progress_message = await update.message.reply_text("🔄 Проверяем ваши токены, пожалуйста, подождите...")
-            
-            # Проверяем валидность токенов
-            is_valid, message = await verify_ozon_tokens(tokens.ozon_api_token, tokens.ozon_client_id)
-            
-            if is_valid:
-                # Обновляем сообщение с результатом проверки
-                await context.bot.edit_message_text(
-                    chat_id=update.effective_chat.id,
-                    message_id=progress_message.message_id,
-                    text="✅ Ваши токены действительны и активны.",
-                    reply_markup=reply_markup
-                )
-            else:
-                # Обновляем сообщение с ошибкой
-                await context.bot.edit_message_text(
-                    chat_id=update.effective_chat.id,
-                    message_id=progress_message.message_id,
-                    text=f"❌ Ошибка проверки токенов: {message}\n\n"
-                    "Рекомендуется установить новые токены с помощью команды /set_token",
-                    reply_markup=reply_markup
-                )
-        else:
-            await update.message.reply_text(
-                "❌ У вас не настроены токены API Ozon.\n\n"
-                "Используйте команду /set_token чтобы настроить API токен и Client ID.",
-                reply_markup=reply_markup
-            )
-    
-    elif command == "stats":
-        # Получаем статистику из Ozon API
-        tokens = await get_user_tokens(user_id)
-        
-        if not tokens:
-            await update.message.reply_text(
-                "❌ У вас не настроены токены API Ozon.\n\n"
-                "Используйте команду /set_token чтобы настроить API токен и Client ID.",
-                reply_markup=reply_markup
-            )
-            return
-        
-        # Отправляем сообщение о загрузке статистики
-        progress_message = await update.message.reply_text("🔄 Загружаем данные из Ozon API, пожалуйста, подождите...")
-        
-        try:
-            # Получаем данные аналитики из API
-            data = await get_ozon_analytics(tokens.ozon_api_token, tokens.ozon_client_id)
-            
-            if isinstance(data, dict) and "result" in data:
-                # Обрабатываем статистику
-                analytics = data["result"]
-                
-                # Формируем сообщение со статистикой
-                stats_message = "*📊 Статистика вашего магазина Ozon*\n\n"
-                
-                # Добавляем информацию о периоде
-                stats_message += f"📆 *Период:* {analytics.get('period', 'Текущий период')}\n\n"
-                
-                # Добавляем основные показатели
-                if 'metrics' in analytics:
-                    for metric in analytics['metrics']:
-                        name = metric.get('name', 'Показатель')
-                        value = metric.get('value', '0')
-                        stats_message += f"• *{name}:* {value}\n"
-                
-                # Обновляем сообщение со статистикой
-                await context.bot.edit_message_text(
-                    chat_id=update.effective_chat.id,
-                    message_id=progress_message.message_id,
-                    text=stats_message,
-                    parse_mode="Markdown",
-                    reply_markup=reply_markup
-                )
-            else:
-                # Если данные не получены или в неверном формате
-                await context.bot.edit_message_text(
-                    chat_id=update.effective_chat.id,
-                    message_id=progress_message.message_id,
-                    text="❌ Не удалось получить статистику из Ozon API.\n\n"
-                    "Возможно, ваши токены недействительны или произошла ошибка API.",
+                    "❌ Произошла ошибка при сохранении токенов.\n\n"
+                    "Пожалуйста, попробуйте еще раз позже или обратитесь в поддержку.",
                     reply_markup=reply_markup
                 )
         except Exception as e:
-            # Обновляем сообщение с ошибкой
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=progress_message.message_id,
-                text=f"❌ Ошибка при получении статистики: {str(e)}\n\n"
-                "Попробуйте позже или проверьте ваши токены с помощью команды /verify",
+            logger.error(f"Ошибка при сохранении токенов: {type(e).__name__} - {str(e)}")
+
+            # Отправляем сообщение об ошибке
+            await update.message.reply_text(
+                f"❌ Произошла ошибка при сохранении токенов: {str(e)}\n\n"
+                "Пожалуйста, попробуйте еще раз позже или обратитесь в поддержку.",
                 reply_markup=reply_markup
             )
-    
-    elif command == "help" or command == "помощь":
-        # Выводим справку по доступным командам
+
+        return
+
+    # Устанавливаем состояние пользователя
+    await state_store.set_state(user_id, "waiting_for_api_token")
+    await update.message.reply_text(
+        "🔑 Пожалуйста, отправьте ваш API токен Ozon.\n\n"
+        "Вы можете найти его в личном кабинете Ozon в разделе API.",
+        reply_markup=reply_markup
+    )
+
+@bot_router.command("status")
+async def command_status(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Проверяет статус токенов пользователя"""
+    reply_markup = get_main_keyboard()
+    tokens = await get_user_tokens(update.effective_user.id)
+
+    if not tokens:
+        await update.message.reply_text(NO_TOKENS_MESSAGE, reply_markup=reply_markup)
+        return
+
+    # Проверяем валидность токенов
+    is_valid, message = await verify_ozon_tokens(tokens.ozon_api_token, tokens.ozon_client_id)
+
+    if is_valid:
+        # Форматируем дату последнего использования
+        last_used = tokens.last_used
+        last_used_str = last_used.strftime("%d.%m.%Y %H:%M:%S") if last_used else "никогда"
+
         await update.message.reply_text(
-            "🤖 *Справка по командам*\n\n"
-            "/start - Запустить бота\n"
-            "/set_token - Настроить API токен и Client ID\n"
-            "/status - Проверить статус ваших токенов\n"
-            "/verify - Проверить валидность ваших токенов\n"
-            "/stats - Получить статистику из Ozon API\n"
-            "/delete_tokens - Удалить сохраненные токены\n"
-            "/help - Показать это сообщение\n"
-            "/notifications - Настройки уведомлений\n\n"
-            "Для начала работы настройте токены с помощью команды /set_token",
+            "✅ *Ваши токены активны и действительны*\n\n"
+            f"API токен: `{tokens.ozon_api_token[:5]}...{tokens.ozon_api_token[-5:]}`\n"
+            f"Client ID: `{tokens.ozon_client_id}`\n"
+            f"Последнее использование: {last_used_str}\n\n"
+            "Вы можете использовать веб-приложение для анализа данных или нажать /delete_tokens для удаления токенов.",
             parse_mode="Markdown",
             reply_markup=reply_markup
         )
-    
-    elif command == "cancel":
+    else:
+        await update.message.reply_text(
+            f"⚠️ *Ваши токены недействительны*\n\n"
+            f"Ошибка: {message}\n\n"
+            "Рекомендуется установить новые токены с помощью команды /set_token",
+            parse_mode="Markdown",
+            reply_markup=reply_markup
+        )
+
+@bot_router.command("delete_tokens")
+async def command_delete_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Удаляет токены пользователя из базы данных"""
+    user_id = update.effective_user.id
+    reply_markup = get_main_keyboard()
+    success = await delete_user_tokens(user_id)
+
+    if success:
         # Сбрасываем состояние пользователя
-        user_states[user_id] = "idle"
-        
+        await state_store.clear_state(user_id)
+
         await update.message.reply_text(
-            "✅ Операция отменена.\n\n"
-            "Вы можете использовать другие команды или кнопки ниже:",
+            "✅ Ваши токены успешно удалены.\n\n"
+            "Вы можете установить новые токены с помощью команды /set_token.",
             reply_markup=reply_markup
         )
-    
-    elif command == "notifications":
+    else:
+        await update.message.reply_text(
+            "❌ Произошла ошибка при удалении токенов.\n\n"
+            "Возможно, у вас нет сохраненных токенов.",
+            reply_markup=reply_markup
+        )
+
+@bot_router.command("verify")
+async def command_verify(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Проверяет валидность токенов пользователя"""
+    reply_markup = get_main_keyboard()
+    tokens = await get_user_tokens(update.effective_user.id)
+
+    if not tokens:
+        await update.message.reply_text(NO_TOKENS_MESSAGE, reply_markup=reply_markup)
+        return
+
+    # Отправляем сообщение о проверке
+    progress_message = await update.message.reply_text("🔄 Проверяем ваши токены, пожалуйста, подождите...")
+
+    # Проверяем валидность токенов
+    is_valid, message = await verify_ozon_tokens(tokens.ozon_api_token, tokens.ozon_client_id)
+
+    if is_valid:
+        # Обновляем сообщение с результатом проверки
+        await context.bot.edit_message_text(
+            chat_id=update.effective_chat.id,
+            message_id=progress_message.message_id,
+            text="✅ Ваши токены действительны и активны.",
+            reply_markup=reply_markup
+        )
+    else:
+        # Обновляем сообщение с ошибкой
+        await context.bot.edit_message_text(
+            chat_id=update.effective_chat.id,
+            message_id=progress_message.message_id,
+            text=f"❌ Ошибка проверки токенов: {message}\n\n"
+            "Рекомендуется установить новые токены с помощью команды /set_token",
+            reply_markup=reply_markup
+        )
+
+# Сохраненная статистика старше этого возраста обновляется в фоне после ответа на /stats
+STATS_STALE_SECONDS = int(os.getenv("STATS_STALE_SECONDS", "3600"))
+# Сколько ждать окончания обновления в очереди interactive, прежде чем ответить, что обновление в очереди
+STATS_REFRESH_WAIT_SECONDS = int(os.getenv("STATS_REFRESH_WAIT_SECONDS", "120"))
+
+# Фоновые обновления статистики (ссылки нужны, чтобы задачи не удалил сборщик мусора)
+stats_refresh_tasks = set()
+
+async def wait_for_refresh(user_id: int, timeout: float, start_refresh) -> Optional[dict]:
+    """
+    Подписывается на ход обновления данных пользователя, запускает его (start_refresh) и ждет
+    окончания (событие done или error) или возвращает None по таймауту
+    """
+    async def final_event():
+        events = refresh_progress.subscribe(user_id, skip_finished=True, on_subscribed=start_refresh)
         try:
-            # Получаем настройки пользователя
-            settings = await get_notification_settings(update.effective_user.id)
-            
-            # Формируем сообщение с текущими настройками
-            settings_message = (
-                f"🔔 *Текущие настройки уведомлений*\n\n"
-                f"• Порог маржинальности: {settings.margin_threshold}%\n"
-                f"• Порог ROI: {settings.roi_threshold}%\n"
-                f"• Ежедневный отчет: {'Включен' if settings.daily_report else 'Выключен'}\n"
-                f"• Уведомления о продажах: {'Включены' if settings.sales_alert else 'Выключены'}\n"
-                f"• Уведомления о возвратах: {'Включены' if settings.returns_alert else 'Выключены'}\n\n"
-                f"Для изменения настроек используйте команды:\n"
-                f"/set_margin_threshold [число] - установить порог маржинальности\n"
-                f"/set_roi_threshold [число] - установить порог ROI\n"
-                f"/toggle_daily_report - вкл/выкл ежедневный отчет\n"
-                f"/toggle_sales_alert - вкл/выкл уведомления о продажах\n"
-                f"/toggle_returns_alert - вкл/выкл уведомления о возвратах"
+            async for event in events:
+                if event and event["stage"] in refresh_progress.FINAL_STAGES:
+                    return event
+        finally:
+            await events.aclose()
+
+    try:
+        return await asyncio.wait_for(final_event(), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+async def refresh_stats_message(user_id: int, chat_id: int, message_id: int, previous_computed_at: Optional[float]):
+    """
+    Ставит обновление данных пользователя в очередь Celery (interactive) и заменяет сообщение /stats
+    свежей статистикой, когда обновление закончится. Если очередь занята дольше
+    STATS_REFRESH_WAIT_SECONDS, сообщает, что обновление поставлено в очередь
+    """
+    import celery_app
+
+    async def start_refresh():
+        # Если данные уже обновляются (кнопка в Mini App или ночное обновление), ждем это обновление
+        await asyncio.to_thread(celery_app.enqueue_user_refresh, user_id)
+
+    try:
+        # Подписка создается до постановки в очередь, чтобы не пропустить быстрое обновление.
+        # Снимок рассчитывает воркер Celery и сохраняет в общую базу (DATABASE_URL)
+        event = await wait_for_refresh(user_id, STATS_REFRESH_WAIT_SECONDS, start_refresh)
+        
+        snapshot = get_snapshot(user_id, "analytics_month")
+        if event is None and (not snapshot or snapshot["computed_at"] == previous_computed_at):
+            # Обновление еще в очереди: оставляем сохраненные цифры, если они есть
+            if snapshot:
+                text = services.format_stats_message(snapshot["payload"], snapshot["age_seconds"])
+                text += "\n⏳ Обновление данных в очереди, отправьте /stats через несколько минут."
+            else:
+                text = (
+                    "⏳ Обновление данных поставлено в очередь.\n\n"
+                    "Отправьте /stats через несколько минут, чтобы получить свежую статистику."
+                )
+            await get_telegram_bot().edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode="Markdown" if snapshot else None
             )
-            
-            await update.message.reply_text(settings_message, parse_mode="Markdown")
-            return
-            
-        except Exception as e:
-            error_message = f"Ошибка при получении настроек уведомлений: {str(e)}"
-            await update.message.reply_text(error_message)
-            return
-    
-    # Обработка команды установки порога маржинальности
-    if command.startswith('/set_margin_threshold'):
-        try:
-            # Извлекаем значение порога
-            parts = command.split()
-            if len(parts) < 2:
-                await update.message.reply_text("Пожалуйста, укажите значение порога маржинальности. Например: /set_margin_threshold 15")
-                return
-                
-            threshold = float(parts[1])
-            if threshold < 0:
-                await update.message.reply_text("Порог маржинальности не может быть отрицательным.")
-                return
-                
-            # Получаем и обновляем настройки
-            settings = await get_notification_settings(update.effective_user.id)
-            settings.margin_threshold = threshold
-            await save_notification_settings(settings)
-            
-            await update.message.reply_text(f"✅ Порог маржинальности установлен на {threshold}%")
-            return
-            
-        except ValueError:
-            await update.message.reply_text("Пожалуйста, укажите корректное числовое значение порога.")
-            return
-        except Exception as e:
-            error_message = f"Ошибка при установке порога маржинальности: {str(e)}"
-            await update.message.reply_text(error_message)
-            return
-    
-    # Обработка команды установки порога ROI
-    if command.startswith('/set_roi_threshold'):
-        try:
-            # Извлекаем значение порога
-            parts = command.split()
-            if len(parts) < 2:
-                await update.message.reply_text("Пожалуйста, укажите значение порога ROI. Например: /set_roi_threshold 30")
-                return
-                
-            threshold = float(parts[1])
-            if threshold < 0:
-                await update.message.reply_text("Порог ROI не может быть отрицательным.")
-                return
-                
-            # Получаем и обновляем настройки
-            settings = await get_notification_settings(update.effective_user.id)
-            settings.roi_threshold = threshold
-            await save_notification_settings(settings)
-            
-            await update.message.reply_text(f"✅ Порог ROI установлен на {threshold}%")
             return
-            
-        except ValueError:
-            await update.message.reply_text("Пожалуйста, укажите корректное числовое значение порога.")
-            return
-        except Exception as e:
-            error_message = f"Ошибка при установке порога ROI: {str(e)}"
-            await update.message.reply_text(error_message)
-            return
-    
-    # Обработка команды переключения ежедневного отчета
-    if command == '/toggle_daily_report':
-        try:
-            settings = await get_notification_settings(update.effective_user.id)
-            settings.daily_report = not settings.daily_report
-            await save_notification_settings(settings)
-            
-            status = "включены" if settings.daily_report else "выключены"
-            await update.message.reply_text(f"✅ Ежедневные отчеты {status}")
-            return
-            
-        except Exception as e:
-            error_message = f"Ошибка при изменении настроек ежедневного отчета: {str(e)}"
-            await update.message.reply_text(error_message)
-            return
-    
-    # Обработка команды переключения уведомлений о продажах
-    if command == '/toggle_sales_alert':
-        try:
-            settings = await get_notification_settings(update.effective_user.id)
-            settings.sales_alert = not settings.sales_alert
-            await save_notification_settings(settings)
-            
-            status = "включены" if settings.sales_alert else "выключены"
-            await update.message.reply_text(f"✅ Уведомления о продажах {status}")
-            return
-            
-        except Exception as e:
-            error_message = f"Ошибка при изменении настроек уведомлений о продажах: {str(e)}"
-            await update.message.reply_text(error_message)
-            return
-    
-    # Обработка команды переключения уведомлений о возвратах
-    if command == '/toggle_returns_alert':
-        try:
-            settings = await get_notification_settings(update.effective_user.id)
-            settings.returns_alert = not settings.returns_alert
-            await save_notification_settings(settings)
-            
-            status = "включены" if settings.returns_alert else "выключены"
-            await update.message.reply_text(f"✅ Уведомления о возвратах {status}")
+        
+        if not snapshot or snapshot["computed_at"] == previous_computed_at:
+            if previous_computed_at is None:
+                await get_telegram_bot().edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text="❌ Не удалось получить статистику из Ozon API.\n\n"
+                    "Возможно, ваши токены недействительны или произошла ошибка API."
+                )
             return
-            
-        except Exception as e:
-            error_message = f"Ошибка при изменении настроек уведомлений о возвратах: {str(e)}"
-            await update.message.reply_text(error_message)
+        
+        await get_telegram_bot().edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=services.format_stats_message(snapshot["payload"], snapshot["age_seconds"]),
+            parse_mode="Markdown"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении статистики пользователя {user_id}: {str(e)}")
+        if previous_computed_at is None:
+            try:
+                await get_telegram_bot().edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=f"❌ Ошибка при получении статистики: {str(e)}\n\n"
+                    "Попробуйте позже или проверьте ваши токены с помощью команды /verify"
+                )
+            except Exception as inner_e:
+                logger.error(f"Ошибка при отправке сообщения об ошибке: {str(inner_e)}")
+
+def get_telegram_bot() -> Bot:
+    """Бот для запросов вне обработки обновлений: меню команд, вебхук, сообщения фоновых задач"""
+    if bot is None:
+        raise RuntimeError("Telegram бот еще не инициализирован")
+    return bot
+
+@bot_router.command("stats")
+async def command_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """
+    Отвечает сохраненной статистикой сразу. Если она устарела или еще не рассчитана,
+    данные обновляются в фоне, а сообщение заменяется свежими цифрами
+    """
+    user_id = update.effective_user.id
+    reply_markup = get_main_keyboard()
+    tokens = await get_user_tokens(user_id)
+
+    if not tokens:
+        await update.message.reply_text(NO_TOKENS_MESSAGE, reply_markup=reply_markup)
+        return
+
+    # Последняя рассчитанная аналитика за месяц (сохраняется при каждом обновлении данных)
+    snapshot = get_snapshot(user_id, "analytics_month")
+
+    if snapshot:
+        stale = snapshot["age_seconds"] > STATS_STALE_SECONDS
+        text = services.format_stats_message(snapshot["payload"], snapshot["age_seconds"])
+        if stale:
+            text += "\n🔄 Обновляем данные, сообщение обновится автоматически..."
+        message = await update.message.reply_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+        if not stale:
             return
-    
+        previous_computed_at = snapshot["computed_at"]
     else:
+        message = await update.message.reply_text("🔄 Загружаем данные из Ozon API, пожалуйста, подождите...")
+        previous_computed_at = None
+
+    task = asyncio.create_task(
+        refresh_stats_message(user_id, update.effective_chat.id, message.message_id, previous_computed_at)
+    )
+    stats_refresh_tasks.add(task)
+    task.add_done_callback(stats_refresh_tasks.discard)
+
+@bot_router.command("help", "помощь")
+async def command_help(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Выводит справку по доступным командам"""
+    await update.message.reply_text(
+        "🤖 *Справка по командам*\n\n"
+        "/start - Запустить бота\n"
+        "/set_token - Настроить API токен и Client ID\n"
+        "/status - Проверить статус ваших токенов\n"
+        "/verify - Проверить валидность ваших токенов\n"
+        "/stats - Получить статистику из Ozon API\n"
+        "/delete_tokens - Удалить сохраненные токены\n"
+        "/help - Показать это сообщение\n"
+        "/notifications - Настройки уведомлений\n\n"
+        "Для начала работы настройте токены с помощью команды /set_token",
+        parse_mode="Markdown",
+        reply_markup=get_main_keyboard()
+    )
+
+@bot_router.command("cancel", "отмена")
+async def command_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Отменяет текущую операцию"""
+    # Сбрасываем состояние пользователя
+    await state_store.clear_state(update.effective_user.id)
+
+    await update.message.reply_text(
+        "✅ Операция отменена.\n\n"
+        "Вы можете использовать другие команды или кнопки ниже:",
+        reply_markup=get_main_keyboard()
+    )
+
+@bot_router.command("notifications")
+async def command_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Показывает текущие настройки уведомлений"""
+    try:
+        # Получаем настройки пользователя
+        settings = await get_notification_settings(update.effective_user.id)
+
+        # Формируем сообщение с текущими настройками
+        settings_message = (
+            f"🔔 *Текущие настройки уведомлений*\n\n"
+            f"• Порог маржинальности: {settings.margin_threshold}%\n"
+            f"• Порог ROI: {settings.roi_threshold}%\n"
+            f"• Ежедневный отчет: {'Включен' if settings.daily_report else 'Выключен'}\n"
+            f"• Уведомления о продажах: {'Включены' if settings.sales_alert else 'Выключены'}\n"
+            f"• Уведомления о возвратах: {'Включены' if settings.returns_alert else 'Выключены'}\n\n"
+            f"Для изменения настроек используйте команды:\n"
+            f"/set\\_margin\\_threshold [число] - установить порог маржинальности\n"
+            f"/set\\_roi\\_threshold [число] - установить порог ROI\n"
+            f"/toggle\\_daily\\_report - вкл/выкл ежедневный отчет\n"
+            f"/toggle\\_sales\\_alert - вкл/выкл уведомления о продажах\n"
+            f"/toggle\\_returns\\_alert - вкл/выкл уведомления о возвратах"
+        )
+
+        await update.message.reply_text(settings_message, parse_mode="Markdown")
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка при получении настроек уведомлений: {str(e)}")
+
+async def set_notification_threshold(update: Update, args: list, field: str, title: str, example: int) -> None:
+    """Устанавливает порог уведомлений (маржинальности или ROI) из аргумента команды"""
+    if not args:
+        await update.message.reply_text(f"Пожалуйста, укажите значение порога {title}. Например: /set_{field} {example}")
+        return
+
+    try:
+        threshold = float(args[0].replace(",", "."))
+    except ValueError:
+        await update.message.reply_text("Пожалуйста, укажите корректное числовое значение порога.")
+        return
+
+    if threshold < 0:
+        await update.message.reply_text(f"Порог {title} не может быть отрицательным.")
+        return
+
+    try:
+        # Получаем и обновляем настройки
+        settings = await get_notification_settings(update.effective_user.id)
+        setattr(settings, field, threshold)
+        await save_notification_settings(settings)
+
+        await update.message.reply_text(f"✅ Порог {title} установлен на {threshold}%")
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка при установке порога {title}: {str(e)}")
+
+@bot_router.command("set_margin_threshold")
+async def command_set_margin_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Устанавливает порог маржинальности"""
+    await set_notification_threshold(update, args, "margin_threshold", "маржинальности", 15)
+
+@bot_router.command("set_roi_threshold")
+async def command_set_roi_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Устанавливает порог ROI"""
+    await set_notification_threshold(update, args, "roi_threshold", "ROI", 30)
+
+async def toggle_notification_setting(update: Update, field: str, title: str) -> None:
+    """Включает или выключает один из видов уведомлений"""
+    try:
+        settings = await get_notification_settings(update.effective_user.id)
+        setattr(settings, field, not getattr(settings, field))
+        await save_notification_settings(settings)
+
+        status = "включены" if getattr(settings, field) else "выключены"
+        await update.message.reply_text(f"✅ {title} {status}")
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка при изменении настроек ({title.lower()}): {str(e)}")
+
+@bot_router.command("toggle_daily_report")
+async def command_toggle_daily_report(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Включает или выключает ежедневный отчет"""
+    await toggle_notification_setting(update, "daily_report", "Ежедневные отчеты")
+
+@bot_router.command("toggle_sales_alert")
+async def command_toggle_sales_alert(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Включает или выключает уведомления о продажах"""
+    await toggle_notification_setting(update, "sales_alert", "Уведомления о продажах")
+
+@bot_router.command("toggle_returns_alert")
+async def command_toggle_returns_alert(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list) -> None:
+    """Включает или выключает уведомления о возвратах"""
+    await toggle_notification_setting(update, "returns_alert", "Уведомления о возвратах")
+
+for command_name, keyword in COMMAND_KEYWORDS:
+    bot_router.add_alias(command_name, keyword)
+
+async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает команды от пользователя (сообщения, начинающиеся с /)"""
+    if not update.message or not update.message.text:
+        logger.error("Ошибка: нет текста сообщения в handle_command")
+        return
+
+    if not await bot_router.dispatch(update, context):
         # Неизвестная команда
         await update.message.reply_text(
             "❓ Неизвестная команда. Используйте /help для получения справки по доступным командам.",
-            reply_markup=reply_markup
+            reply_markup=get_main_keyboard()
         )
 
 # Функция для обработки текстовых сообщений (не команд)
@@ -833,74 +883,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     message_text = update.message.text.strip() if update.message.text else ""
 
-    print(f"Получено текстовое сообщение: '{message_text}' от пользователя {user_id}")
+    webhook_logger.debug("Получено текстовое сообщение", extra={"user_id": user_id, "length": len(message_text)})
 
-    # Проверяем, есть ли пользователь в словаре состояний
-    if user_id not in user_states:
-        user_states[user_id] = "idle"
-        await update.message.reply_text(
-            "Для начала работы с ботом, пожалуйста, используйте команду /start",
-            reply_markup=get_main_keyboard()
-        )
-        return
-
-    current_state = user_states[user_id]
+    # Состояние диалога общее для всех процессов (см. state_store.py)
+    current_state = await state_store.get_state(user_id) or {"state": state_store.IDLE}
+    state_name = current_state["state"]
     reply_markup = get_main_keyboard()
-    
-    # Если сообщение начинается с /, это команда - передаем в обработчик команд
-    if message_text.startswith('/'):
-        print(f"Обнаружена команда в сообщении: {message_text}")
-        await handle_command(update, context)
-        return
-    
-    # Проверка для кнопок клавиатуры, если сообщение совпадает с командой, но без /
-    command_to_check = f"/{message_text.lower()}"
-    if command_to_check in ["/start", "/help", "/set_token", "/status", "/stats", "/delete_tokens", "/verify"]:
-        print(f"Обнаружена команда без / из кнопки: {message_text} -> {command_to_check}")
-        update.message.text = command_to_check
-        await handle_command(update, context)
-        return
-    
-    # Обработка текстовых кнопок с русскими названиями
-    message_lower = message_text.lower()
-    if "запустить" in message_lower or "бота" in message_lower:
-        print(f"Команда из текста: {message_text} -> /start")
-        update.message.text = "/start"
-        await handle_command(update, context)
-        return
-    elif "помощь" in message_lower or "справка" in message_lower:
-        print(f"Команда из текста: {message_text} -> /help")
-        update.message.text = "/help"
-        await handle_command(update, context)
-        return
-    elif "установить" in message_lower and "токены" in message_lower or "токены" in message_lower and "удалить" not in message_lower:
-        print(f"Команда из текста: {message_text} -> /set_token")
-        update.message.text = "/set_token"
-        await handle_command(update, context)
-        return
-    elif "статус" in message_lower or "проверить статус" in message_lower:
-        print(f"Команда из текста: {message_text} -> /status")
-        update.message.text = "/status"
-        await handle_command(update, context)
-        return
-    elif "статистика" in message_lower:
-        print(f"Команда из текста: {message_text} -> /stats")
-        update.message.text = "/stats"
-        await handle_command(update, context)
-        return
-    elif "удалить" in message_lower and "токены" in message_lower:
-        print(f"Команда из текста: {message_text} -> /delete_tokens")
-        update.message.text = "/delete_tokens"
-        await handle_command(update, context)
-        return
-    elif "проверить токены" in message_lower or "проверить" in message_lower and "токены" in message_lower or "валидность" in message_lower:
-        print(f"Команда из текста: {message_text} -> /verify")
-        update.message.text = "/verify"
-        await handle_command(update, context)
+
+    # Во время ввода токенов ключевые слова не проверяем, чтобы не принять токен за команду
+    waiting_for_input = state_name != state_store.IDLE
+
+    # Текст кнопок и команды без слеша ("stats", "Статистика", "Удалить токены")
+    if await bot_router.dispatch(update, context, allow_aliases=not waiting_for_input):
         return
 
     # Если пользователь в состоянии ожидания API токена
-    if current_state == "waiting_for_api_token":
+    if state_name == "waiting_for_api_token":
         # Очищаем токен от кавычек и пробелов
         cleaned_token = message_text.strip("\"' \t\n")
         
@@ -914,8 +912,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
         
-        # Сохраняем токен в состоянии пользователя
-        user_states[user_id] = {"state": "waiting_for_client_id", "api_token": cleaned_token}
+        # Сохраняем токен в состоянии пользователя. Состояние хранится в Redis или в базе,
+        # поэтому токен шифруется так же, как токены пользователей API
+        encrypted_token = encrypt_tokens({"api_token": cleaned_token})
+        if not await state_store.transition(user_id, "waiting_for_api_token", "waiting_for_client_id", api_token=encrypted_token):
+            # Диалог уже продвинулся дальше (сообщение обработано другим процессом)
+            return
         
         await update.message.reply_text(
             "✅ API токен сохранен\n\n"
@@ -926,7 +928,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
         
     # Если пользователь в состоянии ожидания Client ID
-    elif isinstance(current_state, dict) and current_state.get("state") == "waiting_for_client_id":
+    elif state_name == "waiting_for_client_id":
         # Очищаем от кавычек и пробелов
         cleaned_client_id = message_text.strip("\"' \t\n")
         
@@ -939,7 +941,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
         
-        api_token = current_state.get("api_token", "")
+        try:
+            api_token = decrypt_tokens(current_state.get("api_token", ""))["api_token"]
+        except HTTPException:
+            # Токен сохранен до включения шифрования или ключ сменился: начинаем ввод заново
+            await state_store.set_state(user_id, "waiting_for_api_token")
+            await update.message.reply_text(
+                "❌ Не удалось прочитать сохраненный API токен. Пожалуйста, отправьте API токен еще раз.",
+                reply_markup=reply_markup
+            )
+            return
+        
+        # Переводим диалог в состояние проверки, чтобы токены не проверялись дважды
+        if not await state_store.transition(user_id, "waiting_for_client_id", "verifying_tokens"):
+            return
         
         # Отправляем сообщение о проверке токенов
         progress_message = await update.message.reply_text("🔄 Проверяем ваши токены, пожалуйста, подождите...")
@@ -953,7 +968,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             
             if success:
                 # Очищаем состояние пользователя
-                user_states[user_id] = "idle"
+                await state_store.clear_state(user_id)
                 
                 # Обновляем прогресс-сообщение
                 await context.bot.edit_message_text(
@@ -965,7 +980,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 )
             else:
                 # Устанавливаем состояние ожидания API токена
-                user_states[user_id] = "waiting_for_api_token"
+                await state_store.set_state(user_id, "waiting_for_api_token")
                 
                 # Обновляем прогресс-сообщение
                 await context.bot.edit_message_text(
@@ -976,7 +991,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 )
         else:
             # Устанавливаем состояние ожидания API токена
-            user_states[user_id] = "waiting_for_api_token"
+            await state_store.set_state(user_id, "waiting_for_api_token")
             
             # Обновляем прогресс-сообщение с подробной информацией об ошибке
             await context.bot.edit_message_text(
@@ -995,6 +1010,146 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         reply_markup=reply_markup
     )
 
+async def handle_non_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отвечает на сообщения без текста (стикеры, фото и т.п.) клавиатурой с командами"""
+    logger.info(f"Получено сообщение без текста от пользователя {update.effective_user.id if update.effective_user else 'неизвестно'}")
+    try:
+        await update.message.reply_text(
+            "Используйте команды бота или кнопки ниже:",
+            reply_markup=get_main_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при отправке клавиатуры: {str(e)}")
+
+async def handle_telegram_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Логирует ошибки, возникшие в обработчиках обновлений"""
+    logger.error(f"Ошибка при обработке обновления: {type(context.error).__name__} - {str(context.error)}")
+
+# Единственный экземпляр Application: создается при запуске сервиса, обработчики регистрируются один раз.
+# Инициализация (запрос getMe) и настройка бота выполняются в фоне, чтобы медленный или недоступный
+# Telegram не задерживал готовность сервиса
+telegram_application: Optional[Application] = None
+# Бот создается при инициализации Telegram, а не при импорте модуля (см. start_telegram_application)
+bot: Optional[Bot] = None
+telegram_init_task: Optional[asyncio.Task] = None
+telegram_setup_task: Optional[asyncio.Task] = None
+# Отправитель уведомлений, которые веб-сервис ставит в outbox (например, /send_report)
+outbox_sender_task: Optional[asyncio.Task] = None
+
+# Сколько обработчик обновления ждет инициализации Application (секунды)
+TELEGRAM_INIT_WAIT_SECONDS = float(os.getenv("TELEGRAM_INIT_WAIT_SECONDS", "30"))
+# Меню команд и вебхук настраивает один процесс; повторно - не раньше чем через это время (секунды)
+TELEGRAM_SETUP_LOCK_TTL = int(os.getenv("TELEGRAM_SETUP_LOCK_TTL", "3600"))
+TELEGRAM_SETUP_TIMEOUT = float(os.getenv("TELEGRAM_SETUP_TIMEOUT", "30"))
+
+def build_telegram_application() -> Application:
+    """Создает Application бота и регистрирует обработчики обновлений"""
+    from telegram.ext import Application, MessageHandler, filters
+
+    # Обновления приходят через вебхук, поэтому Updater (long polling) не нужен.
+    # Запросы к Bot API идут через общий пул соединений (см. telegram_client.py)
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(PooledTelegramRequest())
+        .get_updates_request(PooledTelegramRequest())
+        .updater(None)
+        .build()
+    )
+    
+    # Команды (текст начинается с /) и обычные текстовые сообщения
+    application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^/'), handle_command))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.Regex(r'^/'), handle_message))
+    application.add_handler(MessageHandler(~filters.TEXT, handle_non_text_message))
+    application.add_error_handler(handle_telegram_error)
+    
+    return application
+
+async def start_telegram_application():
+    """Инициализирует Application бота (выполняется в фоне после запуска сервиса)"""
+    global telegram_application, bot
+    started = time.perf_counter()
+    try:
+        application = build_telegram_application()
+        # initialize() запрашивает getMe у Telegram
+        await application.initialize()
+        telegram_application = application
+        bot = application.bot
+        startup_timings["telegram_init_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        logger.info("Telegram Application инициализирован", extra={"duration_ms": startup_timings["telegram_init_ms"]})
+    except Exception as e:
+        telegram_application = None
+        logger.error(f"Ошибка инициализации Telegram Application: {str(e)}")
+        # Без Application сообщения фоновых задач отправляются отдельным ботом через общий пул соединений
+        bot = telegram_client.create_bot(TELEGRAM_BOT_TOKEN)
+
+async def wait_telegram_application(timeout: float = TELEGRAM_INIT_WAIT_SECONDS):
+    """Ждет окончания инициализации Application, если она еще идет"""
+    if telegram_application is None and telegram_init_task is not None and not telegram_init_task.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(telegram_init_task), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def stop_telegram_application():
+    """Закрывает Application бота и его HTTP-клиент при остановке сервиса"""
+    global telegram_application, bot
+    bot = None
+    if telegram_application is None:
+        return
+    try:
+        await telegram_application.shutdown()
+        logger.info("Telegram Application остановлен")
+    except Exception as e:
+        logger.error(f"Ошибка при остановке Telegram Application: {str(e)}")
+    finally:
+        telegram_application = None
+
+# Очередь обновлений: вебхук сразу отвечает Telegram, а обработка идет в фоне (см. update_queue.py)
+update_dispatcher: Optional[UpdateDispatcher] = None
+
+# Сколько длится остановка сервиса (секунды); должно быть меньше graceful timeout gunicorn (30 с)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+
+# Устанавливается в начале остановки: новые обновления не принимаются
+shutting_down = False
+
+async def enqueue_telegram_update(update_data: dict):
+    """
+    Ставит обновление в очередь обработки и возвращает ответ для Telegram.
+    Повторно доставленные обновления пропускаются. Если очередь переполнена,
+    возвращается ответ 503, чтобы Telegram повторил доставку позже
+    """
+    if shutting_down:
+        # Telegram повторит доставку, и обновление обработает другой процесс
+        return JSONResponse(status_code=503, content={"status": "error", "message": "Сервис останавливается"})
+    
+    update_id = update_data.get('update_id')
+    if update_id is not None and not await update_dedup.mark_update_seen(update_id):
+        webhook_logger.info("Повторная доставка обновления пропущена", extra={"update_id": update_id})
+        return {"status": "ok", "message": "Обновление уже принято"}
+    
+    if update_dispatcher is None or not update_dispatcher.submit(update_data):
+        webhook_logger.warning("Очередь обновлений переполнена, обновление отклонено", extra={"update_id": update_id})
+        if update_id is not None:
+            await update_dedup.forget_update(update_id)
+        return JSONResponse(status_code=503, content={"status": "error", "message": "Очередь обновлений переполнена"})
+    
+    return {"status": "ok", "message": "Обновление принято"}
+
+async def process_telegram_update(update_data: dict):
+    """Передает обновление от Telegram в Application для маршрутизации по обработчикам"""
+    await wait_telegram_application()
+    if telegram_application is None:
+        raise RuntimeError("Telegram Application не инициализирован")
+    
+    update_obj = Update.de_json(data=update_data, bot=telegram_application.bot)
+    if not update_obj or not update_obj.message:
+        webhook_logger.debug("Обновление без сообщения пропущено", extra={"update_id": update_data.get("update_id")})
+        return
+    
+    await telegram_application.process_update(update_obj)
+
 @app.post("/webhook/{token}")
 async def telegram_webhook_with_token(token: str, update: dict = None):
     """Обработчик вебхука от Telegram (новая версия с передачей токена)"""
@@ -1009,59 +1164,20 @@ async def telegram_webhook_with_token(token: str, update: dict = None):
         if not isinstance(update, dict):
             return {"status": "error", "message": "Неверный формат данных"}
             
-        # Логируем получение обновления для отладки
-        update_id = update.get('update_id', 'неизвестно')
-        message_data = update.get('message', {})
-        message_text = message_data.get('text', 'нет текста') if message_data else 'нет текста'
-        user_id = message_data.get('from', {}).get('id', 'неизвестно') if message_data else 'неизвестно'
-        username = message_data.get('from', {}).get('username', 'неизвестно') if message_data else 'неизвестно'
-        
-        print(f"Получено обновление #{update_id} от пользователя {user_id} (@{username}): {message_text[:100]}...")
-        
-        # Дополнительная информация для отладки сообщений
-        if message_text:
-            print(f"Содержимое сообщения: '{message_text}' (длина: {len(message_text)})")
-            print(f"Коды символов: {[ord(c) for c in message_text[:20]]}")
-        
-        # Используем правильный метод для создания объекта Update
-        update_obj = Update.de_json(data=update, bot=bot)
-        
-        # Создаем объект приложения и контекста
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-        context = CallbackContext(application)
-        
-        # Проверяем, что это сообщение (может быть другой тип обновления)
-        if update_obj and update_obj.message:
-            # Если это команда
-            if update_obj.message.text and update_obj.message.text.startswith('/'):
-                print(f"Обрабатываем команду: {update_obj.message.text}")
-                await handle_command(update_obj, context)
-            # Если это обычный текст
-            elif update_obj.message.text:
-                print(f"Обрабатываем текстовое сообщение: {update_obj.message.text}")
-                await handle_message(update_obj, context)
-            else:
-                print(f"Получено сообщение без текста от пользователя {user_id}")
-                # Отправляем клавиатуру в любом случае
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text="Используйте команды бота или кнопки ниже:",
-                        reply_markup=get_main_keyboard()
-                    )
-                except Exception as inner_e:
-                    print(f"Ошибка при отправке клавиатуры: {str(inner_e)}")
-        else:
-            print(f"Получено обновление, не содержащее сообщения: {str(update)[:200]}...")
-        
-        return {"status": "ok", "message": "Обновление обработано"}
+        # Текст сообщения не логируем: в нем могут быть токены
+        message_data = update.get('message') or {}
+        webhook_logger.info("Получено обновление", extra={
+            "update_id": update.get('update_id'),
+            "user_id": message_data.get('from', {}).get('id'),
+        })
+        
+        # Обработка идет в фоне, Telegram получает ответ сразу
+        return await enqueue_telegram_update(update)
     except Exception as e:
         # Подробный вывод ошибки для отладки
         error_type = type(e).__name__
         error_msg = str(e)
-        print(f"Ошибка при обработке вебхука: {error_type} - {error_msg}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Ошибка при обработке вебхука: {error_type} - {error_msg}")
         
         # Более подробный ответ
         return {
@@ -1079,56 +1195,23 @@ async def telegram_webhook(request: Request):
         try:
             update_data = await request.json()
         except Exception as e:
-            print(f"Ошибка при чтении тела запроса: {str(e)}")
+            logger.error(f"Ошибка при чтении тела запроса: {str(e)}")
             return {"status": "error", "message": "Ошибка при чтении тела запроса"}
             
         # Базовая проверка
         if not isinstance(update_data, dict):
             return {"status": "error", "message": "Неверный формат данных"}
         
-        # Логируем получение обновления для отладки
-        update_id = update_data.get('update_id', 'неизвестно')
-        message_text = update_data.get('message', {}).get('text', 'нет текста')
-        user_id = update_data.get('message', {}).get('from', {}).get('id', 'неизвестно')
-        username = update_data.get('message', {}).get('from', {}).get('username', 'неизвестно')
-        print(f"Получен вебхук через /telegram/webhook: #{update_id} от пользователя {user_id} (@{username}): {message_text[:100]}...")
-            
-        # Создаем объект Update
-        try:
-            # В python-telegram-bot нужно использовать Update.de_json вместо from_dict
-            update_obj = Update.de_json(data=update_data, bot=bot)
-            
-            # Создаем объект приложения и контекста
-            application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-            context = CallbackContext(application)
-            
-            # Проверяем, что это сообщение (может быть другой тип обновления)
-            if update_obj and update_obj.message:
-                # Если это команда
-                if update_obj.message.text and update_obj.message.text.startswith('/'):
-                    print(f"Обрабатываем команду через /telegram/webhook: {update_obj.message.text}")
-                    await handle_command(update_obj, context)
-                # Если это обычный текст
-                elif update_obj.message.text:
-                    print(f"Обрабатываем текстовое сообщение через /telegram/webhook: {update_obj.message.text}")
-                    await handle_message(update_obj, context)
-                else:
-                    print(f"Получено сообщение без текста от пользователя {user_id}")
-            else:
-                print(f"Получено обновление, не содержащее сообщения: {str(update_data)[:200]}...")
-                
-            return {"status": "ok", "message": "Обновление обработано"}
-        except Exception as e:
-            error_type = type(e).__name__
-            error_msg = str(e)
-            print(f"Ошибка обработки Update: {error_type} - {error_msg}")
-            import traceback
-            traceback.print_exc()
-            return {"status": "error", "error_type": error_type, "message": error_msg}
+        # Текст сообщения не логируем: в нем могут быть токены
+        message_data = update_data.get('message') or {}
+        webhook_logger.info("Получено обновление через /telegram/webhook", extra={
+            "update_id": update_data.get('update_id'),
+            "user_id": message_data.get('from', {}).get('id'),
+        })
+        
+        return await enqueue_telegram_update(update_data)
     except Exception as e:
-        print(f"Ошибка обработки вебхука через /telegram/webhook: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Ошибка обработки вебхука через /telegram/webhook: {str(e)}")
         return {"status": "error", "message": f"Ошибка: {str(e)}"}
 
 @app.get("/telegram/user/{user_id}/tokens")
@@ -1165,7 +1248,7 @@ async def verify_ozon_tokens(api_token: str, client_id: str) -> tuple:
         payload = {}
         
         try:
-            async with aiohttp.ClientSession() as session:
+            async with ozon_api.client_session() as session:
                 async with session.post(url, json=payload, headers=headers) as response:
                     response_json = await response.json()
                     if response.status == 200:
@@ -1211,7 +1294,7 @@ async def save_user_token_with_verification(user_token: UserToken) -> tuple:
 def update_token_usage(telegram_id: int):
     """Обновляет время последнего использования токенов"""
     with get_db() as conn:
-        cursor = conn.cursor()
+        cursor = PortableCursor(conn)
         cursor.execute('''
             UPDATE user_tokens 
             SET last_updated = CURRENT_TIMESTAMP
@@ -1238,22 +1321,22 @@ async def verify_tokens(tokens: ApiTokens):
 async def auth_by_telegram_id(telegram_id: int):
     """Авторизация по Telegram ID и получение токенов для фронтенда"""
     try:
-        print(f"Попытка авторизации для telegram_id: {telegram_id}")
+        logger.info(f"Попытка авторизации для telegram_id: {telegram_id}")
         
         user_token = await get_user_tokens(telegram_id)
         
         if not user_token:
-            print(f"Пользователь {telegram_id} не найден или нет токенов")
+            logger.warning(f"Пользователь {telegram_id} не найден или нет токенов")
             raise HTTPException(status_code=404, detail="Пользователь не найден или не установлены API токены. Пожалуйста, установите токены через Telegram бота.")
         
-        print(f"Пользователь {telegram_id} найден, получены токены: {user_token.ozon_api_token[:5]}..., {user_token.ozon_client_id}")
+        logger.info(f"Пользователь {telegram_id} найден, Client ID={user_token.ozon_client_id}")
         
         # Обновляем время последнего использования токенов
         try:
             update_token_usage(telegram_id)
-            print(f"Обновлено время использования токенов для {telegram_id}")
+            logger.info(f"Обновлено время использования токенов для {telegram_id}")
         except Exception as e:
-            print(f"Ошибка при обновлении времени использования: {str(e)}")
+            logger.error(f"Ошибка при обновлении времени использования: {str(e)}")
             # Продолжаем выполнение, так как это не критическая ошибка
         
         # Генерируем API ключ для использования на фронтенде
@@ -1271,11 +1354,11 @@ async def auth_by_telegram_id(telegram_id: int):
         try:
             is_valid, message = await verify_ozon_tokens(user_token.ozon_api_token, user_token.ozon_client_id)
             if not is_valid:
-                print(f"Токены для {telegram_id} недействительны: {message}")
+                logger.warning(f"Токены для {telegram_id} недействительны: {message}")
                 raise HTTPException(status_code=400, detail=f"Токены больше не действительны. Пожалуйста, обновите их через Telegram бота. Ошибка: {message}")
-            print(f"Токены для {telegram_id} действительны")
+            logger.info(f"Токены для {telegram_id} действительны")
         except Exception as e:
-            print(f"Ошибка при проверке токенов для {telegram_id}: {str(e)}")
+            logger.error(f"Ошибка при проверке токенов для {telegram_id}: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Ошибка при проверке токенов: {str(e)}")
         
         # Шифруем и сохраняем токены
@@ -1287,12 +1370,12 @@ async def auth_by_telegram_id(telegram_id: int):
                 "api_key": api_key,
                 "telegram_id": telegram_id
             }
-            print(f"Токены успешно сохранены в кэше для {telegram_id}")
+            logger.info(f"Токены успешно сохранены в кэше для {telegram_id}")
             
             # Обновляем обратный словарь
             update_users_db_reverse()
         except Exception as e:
-            print(f"Ошибка при шифровании/сохранении токенов для {telegram_id}: {str(e)}")
+            logger.error(f"Ошибка при шифровании/сохранении токенов для {telegram_id}: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Ошибка при шифровании токенов: {str(e)}")
         
         return {
@@ -1305,16 +1388,14 @@ async def auth_by_telegram_id(telegram_id: int):
         # Пробрасываем HTTPException дальше
         raise
     except Exception as e:
-        print(f"Неожиданная ошибка при авторизации через Telegram ID {telegram_id}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Неожиданная ошибка при авторизации через Telegram ID {telegram_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
 @app.get("/telegram/users")
 async def get_telegram_users():
     """Получает список пользователей Telegram (только для админа)"""
     with get_db() as conn:
-        cursor = conn.cursor()
+        cursor = PortableCursor(conn)
         cursor.execute('SELECT telegram_id, username, created_at FROM user_tokens')
         users = cursor.fetchall()
         return {"users": [{"telegram_id": u[0], "username": u[1], "created_at": u[2]} for u in users]}
@@ -1328,62 +1409,167 @@ async def setup_webhook():
         
         if render_external_url:
             webhook_url = f"{render_external_url}/telegram/webhook"
-            print(f"Настройка вебхука на Render.com: {webhook_url}")
+            logger.info(f"Настройка вебхука на Render.com: {webhook_url}")
             # Устанавливаем вебхук
-            response = requests.get(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook?url={webhook_url}"
-            )
-            print(f"Ответ Telegram API: {response.json()}")
-            
-            if response.status_code == 200 and response.json().get("ok"):
-                print("✅ Вебхук успешно настроен!")
-            else:
-                print(f"❌ Ошибка настройки вебхука: {response.json()}")
-            
-            # Настраиваем меню команд
-            await setup_bot_commands()
+            if await get_telegram_bot().set_webhook(url=webhook_url):
+                logger.info("✅ Вебхук успешно настроен!")
+                return True
+            logger.error("❌ Ошибка настройки вебхука")
         else:
-            print("⚠️ RENDER_EXTERNAL_URL не установлен. Невозможно настроить вебхук автоматически.")
-            print("⚠️ Вебхук не настроен - для работы используйте ручное тестирование через эндпоинт /telegram/webhook")
+            logger.warning("⚠️ RENDER_EXTERNAL_URL не установлен. Невозможно настроить вебхук автоматически.")
+            logger.warning("⚠️ Вебхук не настроен - для работы используйте ручное тестирование через эндпоинт /telegram/webhook")
+            return True
     except Exception as e:
-        print(f"Ошибка настройки вебхука: {str(e)}")
+        logger.error(f"Ошибка настройки вебхука: {str(e)}")
+    return False
+
+async def configure_telegram():
+    """
+    Однократная настройка бота: меню команд и вебхук. Выполняет только процесс, получивший
+    блокировку в Redis, остальные воркеры пропускают настройку. Если настройка не удалась,
+    блокировка снимается, чтобы ее повторил следующий запущенный процесс
+    """
+    if telegram_init_task is not None:
+        await telegram_init_task
+
+    # Ключ зависит от адреса вебхука, поэтому смена адреса сразу приводит к повторной настройке
+    webhook_hash = hashlib.sha256((os.getenv("RENDER_EXTERNAL_URL") or "").encode()).hexdigest()[:16]
+    lock_key = f"telegram:setup:{webhook_hash}"
+    if not redis_store.try_acquire(lock_key, TELEGRAM_SETUP_LOCK_TTL):
+        logger.info("Бот уже настроен другим процессом")
+        return
+
+    started = time.perf_counter()
+    configured = False
+    try:
+        configured = await asyncio.wait_for(_configure_telegram_once(), TELEGRAM_SETUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Настройка бота не завершилась за {TELEGRAM_SETUP_TIMEOUT} с")
+    finally:
+        startup_timings["telegram_setup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if not configured:
+            redis_store.release(lock_key)
+
+async def _configure_telegram_once() -> bool:
+    commands_ok = await setup_bot_commands()
+    webhook_ok = await setup_webhook()
+    return commands_ok and webhook_ok
+
+# Уведомления доставляет воркер Celery очереди notifications. Фоновый отправитель в веб-сервисе
+# включается явно (например, для локального запуска без Celery), иначе он работал бы в каждом воркере gunicorn
+OUTBOX_SENDER_IN_WEB = os.getenv("OUTBOX_SENDER_IN_WEB", "0").lower() in ("1", "true", "yes")
+# Пауза перед перезапуском отправителя уведомлений после ошибки (секунды)
+OUTBOX_SENDER_RESTART_DELAY = float(os.getenv("OUTBOX_SENDER_RESTART_DELAY", "30"))
+
+async def run_outbox_sender():
+    """
+    Фоновый отправитель уведомлений из outbox (если задано OUTBOX_SENDER_IN_WEB).
+    После ошибки (например, Telegram недоступен) отправитель перезапускается
+    """
+    while True:
+        try:
+            await outbox.run_sender()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Отправитель уведомлений остановился с ошибкой: {str(e)}")
+            await asyncio.sleep(OUTBOX_SENDER_RESTART_DELAY)
 
-# Запускаем настройку вебхука при старте приложения
-@app.on_event("startup")
 async def startup_event():
-    # Настраиваем команды бота
-    await setup_bot_commands()
-    
-    # Настраиваем webhook
-    await setup_webhook()
-    print("Приложение запущено. Используйте ручное тестирование через эндпоинт /telegram/webhook")
+    """Запуск сервиса: только быстрые локальные действия, все запросы к Telegram - в фоне"""
+    global update_dispatcher, telegram_init_task, telegram_setup_task, outbox_sender_task
+    started = time.perf_counter()
     
-    # Инициализируем базу данных
     init_db()
     
-    # Celery теперь управляет всеми фоновыми задачами, поэтому здесь их не запускаем
-    print("Фоновые задачи и обновление данных управляются через Celery")
+    # Запускаем обработчики очереди обновлений
+    update_dispatcher = UpdateDispatcher(process_telegram_update)
+    update_dispatcher.start()
+    resubmit_pending_updates()
+    await ozon_api.open_session()
     
-    # ... (остальной код функции startup_event) ...
+    # Application бота создается один раз на весь процесс
+    telegram_init_task = asyncio.create_task(start_telegram_application())
+    telegram_setup_task = asyncio.create_task(configure_telegram())
+    if OUTBOX_SENDER_IN_WEB:
+        outbox_sender_task = asyncio.create_task(run_outbox_sender())
+    
+    startup_timings["startup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    # Периодические задачи и доставку уведомлений выполняет Celery
+    logger.info("Приложение запущено", extra=startup_timings)
 
-# Удаляем вебхук при завершении работы приложения
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Удаляет вебхук при завершении работы приложения"""
+def resubmit_pending_updates():
+    """Ставит в очередь обновления, которые не успел обработать предыдущий процесс"""
     try:
-        # await bot.delete_webhook()
-        print("Приложение остановлено")
+        pending = update_queue.take_pending_updates()
     except Exception as e:
-        print(f"Ошибка при удалении вебхука: {str(e)}")
+        logger.error(f"Ошибка при загрузке отложенных обновлений: {str(e)}")
+        return
+    
+    if pending:
+        rejected = [update_data for update_data in pending if not update_dispatcher.submit(update_data)]
+        update_queue.save_pending_updates(rejected)
+        logger.info(f"Отложенные обновления поставлены в очередь: {len(pending) - len(rejected)}, возвращено в таблицу: {len(rejected)}")
+
+async def shutdown_event():
+    """
+    Остановка сервиса не дольше SHUTDOWN_TIMEOUT: прием обновлений прекращается, принятые
+    обновления и фоновые обновления /stats дообрабатываются, а то, что не успели начать,
+    сохраняется для следующего процесса. Затем закрываются HTTP-клиенты и подключение к Redis
+    """
+    global shutting_down
+    shutting_down = True
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    
+    if telegram_setup_task is not None and not telegram_setup_task.done():
+        telegram_setup_task.cancel()
+    
+    # Дообрабатываем принятые обновления, пока Application еще работает
+    if update_dispatcher is not None:
+        left = await update_dispatcher.drain(timeout=max(0.0, deadline - time.monotonic()))
+        try:
+            saved = update_queue.save_pending_updates(left)
+            logger.info(f"Очередь обновлений остановлена, сохранено для следующего процесса: {saved}")
+        except Exception as e:
+            logger.error(f"Не удалось сохранить необработанные обновления ({len(left)}): {str(e)}")
+    
+    if stats_refresh_tasks:
+        _, pending = await asyncio.wait(set(stats_refresh_tasks), timeout=max(0.0, deadline - time.monotonic()))
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Не завершено фоновых обновлений /stats: {len(pending)}")
+    
+    if telegram_init_task is not None and not telegram_init_task.done():
+        telegram_init_task.cancel()
+    
+    # Сообщения, взятые отправителем, но не доставленные, возвращаются в очередь
+    if outbox_sender_task is not None and not outbox_sender_task.done():
+        outbox_sender_task.cancel()
+        await asyncio.gather(outbox_sender_task, return_exceptions=True)
+    
+    # Метрики хранятся в памяти процесса, поэтому перед остановкой записываем их в лог
+    logger.info("Итоговые метрики процесса", extra={
+        "update_queue": update_dispatcher.metrics() if update_dispatcher is not None else None,
+        "deduplication": await update_dedup.get_dedup_metrics(),
+        "telegram_api": telegram_client.get_latency_metrics(),
+    })
+    
+    await stop_telegram_application()
+    await telegram_client.close_client()
+    await ozon_api.close_sessions()
+    redis_store.close()
+    await redis_store.close_async()
+    logger.info("Приложение остановлено")
 
 # Задачи, выполняющиеся в фоновом режиме
 async def send_notification(chat_id: str, message: str):
     """Отправляет уведомление в телеграм"""
     try:
-        await bot.send_message(chat_id=chat_id, text=message, parse_mode="HTML")
+        await get_telegram_bot().send_message(chat_id=chat_id, text=message, parse_mode="HTML")
         return True
     except Exception as e:
-        print(f"Ошибка при отправке уведомления: {str(e)}")
+        logger.error(f"Ошибка при отправке уведомления: {str(e)}")
         return False
 
 # Эндпоинты API
@@ -1393,10 +1579,13 @@ async def root():
     return {"status": "ok", "message": "API работает"}
 
 @app.get("/send_report")
-async def send_report(background_tasks: BackgroundTasks):
+async def send_report():
     """Отправляет отчёт в телеграм"""
-    background_tasks.add_task(send_notification, CHAT_ID, "Отчёт готов!")
-    return {"message": "Уведомление отправлено"}
+    if not CHAT_ID:
+        raise HTTPException(status_code=503, detail="TELEGRAM_CHAT_ID не установлен")
+    # Сообщение сохраняется в outbox и не потеряется при перезапуске сервиса
+    outbox.enqueue_messages([{"chat_id": CHAT_ID, "text": "Отчёт готов!", "kind": "report"}])
+    return {"message": "Уведомление поставлено в очередь"}
 
 @app.post("/api/tokens")
 async def save_tokens(tokens: ApiTokens, request: Request):
@@ -1501,6 +1690,11 @@ async def save_product_costs(costs: List[ProductCost], api_key: str = Depends(ap
         if not found:
             users_db[user_hash]["product_costs"].append(cost.dict())
     
+    # Себестоимость влияет на метрики - помечаем данные пользователя как изменившиеся
+    telegram_id = users_db[user_hash].get("telegram_id")
+    if telegram_id:
+        bump_data_version(telegram_id)
+    
     return {"message": "Себестоимость товаров сохранена"}
 
 @app.get("/products/costs")
@@ -1569,227 +1763,10 @@ async def get_analytics(period: str = "month", api_key: Optional[str] = None, te
     
     return mock_analytics
 
-# Функции для работы с API Ozon
-
-async def get_ozon_products(api_token: str, client_id: str):
-    """Получает список товаров из API Ozon"""
-    
-    # Проверка на тестовые токены
-    if (api_token.lower().startswith('test') or api_token.lower().startswith('demo')):
-        # Возвращаем тестовые данные
-        test_products = {
-            "result": {
-                "items": [
-                    {
-                        "product_id": 123456789,
-                        "offer_id": "TEST-001",
-                        "name": "Тестовый товар 1",
-                        "price": "2990",
-                        "stock": 10,
-                        "status": "active"
-                    },
-                    {
-                        "product_id": 987654321,
-                        "offer_id": "TEST-002",
-                        "name": "Тестовый товар 2",
-                        "price": "4500",
-                        "stock": 5,
-                        "status": "active"
-                    },
-                    {
-                        "product_id": 555555555,
-                        "offer_id": "TEST-003",
-                        "name": "Тестовый товар 3",
-                        "price": "1200",
-                        "stock": 0,
-                        "status": "inactive"
-                    }
-                ],
-                "total": 3
-            }
-        }
-        
-        return test_products
-    
-    # Для реальных токенов делаем запрос к API
-    url = "https://api-seller.ozon.ru/v2/product/list"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": api_token,
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "filter": {},
-        "limit": 100,
-        "offset": 0
-    }
-    
-    try:
-        # Используем aiohttp для асинхронного запроса
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    # Получаем тело ответа с ошибкой
-                    error_body = await response.text()
-                    error_detail = f"HTTP {response.status}: {error_body}"
-                    raise HTTPException(status_code=400, detail=f"Ошибка API Ozon: {error_detail}")
-    except Exception as e:
-        # Запасной вариант - синхронный запрос через requests
-        try:
-            response = requests.post(url, json=payload, headers=headers)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                error_detail = f"HTTP {response.status_code}: {response.text}"
-                raise HTTPException(status_code=400, detail=f"Ошибка API Ozon: {error_detail}")
-        except Exception as inner_e:
-            raise HTTPException(status_code=500, detail=f"Ошибка при получении товаров: {str(inner_e)}")
-
-async def get_ozon_analytics(api_token: str, client_id: str, period: str = "month"):
-    """Получает аналитику продаж из API Ozon"""
-    
-    # Для тестовых токенов возвращаем тестовые данные
-    if api_token.lower().startswith('test') or api_token.lower().startswith('demo'):
-        print(f"Используем тестовые данные для аналитики (токен {api_token[:5]}...)")
-        
-        # Возвращаем тестовые данные для демонстрации
-    return {
-            "status": "success",
-            "period": period,
-            "sales": 24500,
-            "margin": 23.5,
-            "roi": 42.8,
-            "profit": 8250,
-            "total_products": 36,
-            "active_products": 28,
-            "orders": 52,
-            "average_order": 3100,
-            "marketplace_fees": 3675,
-            "advertising_costs": 2200,
-            "sales_data": [15000, 18000, 22000, 24500, 20000, 23000, 24500],
-            "margin_data": [18.5, 20.2, 22.8, 24.1, 23.5, 24.0, 23.5],
-            "roi_data": [33.2, 38.5, 41.2, 43.7, 42.1, 42.5, 42.8]
-        }
-    
-    # Настройка периода для запроса
-    current_date = datetime.now()
-    
-    if period == "week":
-        # Последние 7 дней
-        date_from = (current_date - timedelta(days=7)).strftime("%Y-%m-%d")
-    elif period == "month":
-        # Последние 30 дней
-        date_from = (current_date - timedelta(days=30)).strftime("%Y-%m-%d")
-    elif period == "year":
-        # Последний год
-        date_from = (current_date - timedelta(days=365)).strftime("%Y-%m-%d")
-    else:
-        # По умолчанию - последние 30 дней
-        date_from = (current_date - timedelta(days=30)).strftime("%Y-%m-%d")
-    
-    date_to = current_date.strftime("%Y-%m-%d")
-    
-    # Получаем данные о финансах из Ozon API
-    try:
-        financial_data = await get_ozon_financial_data(api_token, client_id, period)
-        
-        # Формируем ответ на основе финансовых данных
-        return {
-            "status": "success",
-            "period": period,
-            "sales": financial_data.get("sales", 0),
-            "margin": financial_data.get("margin", 0),
-            "roi": financial_data.get("roi", 0),
-            "profit": financial_data.get("profit", 0),
-            "total_products": financial_data.get("total_products", 0),
-            "active_products": financial_data.get("active_products", 0),
-            "orders": financial_data.get("orders", 0),
-            "average_order": financial_data.get("average_order", 0),
-            "marketplace_fees": financial_data.get("marketplace_fees", 0),
-            "advertising_costs": financial_data.get("advertising_costs", 0),
-            "sales_data": financial_data.get("sales_data", []),
-            "margin_data": financial_data.get("margin_data", []),
-            "roi_data": financial_data.get("roi_data", [])
-        }
-    except Exception as e:
-        print(f"Ошибка при получении аналитики: {str(e)}")
-        
-        # В случае ошибки возвращаем базовую структуру с сообщением об ошибке
-        return {
-            "error": True,
-            "message": f"Ошибка при получении аналитики: {str(e)}",
-            "period": period,
-            "sales": 0,
-            "margin": 0,
-            "roi": 0,
-            "profit": 0,
-            "total_products": 0,
-            "active_products": 0,
-            "orders": 0,
-            "average_order": 0,
-            "marketplace_fees": 0,
-            "advertising_costs": 0,
-            "sales_data": [],
-            "margin_data": [],
-            "roi_data": []
-        }
-
-async def get_ozon_financial_data(api_token: str, client_id: str, period: str = "month"):
-    """Получает финансовые данные из API Ozon"""
-    try:
-        # Определяем даты для запроса в зависимости от периода
-        end_date = datetime.now()
-        
-        if period == "week":
-            start_date = end_date - timedelta(days=7)
-        elif period == "month":
-            start_date = end_date - timedelta(days=30)
-        elif period == "year":
-            start_date = end_date - timedelta(days=365)
-        else:  # По умолчанию месяц
-            start_date = end_date - timedelta(days=30)
-        
-        # Форматируем даты для API запроса
-        date_from = start_date.strftime("%Y-%m-%d")
-        date_to = end_date.strftime("%Y-%m-%d")
-        
-        # URL для запроса финансовых данных
-        url = "https://api-seller.ozon.ru/v1/finance/treasury/totals"
-        
-        # Заголовки запроса
-        headers = {
-            "Client-Id": client_id,
-            "Api-Key": api_token,
-            "Content-Type": "application/json"
-        }
-        
-        # Тело запроса
-        payload = {
-            "date_from": date_from,
-            "date_to": date_to
-        }
-        
-        # Отправляем запрос
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code != 200:
-            return None, f"Ошибка при получении финансовых данных: {response.status_code} - {response.text}"
-        
-        data = response.json()
-        return data, "Финансовые данные успешно получены"
-    
-    except Exception as e:
-        return None, f"Ошибка при получении финансовых данных: {str(e)}"
-
 # Обновляем API эндпоинты для работы с данными Ozon
 
-@app.get("/api/products")
-async def api_get_products(period: str = "month", telegram_id: Optional[int] = None, api_key: Optional[str] = None):
-    """API для получения списка товаров"""
-    # Получаем токены из API ключа или Telegram ID
+async def resolve_ozon_credentials(telegram_id: Optional[int], api_key: Optional[str]) -> tuple:
+    """Возвращает токены Ozon (api_token, client_id) по API ключу или Telegram ID"""
     if api_key:
         # Используем API ключ
         if api_key not in users_db_reverse:
@@ -1816,12 +1793,103 @@ async def api_get_products(period: str = "month", telegram_id: Optional[int] = N
     else:
         raise HTTPException(status_code=400, detail="Необходимо указать telegram_id или api_key")
     
+    return api_token, client_id
+
+def api_key_telegram_id(api_key: str) -> Optional[int]:
+    """Telegram ID владельца API ключа (есть у ключей, выданных Mini App пользователю бота)"""
+    user_hash = users_db_reverse.get(api_key)
+    return users_db[user_hash].get("telegram_id") if user_hash else None
+
+def api_key_fingerprint(api_key: str) -> str:
+    """Короткий хеш API ключа для ETag и ключей расчетов: себестоимость хранится отдельно для каждого ключа"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+def data_etag(resource: str, period: str, telegram_id: Optional[int], api_key: Optional[str], api_token: str) -> Optional[str]:
+    """
+    ETag ответа с данными Ozon. Для пользователей Telegram (в том числе по их API ключу) он зависит
+    от версии и хеша их данных, тестовые данные не меняются. Для ключей, не связанных
+    с пользователем Telegram, версии данных нет, и ETag не вычисляется
+    """
+    if not api_key:
+        return http_cache.user_etag(resource, telegram_id, period=period)
+    if api_token == "test_token":
+        return http_cache.make_etag(resource, "test", period)
+    
+    owner_id = api_key_telegram_id(api_key)
+    if owner_id is None:
+        return None
+    # Себестоимость хранится отдельно для каждого ключа, поэтому ETag зависит и от ключа
+    return http_cache.user_etag(resource, owner_id, period=period, key=api_key_fingerprint(api_key))
+
+@app.get("/api/dashboard")
+async def api_get_dashboard(request: Request, response: Response, period: str = "month", telegram_id: Optional[int] = None, api_key: Optional[str] = Depends(get_optional_api_key), page_size: int = 50, fields: Optional[str] = None, view: Optional[str] = None):
+    """
+    Данные главного экрана за один запрос: сводка, первая страница товаров,
+    самый прибыльный товар и ABC-статистика (см. services.build_dashboard).
+    fields/view задают поля товаров в списке (см. projections.py)
+    """
+    selected = projections.parse_fields(fields, view, projections.PRODUCT_VIEWS)
+    api_token, client_id = await resolve_ozon_credentials(telegram_id, api_key)
+    page_size = max(1, min(page_size, 500))
+    
+    resource = f"dashboard:{page_size}:{projections.describe(selected)}"
+    not_modified = http_cache.conditional_response(request, response, data_etag(resource, period, telegram_id, api_key, api_token))
+    if not_modified:
+        return not_modified
+    
+    # Себестоимость хранится только для API ключей (см. /products/costs)
+    costs = {}
+    if api_key:
+        costs_data = await get_product_costs(api_key=api_key)
+        costs = {item["offer_id"]: item["cost"] for item in costs_data.get("items", [])}
+    
+    # Одновременные запросы главного экрана одного пользователя (например, с двух устройств) считаются один раз.
+    # Себестоимость зависит от API ключа, поэтому он входит в ключ расчета
+    owner = f"{telegram_id or ''}:key:{api_key_fingerprint(api_key) if api_key else ''}"
+    data_owner = telegram_id or api_key_telegram_id(api_key)
+    version = get_data_version(data_owner) if data_owner else 0
+    
+    # Сводка за период берется из снимка, сохраненного при обновлении данных, без запроса к Ozon
+    snapshot = get_snapshot(data_owner, f"analytics_{period}") if data_owner else None
+    summary = snapshot["payload"] if snapshot else None
+    
+    try:
+        dashboard = await singleflight.run(
+            f"dashboard:{owner}:{period}:{page_size}:v{version}",
+            lambda: services.build_dashboard(api_token, client_id, period, costs, page_size, summary),
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при подготовке данных главного экрана: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении данных: {str(e)}")
+    
+    dashboard["products"]["items"] = projections.project(dashboard["products"]["items"], selected)
+    return fast_json.json_response(dashboard, response)
+
+@app.get("/api/products")
+async def api_get_products(request: Request, response: Response, period: str = "month", telegram_id: Optional[int] = None, api_key: Optional[str] = Depends(get_optional_api_key), fields: Optional[str] = None, view: Optional[str] = None):
+    """API для получения списка товаров (fields/view - выбор полей, см. projections.py)"""
+    selected = projections.parse_fields(fields, view, projections.PRODUCT_VIEWS)
+    api_token, client_id = await resolve_ozon_credentials(telegram_id, api_key)
+    
+    # Если данные пользователя не менялись, клиент получает 304 без запросов к Ozon
+    resource = f"products:{projections.describe(selected)}"
+    not_modified = http_cache.conditional_response(request, response, data_etag(resource, period, telegram_id, api_key, api_token))
+    if not_modified:
+        return not_modified
+    
     try:
         # Получаем список товаров с помощью API Ozon
         products_data = await get_ozon_products(api_token, client_id)
         
+        # Если себестоимость и маржинальность не запрошены, сохраненная себестоимость не читается
+        need_costs = selected is None or bool({"cost", "margin_percent"} & set(selected))
+        
         # Для тестовых данных не запрашиваем себестоимость, возвращаем фиктивные данные
-        if api_token.lower().startswith('test') or api_token.lower().startswith('demo') or api_key.lower().startswith('test') or api_key.lower().startswith('demo'):
+        if not need_costs:
+            costs_mapping = {}
+        elif api_token.lower().startswith('test') or api_token.lower().startswith('demo') or api_key.lower().startswith('test') or api_key.lower().startswith('demo'):
             # Создаем тестовые данные о себестоимости
             costs_mapping = {
                 "TEST-001": {"cost": 1500.0},
@@ -1839,7 +1907,7 @@ async def api_get_products(period: str = "month", telegram_id: Optional[int] = N
                         'cost': cost['cost']
                     }
             except Exception as e:
-                print(f"Ошибка при получении себестоимости: {str(e)}")
+                logger.error(f"Ошибка при получении себестоимости: {str(e)}")
                 costs_mapping = {}  # Если не удалось получить себестоимость, используем пустой словарь
             
         # Проходим по списку товаров и добавляем дополнительные данные
@@ -1867,61 +1935,41 @@ async def api_get_products(period: str = "month", telegram_id: Optional[int] = N
                     item['cost'] = 0
                     item['margin_percent'] = 0
                 
-                result_items.append(item)
-                
-        return {
-            "items": result_items,
-            "total": total,
-            "status": "success"
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка при получении товаров: {str(e)}")
-
-@app.get("/api/analytics")
-async def api_get_analytics(period: str = "month", telegram_id: Optional[int] = None, api_key: Optional[str] = None):
-    """API для получения аналитики"""
-    # Получаем токены из API ключа или Telegram ID
-    if api_key:
-        # Используем API ключ
-        if api_key not in users_db_reverse:
-            # Если это тестовый API ключ
-            if api_key.lower().startswith('test') or api_key.lower().startswith('demo'):
-                api_token = "test_token"
-                client_id = "test_client_id"
-            else:
-                raise HTTPException(status_code=401, detail="Недействительный API ключ")
-        else:
-            user_info = users_db[users_db_reverse[api_key]]
-            tokens = decrypt_tokens(user_info['tokens'])
-            
-            api_token = tokens['ozon_api_token']
-            client_id = tokens['ozon_client_id']
-    elif telegram_id:
-        # Используем Telegram ID
-        user_token = await get_user_tokens(telegram_id)
-        if not user_token:
-            raise HTTPException(status_code=404, detail="Пользователь не найден или не установлены API токены")
-        
-        api_token = user_token.ozon_api_token
-        client_id = user_token.ozon_client_id
-    else:
-        raise HTTPException(status_code=400, detail="Необходимо указать telegram_id или api_key")
+                result_items.append(item)
+                
+        return fast_json.json_response({
+            "items": projections.project(result_items, selected),
+            "total": total,
+            "status": "success"
+        }, response)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка при получении товаров: {str(e)}")
+
+@app.get("/api/analytics")
+async def api_get_analytics(request: Request, response: Response, period: str = "month", telegram_id: Optional[int] = None, api_key: Optional[str] = Depends(get_optional_api_key)):
+    """API для получения аналитики"""
+    api_token, client_id = await resolve_ozon_credentials(telegram_id, api_key)
+    
+    # Если данные пользователя не менялись, клиент получает 304 без запросов к Ozon
+    not_modified = http_cache.conditional_response(request, response, data_etag("analytics", period, telegram_id, api_key, api_token))
+    if not_modified:
+        return not_modified
     
     try:
         # Получаем аналитику с помощью API Ozon
         analytics_data = await get_ozon_analytics(api_token, client_id, period)
         
         # Функция уже возвращает готовый результат
-        return analytics_data
+        return fast_json.json_response(analytics_data, response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при получении аналитики: {str(e)}")
 
 # Получение настроек уведомлений пользователя
 async def get_notification_settings(telegram_id: int) -> Optional[NotificationSettings]:
     with get_db() as conn:
-        cursor = conn.cursor()
+        cursor = PortableCursor(conn)
         cursor.execute('''
             SELECT telegram_id, margin_threshold, roi_threshold, daily_report, sales_alert, returns_alert
             FROM notification_settings
@@ -1947,11 +1995,18 @@ async def get_notification_settings(telegram_id: int) -> Optional[NotificationSe
 # Сохранение настроек уведомлений пользователя
 async def save_notification_settings(settings: NotificationSettings) -> bool:
     with get_db() as conn:
-        cursor = conn.cursor()
+        cursor = PortableCursor(conn)
         cursor.execute('''
-            INSERT OR REPLACE INTO notification_settings
-            (telegram_id, margin_threshold, roi_threshold, daily_report, sales_alert, returns_alert, last_updated)
-            VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
+            INSERT INTO notification_settings
+            (telegram_id, margin_threshold, roi_threshold, daily_report, sales_alert, returns_alert, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (telegram_id) DO UPDATE SET
+                margin_threshold = excluded.margin_threshold,
+                roi_threshold = excluded.roi_threshold,
+                daily_report = excluded.daily_report,
+                sales_alert = excluded.sales_alert,
+                returns_alert = excluded.returns_alert,
+                updated_at = excluded.updated_at
         ''', (
             settings.telegram_id,
             settings.margin_threshold,
@@ -1994,342 +2049,146 @@ async def update_notification_settings(settings: NotificationSettings, api_key:
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка при обновлении настроек: {str(e)}")
 
+async def compute_product_analytics(telegram_id: int, api_key: str, period: str) -> list:
+    """Расширенная аналитика по товарам пользователя: продажи, себестоимость, комиссии, реклама и возвраты"""
+    user_token = await get_user_tokens(telegram_id)
+    if not user_token:
+        raise HTTPException(status_code=404, detail="Токены Ozon не найдены")
+        
+    # Получаем продукты
+    products = services.product_items(await get_ozon_products(user_token.ozon_api_token, user_token.ozon_client_id))
+    
+    # Получаем себестоимость (хранится по offer_id, как и на главном экране)
+    costs = await get_product_costs(api_key)
+    cost_map = {item["offer_id"]: float(item["cost"]) for item in costs.get("items", [])}
+    
+    # Получаем данные по продажам
+    analytics = await get_ozon_analytics(user_token.ozon_api_token, user_token.ozon_client_id, period)
+    
+    # Получаем финансовые данные
+    financials = await get_ozon_financial_data(user_token.ozon_api_token, user_token.ozon_client_id, period)
+    
+    # Получаем данные по рекламе
+    ad_data = await get_ozon_advertising_costs(user_token.ozon_api_token, user_token.ozon_client_id, period)
+    ad_costs_map = {}  # Затраты на рекламу по продуктам
+    
+    # Получаем данные по возвратам
+    returns_data = await get_ozon_returns_data(user_token.ozon_api_token, user_token.ozon_client_id, period)
+    returns_map = {}  # Стоимость возвратов по продуктам
+    
+    # Распределение затрат на рекламу равномерно по всем продуктам, 
+    # в реальности требуется более сложная логика в зависимости от данных Ozon API
+    total_products = len(products)
+    if total_products > 0:
+        ad_cost_per_product = ad_data.get("total_cost", 0) / total_products
+        
+        for product in products:
+            product_id = product.get("product_id")
+            ad_costs_map[product_id] = ad_cost_per_product
+    
+    # Формируем расширенную аналитику по продуктам
+    product_analytics = []
+    
+    for product in products:
+        product_id = product.get("product_id")
+        offer_id = product.get("offer_id")
+        name = product.get("name")
+        
+        # Данные по продажам
+        sales_count, revenue = services.product_sales(analytics, product_id)
+        
+        # Себестоимость
+        cost = cost_map.get(offer_id, 0)
+        
+        # Комиссии (финансовый отчет Ozon может не содержать разбивки по товарам)
+        commission = 0
+        for item in (financials if isinstance(financials, list) else []):
+            if item.get("product_id") == product_id:
+                commission += item.get("commission", 0)
+        
+        # Затраты на рекламу для продукта
+        ad_cost = ad_costs_map.get(product_id, 0)
+        
+        # Затраты на возвраты для продукта
+        return_cost = returns_map.get(product_id, 0)
+        
+        # Прибыль и рентабельность с учётом всех затрат (тот же расчет, что и на главном экране)
+        profit = services.product_profit(revenue, sales_count, cost, commission, ad_cost, return_cost)
+        
+        # Формируем аналитику по продукту
+        product_analytics.append({
+            "product_id": product_id,
+            "offer_id": offer_id,
+            "name": name,
+            "image": product.get("images", [""])[0] if product.get("images") else "",
+            "sales_count": sales_count,
+            "revenue": revenue,
+            "cost": cost,
+            "total_cost": profit["total_cost"],
+            "commission": commission,
+            "ad_cost": ad_cost,
+            "return_cost": return_cost,
+            "profit": profit["profit"],
+            "margin": profit["margin"],
+            "roi": profit["roi"]
+        })
+    
+    return product_analytics
+
 # Расширенная аналитика для продуктов
 @app.get("/api/analytics/products")
-async def get_product_analytics(period: str = "month", api_key: str = Depends(api_key_header)):
+async def get_product_analytics(period: str = "month", api_key: str = Depends(api_key_header), request: Request = None, response: Response = None, fields: Optional[str] = None, view: Optional[str] = None):
+    # Внутренние вызовы (ABC-анализ, товар дня) всегда получают все поля
+    selected = projections.parse_fields(fields, view, projections.PRODUCT_ANALYTICS_VIEWS, projections.PRODUCT_ANALYTICS_FIELDS)
     try:
         tokens = await get_api_tokens(api_key)
         telegram_id = tokens.get("telegram_id")
         if not telegram_id:
             raise HTTPException(status_code=401, detail="Недействительный API ключ")
-            
-        user_token = await get_user_tokens(telegram_id)
-        if not user_token:
-            raise HTTPException(status_code=404, detail="Токены Ozon не найдены")
-            
-        # Получаем продукты
-        products = await get_ozon_products(user_token.ozon_api_token, user_token.ozon_client_id)
-        
-        # Получаем себестоимость
-        costs = await get_product_costs(api_key)
-        cost_map = {cost.product_id: cost.cost for cost in costs}
-        
-        # Получаем данные по продажам
-        analytics = await get_ozon_analytics(user_token.ozon_api_token, user_token.ozon_client_id, period)
         
-        # Получаем финансовые данные
-        financials = await get_ozon_financial_data(user_token.ozon_api_token, user_token.ozon_client_id, period)
-        
-        # Получаем данные по рекламе
-        ad_data = await get_ozon_advertising_costs(user_token.ozon_api_token, user_token.ozon_client_id, period)
-        ad_costs_map = {}  # Затраты на рекламу по продуктам
-        
-        # Получаем данные по возвратам
-        returns_data = await get_ozon_returns_data(user_token.ozon_api_token, user_token.ozon_client_id, period)
-        returns_map = {}  # Стоимость возвратов по продуктам
-        
-        # Распределение затрат на рекламу равномерно по всем продуктам, 
-        # в реальности требуется более сложная логика в зависимости от данных Ozon API
-        total_products = len(products)
-        if total_products > 0:
-            ad_cost_per_product = ad_data.get("total_cost", 0) / total_products
-            
-            for product in products:
-                product_id = product.get("product_id")
-                ad_costs_map[product_id] = ad_cost_per_product
-        
-        # Формируем расширенную аналитику по продуктам
-        product_analytics = []
-        
-        for product in products:
-            product_id = product.get("product_id")
-            offer_id = product.get("offer_id")
-            name = product.get("name")
+        # При вызове из других функций (например, ABC-анализа) request не передается
+        if request is not None:
+            etag = http_cache.user_etag("product_analytics", telegram_id, period=period, key=api_key_fingerprint(api_key), fields=projections.describe(selected))
+            not_modified = http_cache.conditional_response(request, response, etag)
+            if not_modified:
+                return not_modified
             
-            # Данные по продажам
-            sales_data = next((item for item in analytics if item.get("product_id") == product_id), None)
-            sales_count = sales_data.get("sales_count", 0) if sales_data else 0
-            revenue = sales_data.get("revenue", 0) if sales_data else 0
-            
-            # Себестоимость
-            cost = cost_map.get(product_id, 0)
-            
-            # Комиссии
-            commission = 0
-            for item in financials:
-                if item.get("product_id") == product_id:
-                    commission += item.get("commission", 0)
-            
-            # Затраты на рекламу для продукта
-            ad_cost = ad_costs_map.get(product_id, 0)
-            
-            # Затраты на возвраты для продукта
-            return_cost = returns_map.get(product_id, 0)
-            
-            # Прибыль и рентабельность с учётом всех затрат
-            total_costs = (cost * sales_count) + commission + ad_cost + return_cost
-            profit = revenue - total_costs
-            margin = (profit / revenue * 100) if revenue > 0 else 0
-            roi = (profit / total_costs * 100) if total_costs > 0 else 0
-            
-            # Формируем аналитику по продукту
-            product_analytics.append({
-                "product_id": product_id,
-                "offer_id": offer_id,
-                "name": name,
-                "image": product.get("images", [""])[0] if product.get("images") else "",
-                "sales_count": sales_count,
-                "revenue": revenue,
-                "cost": cost,
-                "total_cost": cost * sales_count,
-                "commission": commission,
-                "ad_cost": ad_cost,
-                "return_cost": return_cost,
-                "profit": profit,
-                "margin": margin,
-                "roi": roi
-            })
+        # Одновременные запросы аналитики одного пользователя за тот же период считаются один раз.
+        # Себестоимость хранится для каждого API ключа, поэтому ключи пользователя считаются отдельно
+        product_analytics = await singleflight.run(
+            f"product_analytics:{telegram_id}:{api_key_fingerprint(api_key)}:{period}:v{get_data_version(telegram_id)}",
+            lambda: compute_product_analytics(telegram_id, api_key, period),
+        )
         
+        # Эндпоинт отдает список сразу через orjson, внутренние вызовы получают сам список
+        if request is not None:
+            return fast_json.json_response(projections.project(product_analytics, selected), response)
         return product_analytics
     except Exception as e:
-        print(f"Ошибка при получении аналитики по продуктам: {str(e)}")
+        logger.error(f"Ошибка при получении аналитики по продуктам: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Ошибка при получении аналитики по продуктам: {str(e)}")
 
-# Функция для отправки ежедневных отчетов пользователям
-async def send_daily_reports(background_tasks: BackgroundTasks):
-    try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT n.telegram_id 
-                FROM notification_settings n
-                JOIN user_tokens u ON n.telegram_id = u.telegram_id
-                WHERE n.daily_report = 1
-            ''')
-            
-            users = cursor.fetchall()
-            
-        for user in users:
-            telegram_id = user[0]
-            try:
-                # Получаем данные аналитики
-                analytics_data = await api_get_analytics(period="day", telegram_id=telegram_id)
-                
-                if not analytics_data:
-                    continue
-                
-                # Форматируем отчет
-                total_revenue = analytics_data.get("revenue", 0)
-                total_profit = analytics_data.get("profit", 0)
-                margin = analytics_data.get("margin", 0)
-                roi = analytics_data.get("roi", 0)
-                
-                report_message = (
-                    f"📊 *Ежедневный отчет*\n\n"
-                    f"Выручка: {total_revenue:.2f} ₽\n"
-                    f"Прибыль: {total_profit:.2f} ₽\n"
-                    f"Маржинальность: {margin:.2f}%\n"
-                    f"ROI: {roi:.2f}%\n\n"
-                    f"Для более подробной информации откройте приложение."
-                )
-                
-                # Отправляем уведомление
-                background_tasks.add_task(send_notification, telegram_id, report_message)
-                
-            except Exception as e:
-                print(f"Ошибка при отправке отчета пользователю {telegram_id}: {str(e)}")
-                continue
-                
-    except Exception as e:
-        print(f"Ошибка при отправке ежедневных отчетов: {str(e)}")
-
-# Функция для проверки показателей и отправки уведомлений
-async def check_metrics_and_notify(background_tasks: BackgroundTasks):
+# Функция для отправки ежедневных отчетов пользователям (подготовленные ночью отчеты ставятся в очередь outbox)
+async def send_daily_reports():
     try:
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT n.telegram_id, n.margin_threshold, n.roi_threshold 
-                FROM notification_settings n
-                JOIN user_tokens u ON n.telegram_id = u.telegram_id
-            ''')
-            
-            users = cursor.fetchall()
-            
-        for user in users:
-            telegram_id, margin_threshold, roi_threshold = user
-            
-            try:
-                # Получаем данные пользователя
-                user_token = await get_user_tokens(telegram_id)
-                if not user_token:
-                    continue
-                
-                # Получаем продукты
-                products = await get_ozon_products(user_token.ozon_api_token, user_token.ozon_client_id)
-                
-                # Получаем себестоимость
-                with get_db() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        SELECT product_id, cost FROM product_costs
-                        WHERE telegram_id = ?
-                    ''', (telegram_id,))
-                    
-                    costs = cursor.fetchall()
-                    cost_map = {row[0]: row[1] for row in costs}
-                
-                # Получаем данные по продажам
-                analytics = await get_ozon_analytics(user_token.ozon_api_token, user_token.ozon_client_id, "day")
-                
-                # Получаем финансовые данные
-                financials = await get_ozon_financial_data(user_token.ozon_api_token, user_token.ozon_client_id, "day")
-                
-                # Формируем аналитику по продуктам
-                product_analytics = []
-                
-                for product in products:
-                    product_id = product.get("product_id")
-                    name = product.get("name")
-                    
-                    # Данные по продажам
-                    sales_data = next((item for item in analytics if item.get("product_id") == product_id), None)
-                    sales_count = sales_data.get("sales_count", 0) if sales_data else 0
-                    revenue = sales_data.get("revenue", 0) if sales_data else 0
-                    
-                    # Себестоимость
-                    cost = cost_map.get(product_id, 0)
-                    
-                    # Комиссии
-                    commission = 0
-                    for item in financials:
-                        if item.get("product_id") == product_id:
-                            commission += item.get("commission", 0)
-                    
-                    # Прибыль и рентабельность
-                    profit = revenue - (cost * sales_count) - commission
-                    margin = (profit / revenue * 100) if revenue > 0 else 0
-                    roi = (profit / (cost * sales_count) * 100) if cost * sales_count > 0 else 0
-                    
-                    product_analytics.append({
-                        "product_id": product_id,
-                        "name": name,
-                        "sales_count": sales_count,
-                        "margin": margin,
-                        "roi": roi
-                    })
-                
-                # Проверяем, есть ли товары с показателями ниже порога
-                low_margin_products = [
-                    p for p in product_analytics 
-                    if p.get("sales_count", 0) > 0 and p.get("margin", 0) < margin_threshold
-                ]
-                
-                low_roi_products = [
-                    p for p in product_analytics 
-                    if p.get("sales_count", 0) > 0 and p.get("roi", 0) < roi_threshold
-                ]
-                
-                # Отправляем уведомления о низкой маржинальности
-                if low_margin_products:
-                    products_list = "\n".join([
-                        f"• {p.get('name')} - {p.get('margin', 0):.2f}%"
-                        for p in low_margin_products[:5]  # Ограничиваем список 5 товарами
-                    ])
-                    
-                    margin_message = (
-                        f"⚠️ *Внимание: Низкая маржинальность*\n\n"
-                        f"У следующих товаров маржинальность ниже порога ({margin_threshold}%):\n\n"
-                        f"{products_list}\n"
-                    )
-                    
-                    if len(low_margin_products) > 5:
-                        margin_message += f"\nИ еще {len(low_margin_products) - 5} товаров...\n"
-                        
-                    margin_message += "\nПроверьте себестоимость этих товаров в приложении."
-                    
-                    background_tasks.add_task(send_notification, telegram_id, margin_message)
-                
-                # Отправляем уведомления о низком ROI
-                if low_roi_products:
-                    products_list = "\n".join([
-                        f"• {p.get('name')} - {p.get('roi', 0):.2f}%"
-                        for p in low_roi_products[:5]  # Ограничиваем список 5 товарами
-                    ])
-                    
-                    roi_message = (
-                        f"⚠️ *Внимание: Низкий ROI*\n\n"
-                        f"У следующих товаров ROI ниже порога ({roi_threshold}%):\n\n"
-                        f"{products_list}\n"
-                    )
-                    
-                    if len(low_roi_products) > 5:
-                        roi_message += f"\nИ еще {len(low_roi_products) - 5} товаров...\n"
-                        
-                    roi_message += "\nПроверьте себестоимость этих товаров в приложении."
-                    
-                    background_tasks.add_task(send_notification, telegram_id, roi_message)
-                
-            except Exception as e:
-                print(f"Ошибка при проверке метрик для пользователя {telegram_id}: {str(e)}")
-                continue
-    
+        return await services.send_daily_reports()
     except Exception as e:
-        print(f"Ошибка при проверке метрик и отправке уведомлений: {str(e)}")
-
-# Функция для проведения ABC-анализа товаров
-async def perform_abc_analysis(products_data: list) -> list:
-    """
-    Классифицирует товары по их вкладу в прибыль:
-    A - топ 20% товаров (высокий вклад в прибыль)
-    B - средние 30% товаров
-    C - остальные 50% товаров
-    """
-    if not products_data:
-        return []
-    
-    # Сортируем товары по прибыли в порядке убывания
-    sorted_products = sorted(products_data, key=lambda x: x.get('profit', 0), reverse=True)
-    
-    # Считаем общую прибыль
-    total_profit = sum(p.get('profit', 0) for p in sorted_products)
-    
-    # Если общая прибыль нулевая, всё в категории C
-    if total_profit <= 0:
-        for product in sorted_products:
-            product['abc_category'] = 'C'
-            product['profit_percent'] = 0
-        return sorted_products
-    
-    cumulative_profit = 0
-    cumulative_percent = 0
-    
-    # Проходим по всем товарам и присваиваем категории
-    for product in sorted_products:
-        profit = product.get('profit', 0)
-        profit_percent = (profit / total_profit) * 100 if total_profit > 0 else 0
-        cumulative_profit += profit
-        cumulative_percent = (cumulative_profit / total_profit) * 100 if total_profit > 0 else 0
-        
-        # Присваиваем категорию ABC
-        if cumulative_percent <= 20:
-            category = 'A'
-        elif cumulative_percent <= 50:
-            category = 'B'
-        else:
-            category = 'C'
-        
-        # Добавляем информацию в объект товара
-        product['abc_category'] = category
-        product['profit_percent'] = profit_percent
-        product['cumulative_percent'] = cumulative_percent
-    
-    return sorted_products
+        logger.error(f"Ошибка при отправке ежедневных отчетов: {str(e)}")
 
 # Расширяем функцию аналитики продуктов, добавляя ABC-анализ
 @app.get("/api/analytics/abc")
-async def get_abc_analysis(period: str = "month", api_key: str = Depends(api_key_header)):
+async def get_abc_analysis(request: Request, response: Response, period: str = "month", api_key: str = Depends(api_key_header), fields: Optional[str] = None, view: Optional[str] = None):
+    # fields/view задают поля товаров в группах A, B и C (см. projections.py)
+    selected = projections.parse_fields(fields, view, projections.PRODUCT_ANALYTICS_VIEWS, projections.PRODUCT_ANALYTICS_FIELDS)
     try:
+        tokens = await get_api_tokens(api_key)
+        telegram_id = tokens.get("telegram_id")
+        if telegram_id:
+            etag = http_cache.user_etag("abc", telegram_id, period=period, key=api_key_fingerprint(api_key), fields=projections.describe(selected))
+            not_modified = http_cache.conditional_response(request, response, etag)
+            if not_modified:
+                return not_modified
+        
         # Получаем аналитику по продуктам
         product_analytics = await get_product_analytics(period=period, api_key=api_key)
         
@@ -2338,9 +2197,9 @@ async def get_abc_analysis(period: str = "month", api_key: str = Depends(api_key
         
         # Группируем результаты по категориям
         result = {
-            "A": [p for p in abc_analysis if p.get('abc_category') == 'A'],
-            "B": [p for p in abc_analysis if p.get('abc_category') == 'B'],
-            "C": [p for p in abc_analysis if p.get('abc_category') == 'C'],
+            "A": projections.project([p for p in abc_analysis if p.get('abc_category') == 'A'], selected),
+            "B": projections.project([p for p in abc_analysis if p.get('abc_category') == 'B'], selected),
+            "C": projections.project([p for p in abc_analysis if p.get('abc_category') == 'C'], selected),
             "total_products": len(abc_analysis),
             "total_profit": sum(p.get('profit', 0) for p in abc_analysis),
             "category_stats": {
@@ -2365,7 +2224,7 @@ async def get_abc_analysis(period: str = "month", api_key: str = Depends(api_key
             }
         }
         
-        return result
+        return fast_json.json_response(result, response)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка при проведении ABC-анализа: {str(e)}")
 
@@ -2440,62 +2299,9 @@ async def update_user_data(user_id: int, token_data: dict = Body(...)):
             }
         }
     except Exception as e:
-        print(f"Ошибка при обновлении данных: {str(e)}")
+        logger.error(f"Ошибка при обновлении данных: {str(e)}")
         return {"success": False, "error": f"Ошибка при обновлении данных: {str(e)}"}
 
-async def update_top_product(user_id: int):
-    """Обновляет информацию о 'Товаре дня' - самом прибыльном товаре пользователя"""
-    try:
-        conn = sqlite3.connect("ozon.db")
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Получаем товар с наибольшей прибылью за последние 30 дней
-        cursor.execute("""
-            SELECT 
-                p.id, p.name, p.offer_id, p.product_id, p.image_url, p.price, p.commission_amount,
-                p.category, p.cost, COUNT(DISTINCT t.id) as sales_count,
-                SUM(t.price) as total_sales,
-                SUM(t.commission_amount) as total_commission,
-                SUM(p.cost) as total_cost,
-                (SUM(t.price) - SUM(t.commission_amount) - (COUNT(DISTINCT t.id) * p.cost)) as profit,
-                ((SUM(t.price) - SUM(t.commission_amount) - (COUNT(DISTINCT t.id) * p.cost)) / SUM(t.price) * 100) as profit_percent,
-                ((SUM(t.price) - SUM(t.commission_amount) - (COUNT(DISTINCT t.id) * p.cost)) / (COUNT(DISTINCT t.id) * p.cost) * 100) as roi
-            FROM products p
-            JOIN transactions t ON p.product_id = t.product_id AND p.user_id = t.user_id
-            WHERE p.user_id = ? AND t.transaction_date >= date('now', '-30 day')
-            GROUP BY p.id
-            ORDER BY profit DESC
-            LIMIT 1
-        """, (user_id,))
-        
-        top_product = cursor.fetchone()
-        
-        if top_product:
-            # Преобразуем строку в словарь
-            top_product_dict = dict(top_product)
-            
-            # Сохраняем информацию о "Товаре дня" в отдельную таблицу
-            cursor.execute("""
-                INSERT OR REPLACE INTO top_product (
-                    user_id, product_id, offer_id, name, image_url, price, 
-                    sales_count, total_sales, profit, profit_percent, roi, updated_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
-            """, (
-                user_id, top_product_dict["product_id"], top_product_dict["offer_id"],
-                top_product_dict["name"], top_product_dict["image_url"], top_product_dict["price"],
-                top_product_dict["sales_count"], top_product_dict["total_sales"],
-                top_product_dict["profit"], top_product_dict["profit_percent"], top_product_dict["roi"]
-            ))
-            
-            conn.commit()
-        
-        conn.close()
-        return True
-    except Exception as e:
-        print(f"Ошибка при обновлении 'Товара дня': {str(e)}")
-        return False
-
 async def initialize_database():
     """Инициализирует базу данных - создает необходимые таблицы, если они не существуют"""
     try:
@@ -2619,10 +2425,10 @@ async def initialize_database():
         
         conn.commit()
         conn.close()
-        print("База данных инициализирована")
+        logger.info("База данных инициализирована")
         return True
     except Exception as e:
-        print(f"Ошибка при инициализации базы данных: {str(e)}")
+        logger.error(f"Ошибка при инициализации базы данных: {str(e)}")
         return False
 
 @app.get("/api/analytics/top_product")
@@ -2653,7 +2459,7 @@ async def get_top_product(user_id: int):
                 "error": "Товар дня не найден. Возможно, у вас еще нет продаж или данные не обновлены."
             }
     except Exception as e:
-        print(f"Ошибка при получении 'Товара дня': {str(e)}")
+        logger.error(f"Ошибка при получении 'Товара дня': {str(e)}")
         return {"success": False, "error": f"Ошибка при получении данных: {str(e)}"}
 
 @app.get("/api/analytics/top_product_by_user")
@@ -2684,7 +2490,7 @@ async def get_top_product_by_user(user_id: int):
                 "error": "Товар дня не найден. Возможно, у вас еще нет продаж или данные не обновлены."
             }
     except Exception as e:
-        print(f"Ошибка при получении 'Товара дня': {str(e)}")
+        logger.error(f"Ошибка при получении 'Товара дня': {str(e)}")
         return {"success": False, "error": f"Ошибка при получении данных: {str(e)}"}
 
 # API-эндпоинт для получения самого прибыльного товара (для виджета "Товар дня")
@@ -2717,425 +2523,140 @@ async def get_top_product_by_analytics(period: str = "month", api_key: str = Dep
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка при получении топового товара: {str(e)}")
 
-# Новые функции для получения данных о рекламе и возвратах
-async def get_ozon_advertising_costs(api_token: str, client_id: str, period: str = "month"):
-    """Получает данные о рекламных расходах из API Ozon"""
+# Новые API-эндпоинты для работы с Celery
+@app.post("/api/update_all_data")
+async def api_update_all_data():
+    """API-эндпоинт для обновления данных всех пользователей за один запрос (ручной запуск)"""
     try:
-        # Определяем даты для запроса в зависимости от периода
-        end_date = datetime.now()
-        
-        if period == "week":
-            start_date = end_date - timedelta(days=7)
-        elif period == "month":
-            start_date = end_date - timedelta(days=30)
-        elif period == "year":
-            start_date = end_date - timedelta(days=365)
-        else:  # По умолчанию месяц
-            start_date = end_date - timedelta(days=30)
-        
-        # Форматируем даты для API запроса
-        date_from = start_date.strftime("%Y-%m-%d")
-        date_to = end_date.strftime("%Y-%m-%d")
-        
-        # URL для запроса данных по рекламе
-        url = "https://api-seller.ozon.ru/v1/finance/campaign"
-        
-        # Заголовки запроса
-        headers = {
-            "Client-Id": client_id,
-            "Api-Key": api_token,
-            "Content-Type": "application/json"
-        }
-        
-        # Тело запроса
-        payload = {
-            "date_from": date_from,
-            "date_to": date_to,
-            "pagination": {
-                "limit": 1000,
-                "offset": 0
-            }
-        }
-        
-        # Отправляем запрос
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code != 200:
-            print(f"Ошибка при получении данных по рекламе: {response.status_code} - {response.text}")
-            return {"total_cost": 0, "campaigns": []}
-        
-        data = response.json()
-        
-        # Считаем общие расходы на рекламу
-        total_cost = 0
-        campaigns = []
-        
-        if "result" in data and "campaigns" in data["result"]:
-            for campaign in data["result"]["campaigns"]:
-                cost = campaign.get("cost", 0)
-                total_cost += cost
-                campaigns.append({
-                    "campaign_id": campaign.get("campaign_id", ""),
-                    "name": campaign.get("name", ""),
-                    "cost": cost
-                })
-        
-        return {"total_cost": total_cost, "campaigns": campaigns}
-    
+        return await services.refresh_all_users()
     except Exception as e:
-        print(f"Ошибка при получении данных по рекламе: {str(e)}")
-        return {"total_cost": 0, "campaigns": []}
+        logger.error(f"Общая ошибка при обновлении данных: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при обновлении данных: {str(e)}")
 
-async def get_ozon_returns_data(api_token: str, client_id: str, period: str = "month"):
-    """Получает данные о возвратах из API Ozon"""
+@app.post("/api/update_all_data/{telegram_id}")
+async def api_update_user_data(telegram_id: int):
+    """API-эндпоинт для обновления данных одного пользователя"""
     try:
-        # Определяем даты для запроса в зависимости от периода
-        end_date = datetime.now()
-        
-        if period == "week":
-            start_date = end_date - timedelta(days=7)
-        elif period == "month":
-            start_date = end_date - timedelta(days=30)
-        elif period == "year":
-            start_date = end_date - timedelta(days=365)
-        else:  # По умолчанию месяц
-            start_date = end_date - timedelta(days=30)
-        
-        # Форматируем даты для API запроса
-        date_from = start_date.strftime("%Y-%m-%d")
-        date_to = end_date.strftime("%Y-%m-%d")
-        
-        # URL для запроса данных по возвратам
-        url = "https://api-seller.ozon.ru/v3/returns/company/fbs"
-        
-        # Заголовки запроса
-        headers = {
-            "Client-Id": client_id,
-            "Api-Key": api_token,
-            "Content-Type": "application/json"
-        }
-        
-        # Тело запроса
-        payload = {
-            "filter": {
-                "date": {
-                    "from": date_from,
-                    "to": date_to
-                }
-            },
-            "limit": 1000,
-            "offset": 0
-        }
-        
-        # Отправляем запрос
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code != 200:
-            print(f"Ошибка при получении данных по возвратам: {response.status_code} - {response.text}")
-            return {"total_returns": 0, "total_cost": 0, "returns": []}
-        
-        data = response.json()
-        
-        # Считаем общую сумму возвратов
-        total_returns = 0
-        total_cost = 0
-        returns = []
-        
-        if "result" in data and "returns" in data["result"]:
-            for return_item in data["result"]["returns"]:
-                price = return_item.get("price", 0)
-                total_returns += 1
-                total_cost += price
-                returns.append({
-                    "return_id": return_item.get("id", ""),
-                    "product_id": return_item.get("product_id", ""),
-                    "price": price,
-                    "reason": return_item.get("return_reason", "")
-                })
-        
-        return {
-            "total_returns": total_returns, 
-            "total_cost": total_cost,
-            "returns": returns
-        }
-    
+        updated = await services.refresh_user_data(telegram_id)
     except Exception as e:
-        print(f"Ошибка при получении данных по возвратам: {str(e)}")
-        return {"total_returns": 0, "total_cost": 0, "returns": []}
-
-async def get_ozon_financial_data(api_token: str, client_id: str, period: str = "month"):
-    """Получает финансовые данные из API Ozon"""
-    try:
-        # Определяем даты для запроса в зависимости от периода
-        end_date = datetime.now()
-        
-        if period == "week":
-            start_date = end_date - timedelta(days=7)
-        elif period == "month":
-            start_date = end_date - timedelta(days=30)
-        elif period == "year":
-            start_date = end_date - timedelta(days=365)
-        else:  # По умолчанию месяц
-            start_date = end_date - timedelta(days=30)
-        
-        # Форматируем даты для API запроса
-        date_from = start_date.strftime("%Y-%m-%d")
-        date_to = end_date.strftime("%Y-%m-%d")
-        
-        # URL для запроса финансовых данных
-        url = "https://api-seller.ozon.ru/v1/finance/treasury/totals"
-        
-        # Заголовки запроса
-        headers = {
-            "Client-Id": client_id,
-            "Api-Key": api_token,
-            "Content-Type": "application/json"
-        }
-        
-        # Тело запроса
-        payload = {
-            "date_from": date_from,
-            "date_to": date_to
-        }
-        
-        # Отправляем запрос к API Ozon
-        response = requests.post(url, headers=headers, json=payload)
-        
-        # Получаем рекламные расходы
-        ad_data = await get_ozon_advertising_costs(api_token, client_id, period)
-        advertising_costs = ad_data.get("total_cost", 0)
-        
-        # Получаем данные о возвратах
-        returns_data = await get_ozon_returns_data(api_token, client_id, period)
-        returns_cost = returns_data.get("total_cost", 0)
-        
-        if response.status_code != 200:
-            return {
-                "error": True,
-                "message": f"Ошибка при получении финансовых данных: {response.status_code} - {response.text}",
-                "advertising_costs": advertising_costs,
-                "returns_cost": returns_cost
-            }
-        
-        data = response.json()
-        
-        # Дополняем данные рекламными расходами и возвратами
-        data["advertising_costs"] = advertising_costs
-        data["returns_cost"] = returns_cost
-        
-        return data
+        logger.error(f"Ошибка при обновлении данных для пользователя {telegram_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при обновлении данных: {str(e)}")
     
-    except Exception as e:
-        print(f"Ошибка при получении финансовых данных: {str(e)}")
-        return {
-            "error": True,
-            "message": f"Ошибка при получении финансовых данных: {str(e)}",
-            "advertising_costs": 0,
-            "returns_cost": 0
-        }
+    if not updated:
+        raise HTTPException(status_code=404, detail="Пользователь не найден или не установлены API токены")
+    
+    return {"status": "success", "telegram_id": telegram_id}
 
-# Новые API-эндпоинты для работы с Celery
-@app.post("/api/update_all_data")
-async def api_update_all_data():
-    """API-эндпоинт для обновления данных всех пользователей (вызывается из Celery)"""
-    try:
-        # Получаем всех пользователей с активными токенами
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT telegram_id FROM user_tokens")
-            users = cursor.fetchall()
-        
-        # Счетчики успешных и неудачных обновлений
-        success_count = 0
-        error_count = 0
-        
-        # Обновляем данные для каждого пользователя
-        for user in users:
-            telegram_id = user[0]
-            try:
-                # Получаем токены пользователя
-                user_token = await get_user_tokens(telegram_id)
-                if not user_token:
-                    continue
-                
-                # Обновляем данные о товарах
-                products = await get_ozon_products(user_token.ozon_api_token, user_token.ozon_client_id)
-                
-                # Обновляем аналитику
-                analytics = await get_ozon_analytics(user_token.ozon_api_token, user_token.ozon_client_id)
-                
-                # Обновляем данные о рекламе
-                ad_data = await get_ozon_advertising_costs(user_token.ozon_api_token, user_token.ozon_client_id)
-                
-                # Обновляем данные о возвратах
-                returns_data = await get_ozon_returns_data(user_token.ozon_api_token, user_token.ozon_client_id)
-                
-                # Обновляем ABC-анализ
-                abc_analysis = await perform_abc_analysis(products)
-                
-                # Обновляем топовый товар
-                await update_top_product(telegram_id)
-                
-                success_count += 1
-                
-            except Exception as e:
-                print(f"Ошибка при обновлении данных для пользователя {telegram_id}: {str(e)}")
-                error_count += 1
-                continue
-        
-        return {
-            "status": "success",
-            "total_users": len(users),
-            "success_count": success_count,
-            "error_count": error_count
-        }
+async def require_webapp_owner(telegram_id: int, init_data: Optional[str] = None, header_init_data: Optional[str] = Header(None, alias="X-Telegram-Init-Data")) -> int:
+    """
+    Проверяет, что запрос к данным пользователя сделан из его Mini App: initData передается
+    в заголовке X-Telegram-Init-Data или, для EventSource (он не отправляет заголовки),
+    в параметре init_data
+    """
+    user = webapp_auth.validate_init_data(header_init_data or init_data, TELEGRAM_BOT_TOKEN)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Недействительные данные Telegram Mini App")
+    if user["id"] != telegram_id:
+        raise HTTPException(status_code=403, detail="Нет доступа к данным другого пользователя")
+    return telegram_id
+
+@app.post("/api/refresh/{telegram_id}")
+async def api_refresh_user_data(telegram_id: int = Depends(require_webapp_owner)):
+    """
+    Обновление данных по запросу пользователя: задача ставится в очередь interactive
+    с высоким приоритетом. Пока обновление выполняется, повторные запросы не ставят новых задач
+    """
+    if not services.get_user_credentials(telegram_id):
+        raise HTTPException(status_code=404, detail="Пользователь не найден или не установлены API токены")
     
+    try:
+        import celery_app
+        return celery_app.enqueue_user_refresh(telegram_id)
     except Exception as e:
-        print(f"Общая ошибка при обновлении данных: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Ошибка при обновлении данных: {str(e)}")
+        logger.error(f"Ошибка при постановке обновления данных пользователя {telegram_id}: {str(e)}")
+        raise HTTPException(status_code=503, detail="Очередь задач недоступна, попробуйте позже")
+
+@app.get("/api/refresh/{telegram_id}/events")
+async def api_refresh_events(telegram_id: int = Depends(require_webapp_owner), skip_finished: bool = False):
+    """
+    Поток Server-Sent Events с ходом обновления данных пользователя: этапы catalog, analytics,
+    abc, top_product и итог done/error. Сначала отдаются уже пройденные этапы текущего обновления;
+    с skip_finished=1 завершенное обновление не повторяется, и поток ждет следующего
+    """
+    async def event_stream():
+        async for event in refresh_progress.subscribe(telegram_id, skip_finished):
+            yield refresh_progress.format_sse(event)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/api/send_daily_reports")
 async def api_send_daily_reports():
-    """API-эндпоинт для отправки ежедневных отчетов (вызывается из Celery)"""
+    """API-эндпоинт для отправки ежедневных отчетов (ручной запуск, Celery вызывает services напрямую)"""
     try:
-        # Получаем пользователей, которые включили ежедневные отчеты
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT n.telegram_id 
-                FROM notification_settings n
-                JOIN user_tokens u ON n.telegram_id = u.telegram_id
-                WHERE n.daily_report = 1
-            ''')
-            
-            users = cursor.fetchall()
-        
-        # Счетчики успешных и неудачных отправок
-        success_count = 0
-        error_count = 0
-        
-        for user in users:
-            telegram_id = user[0]
-            try:
-                # Получаем данные аналитики
-                analytics_data = await api_get_analytics(period="day", telegram_id=telegram_id)
-                
-                if not analytics_data:
-                    continue
-                
-                # Форматируем отчет
-                total_revenue = analytics_data.get("revenue", 0)
-                total_profit = analytics_data.get("profit", 0)
-                margin = analytics_data.get("margin", 0)
-                roi = analytics_data.get("roi", 0)
-                
-                report_message = (
-                    f"📊 *Ежедневный отчет*\n\n"
-                    f"Выручка: {total_revenue:.2f} ₽\n"
-                    f"Прибыль: {total_profit:.2f} ₽\n"
-                    f"Маржинальность: {margin:.2f}%\n"
-                    f"ROI: {roi:.2f}%\n\n"
-                    f"Для более подробной информации откройте приложение."
-                )
-                
-                # Отправляем уведомление
-                success = await send_notification(telegram_id, report_message)
-                
-                if success:
-                    success_count += 1
-                else:
-                    error_count += 1
-                
-            except Exception as e:
-                print(f"Ошибка при отправке отчета пользователю {telegram_id}: {str(e)}")
-                error_count += 1
-                continue
-        
-        return {
-            "status": "success",
-            "total_users": len(users),
-            "success_count": success_count,
-            "error_count": error_count
-        }
-                
+        return await services.send_daily_reports()
     except Exception as e:
-        print(f"Общая ошибка при отправке ежедневных отчетов: {str(e)}")
+        logger.error(f"Общая ошибка при отправке ежедневных отчетов: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при отправке отчетов: {str(e)}")
 
+@app.get("/api/outbox/metrics")
+async def api_outbox_metrics():
+    """Глубина очереди исходящих уведомлений и возраст самого старого сообщения"""
+    return outbox.get_outbox_metrics()
+
+@app.get("/api/jobs/runs")
+async def api_list_job_runs(job: Optional[str] = None, limit: int = 20):
+    """Последние запуски периодических задач"""
+    return {"runs": job_ledger.list_runs(job, min(limit, 200))}
+
+@app.get("/api/telegram/queue/metrics")
+async def api_update_queue_metrics():
+    """Глубина очереди обновлений Telegram, отклоненные и повторные обновления, задержка обработки"""
+    if update_dispatcher is None:
+        raise HTTPException(status_code=503, detail="Очередь обновлений не запущена")
+    return {**update_dispatcher.metrics(), "deduplication": await update_dedup.get_dedup_metrics()}
+
+@app.get("/api/telegram/client/metrics")
+async def api_telegram_client_metrics():
+    """Время ответа Telegram Bot API по методам (гистограммы в миллисекундах)"""
+    return {"methods": telegram_client.get_latency_metrics()}
+
+@app.get("/api/singleflight/metrics")
+async def api_singleflight_metrics():
+    """Сколько тяжелых расчетов выполнено и сколько запросов получили результат чужого расчета"""
+    return singleflight.get_metrics()
+
+@app.get("/api/refresh/schedule")
+async def api_refresh_schedule():
+    """Расписание ночного обновления: пользователи по группам активности и нагрузка по часам"""
+    return refresh_scheduler.get_schedule_overview()
+
+@app.get("/api/jobs/runs/{run_id}")
+async def api_get_job_run(run_id: int, top: int = 10):
+    """Отчет по запуску задачи: самые медленные пользователи и эндпоинты Ozon"""
+    report = job_ledger.get_run_report(run_id, top)
+    if not report:
+        raise HTTPException(status_code=404, detail="Запуск не найден")
+    return report
+
 @app.get("/api/check_metrics")
 async def api_check_metrics():
-    """API-эндпоинт для проверки метрик и отправки уведомлений (вызывается из Celery)"""
+    """API-эндпоинт для проверки метрик и отправки уведомлений (ручной запуск, Celery вызывает services напрямую)"""
     try:
-        # Получаем всех пользователей с настройками уведомлений
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT n.telegram_id, n.margin_threshold, n.roi_threshold 
-                FROM notification_settings n
-                JOIN user_tokens u ON n.telegram_id = u.telegram_id
-            ''')
-            
-            users = cursor.fetchall()
-        
-        # Счетчики отправленных уведомлений
-        low_margin_alerts = 0
-        low_roi_alerts = 0
-        
-        for user in users:
-            telegram_id, margin_threshold, roi_threshold = user
-            
-            try:
-                # Получаем данные пользователя
-                user_token = await get_user_tokens(telegram_id)
-                if not user_token:
-                    continue
-                
-                # Получаем аналитику
-                analytics = await api_get_analytics(period="day", telegram_id=telegram_id)
-                
-                if not analytics:
-                    continue
-                
-                # Проверяем метрики
-                current_margin = analytics.get("margin", 0)
-                current_roi = analytics.get("roi", 0)
-                
-                # Отправляем уведомления, если метрики ниже порогов
-                if current_margin < margin_threshold:
-                    alert_message = (
-                        f"⚠️ *Внимание! Низкая маржинальность*\n\n"
-                        f"Текущая маржинальность: {current_margin:.2f}%\n"
-                        f"Ваш порог: {margin_threshold:.2f}%\n\n"
-                        f"Рекомендуем проверить цены и себестоимость товаров."
-                    )
-                    
-                    success = await send_notification(telegram_id, alert_message)
-                    if success:
-                        low_margin_alerts += 1
-                
-                if current_roi < roi_threshold:
-                    alert_message = (
-                        f"⚠️ *Внимание! Низкий ROI*\n\n"
-                        f"Текущий ROI: {current_roi:.2f}%\n"
-                        f"Ваш порог: {roi_threshold:.2f}%\n\n"
-                        f"Рекомендуем пересмотреть стратегию продаж и ценообразование."
-                    )
-                    
-                    success = await send_notification(telegram_id, alert_message)
-                    if success:
-                        low_roi_alerts += 1
-                
-            except Exception as e:
-                print(f"Ошибка при проверке метрик пользователя {telegram_id}: {str(e)}")
-                continue
-        
-        return {
-            "status": "success",
-            "total_users": len(users),
-            "low_margin_alerts": low_margin_alerts,
-            "low_roi_alerts": low_roi_alerts
-        }
-                
+        return await services.check_metrics()
     except Exception as e:
-        print(f"Общая ошибка при проверке метрик: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Ошибка при проверке метрик: {str(e)}")
\ No newline at end of file
+        logger.error(f"Общая ошибка при проверке метрик: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при проверке метрик: {str(e)}")
+
+@app.get("/api/startup/timings")
+async def api_startup_timings():
+    """Длительность импорта модуля и этапов запуска сервиса (миллисекунды)"""
+    return {
+        **startup_timings,
+        "telegram_ready": telegram_application is not None,
+    }
+
+startup_timings["import_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
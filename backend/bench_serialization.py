@@ -0,0 +1,133 @@
+# Сравнение способов сериализации больших ответов API на синтетических данных.
+# Для каждого эндпоинта показывает время сериализации и размер ответа без сжатия и со сжатием gzip.
+#
+# Пример:
+#   python bench_serialization.py --skus 5000 --repeat 5
+import argparse
+import gzip
+import json
+import random
+import time
+from typing import Callable, Dict, List
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+import fast_json
+import projections
+
+def make_product(index: int) -> dict:
+    """Товар в формате ответа /api/products"""
+    price = round(random.uniform(300, 15000), 2)
+    cost = round(price * random.uniform(0.3, 0.8), 2)
+    return {
+        "product_id": 100000 + index,
+        "offer_id": f"SKU-{index:06d}",
+        "name": f"Товар номер {index} для проверки размера ответа",
+        "price": str(price),
+        "old_price": str(round(price * 1.2, 2)),
+        "images": [f"https://cdn.ozon.ru/s3/multimedia/{index}/{n}.jpg" for n in range(3)],
+        "visible": True,
+        "cost": cost,
+        "margin_percent": round((price - cost) / price * 100, 2),
+    }
+
+def make_product_analytics(index: int) -> dict:
+    """Строка в формате ответа /api/analytics/products"""
+    revenue = round(random.uniform(0, 500000), 2)
+    total_cost = round(revenue * random.uniform(0.4, 0.9), 2)
+    profit = revenue - total_cost
+    return {
+        "product_id": 100000 + index,
+        "offer_id": f"SKU-{index:06d}",
+        "name": f"Товар номер {index} для проверки размера ответа",
+        "image": f"https://cdn.ozon.ru/s3/multimedia/{index}/0.jpg",
+        "sales_count": random.randint(0, 500),
+        "revenue": revenue,
+        "cost": round(random.uniform(100, 5000), 2),
+        "total_cost": total_cost,
+        "commission": round(revenue * 0.15, 2),
+        "ad_cost": round(random.uniform(0, 3000), 2),
+        "return_cost": round(random.uniform(0, 1000), 2),
+        "profit": profit,
+        "margin": profit / revenue * 100 if revenue else 0,
+        "roi": profit / total_cost * 100 if total_cost else 0,
+    }
+
+def make_payloads(skus: int) -> Dict[str, object]:
+    products = [make_product(index) for index in range(skus)]
+    analytics = [make_product_analytics(index) for index in range(skus)]
+    ranked = sorted(analytics, key=lambda item: item["profit"], reverse=True)
+    third = len(ranked) // 3
+    return {
+        "/api/products": {"items": products, "total": skus, "status": "success"},
+        "/api/analytics/products": analytics,
+        "/api/analytics/products?view=compact": projections.project(
+            analytics, projections.PRODUCT_ANALYTICS_VIEWS["compact"]
+        ),
+        "/api/analytics/abc": {
+            "A": ranked[:third],
+            "B": ranked[third:2 * third],
+            "C": ranked[2 * third:],
+            "total_products": skus,
+        },
+    }
+
+def stdlib_path(content) -> bytes:
+    """Прежний путь FastAPI: jsonable_encoder + json.dumps"""
+    return JSONResponse(jsonable_encoder(content)).body
+
+def fast_path(content) -> bytes:
+    """Новый путь: сериализация через fast_json без jsonable_encoder"""
+    return fast_json.dumps(content)
+
+def measure(serializer: Callable, content, repeat: int) -> tuple:
+    best = None
+    body = b""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = serializer(content)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, body
+
+def run(skus: int, repeat: int, level: int) -> List[dict]:
+    random.seed(42)
+    rows = []
+    for endpoint, content in make_payloads(skus).items():
+        for name, serializer in (("stdlib", stdlib_path), ("orjson" if fast_json.orjson else "json", fast_path)):
+            elapsed_ms, body = measure(serializer, content, repeat)
+            started = time.perf_counter()
+            compressed = gzip.compress(body, compresslevel=level)
+            gzip_ms = (time.perf_counter() - started) * 1000
+            rows.append({
+                "endpoint": endpoint,
+                "serializer": name,
+                "serialize_ms": round(elapsed_ms, 1),
+                "raw_kb": round(len(body) / 1024, 1),
+                "gzip_ms": round(gzip_ms, 1),
+                "gzip_kb": round(len(compressed) / 1024, 1),
+            })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение сериализации больших ответов API")
+    parser.add_argument("--skus", type=int, default=5000, help="число товаров в каталоге")
+    parser.add_argument("--repeat", type=int, default=5, help="число повторов (берется лучшее время)")
+    parser.add_argument("--level", type=int, default=5, help="уровень сжатия gzip (как GZIP_COMPRESS_LEVEL)")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    rows = run(args.skus, args.repeat, args.level)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+        return
+
+    print(f"Товаров: {args.skus}, повторов: {args.repeat}, gzip level {args.level}")
+    print(f"{'эндпоинт':<38} {'сериализатор':<13} {'мс':>8} {'КБ':>9} {'gzip мс':>8} {'gzip КБ':>8}")
+    for row in rows:
+        print(
+            f"{row['endpoint']:<38} {row['serializer']:<13} {row['serialize_ms']:>8} "
+            f"{row['raw_kb']:>9} {row['gzip_ms']:>8} {row['gzip_kb']:>8}"
+        )
+
+if __name__ == "__main__":
+    main()
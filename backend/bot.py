@@ -1,3 +1,4 @@
+import logging
 import os
 from dotenv import load_dotenv
 import telegram
@@ -5,10 +6,13 @@ from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, BotCommand
 from telegram.ext import CommandHandler, MessageHandler, filters
 import telegram.ext
 import asyncio
-import sqlite3
-from contextlib import contextmanager
 from pydantic import BaseModel
 from typing import Optional, List
+from telegram_client import PooledTelegramRequest
+import database
+from database import get_db, PortableCursor
+
+logger = logging.getLogger(__name__)
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -20,60 +24,49 @@ class UserToken(BaseModel):
     ozon_api_token: str
     ozon_client_id: str
 
-@contextmanager
-def get_db():
-    conn = sqlite3.connect('user_tokens.db')
-    try:
-        yield conn
-    finally:
-        conn.close()
-
 # Функция для инициализации базы данных
 def init_db():
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_tokens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE,
-                username TEXT,
-                ozon_api_token TEXT,
-                ozon_client_id TEXT,
-                last_updated TIMESTAMP
-            )
-        ''')
-        conn.commit()
+    # Таблица пользователей общая с веб-сервисом и воркерами Celery (см. database.py)
+    database.init_db()
 
 def save_user_token(user_token: UserToken):
     """Сохраняет токены пользователя в базу данных"""
     with get_db() as conn:
-        cursor = conn.cursor()
+        cursor = PortableCursor(conn)
         cursor.execute('''
-            INSERT OR REPLACE INTO user_tokens 
+            INSERT INTO user_tokens 
             (telegram_id, username, ozon_api_token, ozon_client_id, last_updated)
             VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (telegram_id) DO UPDATE SET
+                username = excluded.username,
+                ozon_api_token = excluded.ozon_api_token,
+                ozon_client_id = excluded.ozon_client_id,
+                last_updated = excluded.last_updated
         ''', (user_token.telegram_id, user_token.username, user_token.ozon_api_token, user_token.ozon_client_id))
         conn.commit()
 
 def get_user_token(telegram_id: int) -> Optional[UserToken]:
     """Получает токены пользователя из базы данных"""
     with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM user_tokens WHERE telegram_id = ?', (telegram_id,))
+        cursor = PortableCursor(conn)
+        cursor.execute(
+            'SELECT telegram_id, username, ozon_api_token, ozon_client_id FROM user_tokens WHERE telegram_id = ?',
+            (telegram_id,)
+        )
         row = cursor.fetchone()
         if row:
             return UserToken(
-                telegram_id=row[1],
-                username=row[2],
-                ozon_api_token=row[3],
-                ozon_client_id=row[4]
+                telegram_id=row[0],
+                username=row[1],
+                ozon_api_token=row[2],
+                ozon_client_id=row[3]
             )
         return None
 
 def delete_user_token(telegram_id: int):
     """Удаляет токены пользователя из базы данных"""
     with get_db() as conn:
-        cursor = conn.cursor()
+        cursor = PortableCursor(conn)
         cursor.execute('DELETE FROM user_tokens WHERE telegram_id = ?', (telegram_id,))
         conn.commit()
 
@@ -229,7 +222,13 @@ def main():
     init_db()
 
     # Создаем приложение
-    application = telegram.ext.Application.builder().token(bot_token).build()
+    application = (
+        telegram.ext.Application.builder()
+        .token(bot_token)
+        .request(PooledTelegramRequest())
+        .get_updates_request(PooledTelegramRequest())
+        .build()
+    )
 
     # Устанавливаем команды бота с описаниями
     application.post_init = set_bot_commands
@@ -245,8 +244,10 @@ def main():
     application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
 
     # Запускаем бота
-    print("Запуск бота...")
+    logger.info("Запуск бота...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
+    from logging_setup import setup_logging
+    setup_logging("bot")
     main() 
\ No newline at end of file
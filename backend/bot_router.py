@@ -0,0 +1,89 @@
+# Маршрутизатор команд бота.
+# Команды со слешем и текст кнопок без слеша ищутся по словарю за O(1), а русские
+# формулировки ("Удалить токены", "Статистика") - одним заранее скомпилированным регулярным
+# выражением. Порядок ключевых слов задает приоритет: "удалить токены" проверяется раньше,
+# чем просто "токены".
+import logging
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Обработчик команды: (update, context, args) -> None
+CommandHandler = Callable[..., Awaitable[None]]
+
+class CommandRouter:
+    """Таблица команд бота с точным поиском и поиском по ключевым словам"""
+
+    def __init__(self):
+        self.commands: Dict[str, CommandHandler] = {}
+        self.aliases: List[Tuple[str, str]] = []
+        self._alias_pattern: Optional[re.Pattern] = None
+        self._alias_groups: Dict[str, str] = {}
+
+    def command(self, *names: str):
+        """Декоратор: регистрирует обработчик для одной или нескольких команд (без слеша)"""
+        def decorator(handler: CommandHandler) -> CommandHandler:
+            for name in names:
+                self.commands[name.lower()] = handler
+            return handler
+        return decorator
+
+    def add_alias(self, command: str, pattern: str):
+        """
+        Добавляет ключевое слово (регулярное выражение) для команды.
+        Ключевые слова проверяются в порядке добавления
+        """
+        self.aliases.append((command, pattern))
+        self._alias_pattern = None
+
+    def _compile(self):
+        # Каждая альтернатива привязана к началу строки через ".*?", поэтому при совпадении
+        # нескольких ключевых слов выигрывает добавленное раньше, а не встреченное раньше в тексте
+        parts = []
+        self._alias_groups = {}
+        for index, (command, pattern) in enumerate(self.aliases):
+            group = f"c{index}"
+            self._alias_groups[group] = command
+            parts.append(f"(?P<{group}>.*?(?:{pattern}))")
+        self._alias_pattern = re.compile("|".join(parts), re.IGNORECASE | re.DOTALL) if parts else None
+
+    def resolve(self, text: str, allow_aliases: bool = True) -> Optional[Tuple[str, List[str]]]:
+        """
+        Определяет команду по тексту сообщения.
+        Возвращает (имя команды, аргументы) или None, если команда не распознана
+        """
+        text = (text or "").strip()
+        if not text:
+            return None
+
+        first_word, *args = text.split()
+        name = first_word.lstrip("/").split("@", 1)[0].lower()
+
+        # Команда со слешем (/stats, /set_margin_threshold 15) или текст кнопки без слеша (stats)
+        if name in self.commands and (first_word.startswith("/") or not args):
+            return name, args
+
+        if first_word.startswith("/") or not allow_aliases:
+            return None
+
+        if self._alias_pattern is None:
+            self._compile()
+        if self._alias_pattern is None:
+            return None
+
+        match = self._alias_pattern.match(text)
+        if not match:
+            return None
+        return self._alias_groups[match.lastgroup], []
+
+    async def dispatch(self, update, context, allow_aliases: bool = True) -> bool:
+        """Вызывает обработчик команды из сообщения. Возвращает False, если команда не распознана"""
+        resolved = self.resolve(update.message.text, allow_aliases)
+        if not resolved:
+            return False
+
+        name, args = resolved
+        logger.debug(f"Обработка команды '{name}' от пользователя {update.effective_user.id}")
+        await self.commands[name](update, context, args)
+        return True
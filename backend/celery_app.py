@@ -1,116 +1,374 @@
-from celery import Celery
+import logging
+from celery import Celery, chord, signals
 from celery.schedules import crontab
+from celery.exceptions import SoftTimeLimitExceeded
+from kombu import Queue
 import os
+import time
+import asyncio
+import aiohttp
 from dotenv import load_dotenv
-import httpx
-from datetime import datetime
+from fastapi import HTTPException
+import services
+import job_ledger
+import refresh_scheduler
+import redis_store
+import outbox
+import telegram_client
+import refresh_progress
+from ozon_api import OzonAPIError, start_call_tracking
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Получаем URL бэкенда из переменных окружения или используем локальный хост
-BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
+# Ограничения для задачи обновления данных одного пользователя
+USER_REFRESH_RATE_LIMIT = os.getenv("USER_REFRESH_RATE_LIMIT", "60/m")  # Не чаще N задач на воркер
+USER_REFRESH_SOFT_TIME_LIMIT = int(os.getenv("USER_REFRESH_SOFT_TIME_LIMIT", "120"))  # секунды
+USER_REFRESH_MAX_RETRIES = int(os.getenv("USER_REFRESH_MAX_RETRIES", "3"))
+
+# Пока обновление данных пользователя выполняется, повторные запросы на обновление не ставятся
+REFRESH_LOCK_TTL = USER_REFRESH_SOFT_TIME_LIMIT + 60
+
+# Приоритеты задач (в Redis меньшее значение обрабатывается раньше)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 5
+PRIORITY_BATCH = 9
 
 # Настройка Celery
 app = Celery('ozon_bot_tasks')
 
+# Воркеры и beat пишут логи в том же JSON-формате, что и веб-сервис.
+# Обработчик сигнала заменяет стандартную настройку логирования Celery
+@signals.setup_logging.connect
+def configure_worker_logging(**kwargs):
+    setup_logging("celery")
+
 # Конфигурация Celery
 app.conf.broker_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 app.conf.result_backend = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
-# Настройка часового пояса
-app.conf.timezone = 'Europe/Moscow'
+# Настройка часового пояса (общий с ночным окном обновления в refresh_scheduler.py)
+app.conf.timezone = refresh_scheduler.SCHEDULE_TIMEZONE_NAME
+
+# Подтверждаем задачу только после выполнения и не берем лишние задачи заранее,
+# чтобы задачи обновления равномерно распределялись между воркерами
+app.conf.task_acks_late = True
+app.conf.worker_prefetch_multiplier = 1
+
+# Очереди: обновление по запросу пользователя, плановое пакетное обновление и уведомления.
+# Для каждой очереди запускается отдельный воркер, чтобы ночное обновление не задерживало запросы
+# пользователей и доставку уведомлений:
+#   celery -A celery_app worker -Q interactive
+#   celery -A celery_app worker -Q batch
+#   celery -A celery_app worker -Q notifications
+app.conf.task_queues = (
+    Queue('interactive'),
+    Queue('batch'),
+    Queue('notifications'),
+)
+app.conf.task_default_queue = 'batch'
+app.conf.task_routes = {
+    'celery_app.refresh_user_now': {'queue': 'interactive'},
+    'celery_app.update_user_data': {'queue': 'batch'},
+    'celery_app.update_all_users_data': {'queue': 'batch'},
+    'celery_app.dispatch_due_refreshes': {'queue': 'batch'},
+    'celery_app.aggregate_update_results': {'queue': 'batch'},
+    'celery_app.send_daily_reports': {'queue': 'notifications'},
+    'celery_app.check_metrics': {'queue': 'notifications'},
+    'celery_app.check_user_metrics': {'queue': 'notifications'},
+    'celery_app.deliver_outbox': {'queue': 'notifications'},
+}
+# Приоритеты внутри очереди Redis
+app.conf.broker_transport_options = {
+    'priority_steps': list(range(10)),
+    'queue_order_strategy': 'priority',
+}
+app.conf.task_default_priority = PRIORITY_DEFAULT
 
 # Настройка периодических задач
 app.conf.beat_schedule = {
-    # Ежедневное обновление данных в 02:00
-    'daily-data-update': {
-        'task': 'celery_app.update_all_users_data',
-        'schedule': crontab(hour=2, minute=0),
+    # Обновление данных по расписанию пользователей: время обновления каждого продавца
+    # распределено по ночному окну (см. refresh_scheduler.py), диспетчер забирает тех, чье время подошло
+    'dispatch-due-refreshes': {
+        'task': 'celery_app.dispatch_due_refreshes',
+        'schedule': crontab(minute='*/5'),
     },
-    # Ежедневный отчет в 09:00
+    # Ежедневный отчет в 09:00 (отчеты готовятся заранее при ночном обновлении данных)
     'daily-report': {
         'task': 'celery_app.send_daily_reports',
         'schedule': crontab(hour=9, minute=0),
     },
-    # Проверка метрик каждые 3 часа
+    # Проверка метрик пользователей, у которых изменились данные или себестоимость.
+    # Пользователи без изменений пропускаются, поэтому проверку можно запускать часто
     'check-metrics': {
         'task': 'celery_app.check_metrics',
-        'schedule': crontab(minute=0, hour='*/3'),
+        'schedule': crontab(minute='*/30'),
+    },
+    # Доставка уведомлений, отложенных после ошибок (новые доставляются сразу после рассылок)
+    'deliver-outbox': {
+        'task': 'celery_app.deliver_outbox',
+        'schedule': crontab(minute='*'),
     },
 }
 
+def refresh_lock_key(user_id) -> str:
+    """Ключ блокировки, которая держится, пока обновляются данные пользователя"""
+    return f"refresh:inflight:{user_id}"
+
+def is_retryable_error(error: Exception) -> bool:
+    """Определяет, имеет ли смысл повторить задачу после ошибки"""
+    if isinstance(error, OzonAPIError):
+        # Решаем по настоящему ответу Ozon: неверные токены (401/403) не повторяем
+        return error.retryable
+    if isinstance(error, HTTPException):
+        # Ошибки сервера Ozon повторяем, ошибки запроса (например, неверные токены) - нет
+        return error.status_code >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
 @app.task(name='celery_app.update_all_users_data')
 def update_all_users_data():
-    """Задача для обновления данных всех пользователей"""
+    """Задача для обновления данных всех пользователей: ставит по задаче на каждого пользователя"""
+    run_id = None
+    try:
+        run_id = job_ledger.start_run("update_all_users_data")
+        user_ids = services.get_all_user_ids()
+        
+        if not user_ids:
+            logger.info("Нет пользователей для обновления данных")
+            job_ledger.finish_run(run_id)
+            return {"status": "success", "total_users": 0}
+        
+        # Каждый пользователь обновляется отдельной задачей, итог собирает aggregate_update_results
+        chord(
+            update_user_data.s(user_id, run_id).set(priority=PRIORITY_BATCH) for user_id in user_ids
+        )(aggregate_update_results.s(run_id))
+        
+        logger.info(f"Поставлено задач обновления данных: {len(user_ids)}")
+        return {"status": "scheduled", "total_users": len(user_ids), "run_id": run_id}
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении задачи update_all_users_data: {str(e)}")
+        if run_id:
+            job_ledger.finish_run(run_id, status="error", details={"message": str(e)})
+        return {"status": "error", "message": str(e)}
+
+@app.task(name='celery_app.dispatch_due_refreshes')
+def dispatch_due_refreshes():
+    """Ставит задачи обновления для пользователей, чье время обновления по расписанию подошло"""
     try:
-        # Вызываем API endpoint для обновления данных
-        response = httpx.post(f"{BACKEND_URL}/api/update_all_data", timeout=300)
+        changes = refresh_scheduler.sync_schedule()
+        user_ids = refresh_scheduler.claim_due_users()
+        
+        if not user_ids:
+            return {"status": "success", "total_users": 0, "schedule": changes}
+        
+        run_id = job_ledger.start_run("scheduled_refresh")
+        chord(
+            update_user_data.s(user_id, run_id).set(priority=PRIORITY_BATCH) for user_id in user_ids
+        )(aggregate_update_results.s(run_id))
         
-        if response.status_code == 200:
-            print(f"[{datetime.now()}] Данные всех пользователей успешно обновлены")
-            return {"status": "success", "message": "Данные всех пользователей успешно обновлены"}
-        else:
-            print(f"[{datetime.now()}] Ошибка при обновлении данных: {response.status_code} - {response.text}")
-            return {"status": "error", "message": f"Ошибка при обновлении данных: {response.status_code}"}
+        logger.info(f"Поставлено задач обновления по расписанию: {len(user_ids)}")
+        return {"status": "scheduled", "total_users": len(user_ids), "run_id": run_id, "schedule": changes}
     except Exception as e:
-        print(f"[{datetime.now()}] Ошибка при выполнении задачи update_all_users_data: {str(e)}")
+        logger.error(f"Ошибка при выполнении задачи dispatch_due_refreshes: {str(e)}")
         return {"status": "error", "message": str(e)}
 
+@app.task(name='celery_app.aggregate_update_results')
+def aggregate_update_results(results, run_id=None):
+    """Собирает результаты обновления данных всех пользователей"""
+    success_count = sum(1 for result in results if result.get("status") == "success")
+    error_count = len(results) - success_count
+    
+    if run_id:
+        job_ledger.finish_run(run_id, total_items=len(results), success_count=success_count, error_count=error_count)
+    
+    logger.info(f"Обновление данных завершено: успешно {success_count}, с ошибками {error_count}")
+    return {
+        "status": "success",
+        "total_users": len(results),
+        "success_count": success_count,
+        "error_count": error_count
+    }
+
 @app.task(name='celery_app.send_daily_reports')
 def send_daily_reports():
     """Задача для отправки ежедневных отчетов"""
+    run_id = job_ledger.start_run("send_daily_reports")
     try:
-        # Вызываем API endpoint для отправки отчетов
-        response = httpx.get(f"{BACKEND_URL}/api/send_daily_reports", timeout=120)
-        
-        if response.status_code == 200:
-            print(f"[{datetime.now()}] Ежедневные отчеты успешно отправлены")
-            return {"status": "success", "message": "Ежедневные отчеты успешно отправлены"}
-        else:
-            print(f"[{datetime.now()}] Ошибка при отправке отчетов: {response.status_code} - {response.text}")
-            return {"status": "error", "message": f"Ошибка при отправке отчетов: {response.status_code}"}
+        result = asyncio.run(services.send_daily_reports())
+        job_ledger.finish_run(
+            run_id,
+            total_items=result["success_count"] + result["error_count"],
+            success_count=result["success_count"],
+            error_count=result["error_count"]
+        )
+        logger.info(f"Ежедневные отчеты поставлены в очередь: {result['success_count']}, не подготовлено: {result['error_count']}")
+        deliver_outbox.delay()
+        return result
     except Exception as e:
-        print(f"[{datetime.now()}] Ошибка при выполнении задачи send_daily_reports: {str(e)}")
+        job_ledger.finish_run(run_id, status="error", details={"message": str(e)})
+        logger.error(f"Ошибка при выполнении задачи send_daily_reports: {str(e)}")
         return {"status": "error", "message": str(e)}
 
 @app.task(name='celery_app.check_metrics')
 def check_metrics():
     """Задача для проверки метрик и отправки уведомлений"""
+    run_id = job_ledger.start_run("check_metrics")
     try:
-        # Вызываем API endpoint для проверки метрик
-        response = httpx.get(f"{BACKEND_URL}/api/check_metrics", timeout=120)
-        
-        if response.status_code == 200:
-            print(f"[{datetime.now()}] Проверка метрик успешно выполнена")
-            return {"status": "success", "message": "Проверка метрик успешно выполнена"}
-        else:
-            print(f"[{datetime.now()}] Ошибка при проверке метрик: {response.status_code} - {response.text}")
-            return {"status": "error", "message": f"Ошибка при проверке метрик: {response.status_code}"}
+        result = asyncio.run(services.check_metrics(run_id=run_id))
+        job_ledger.finish_run(
+            run_id,
+            total_items=result["total_users"],
+            success_count=result["total_users"],
+            details={"low_margin_alerts": result["low_margin_alerts"], "low_roi_alerts": result["low_roi_alerts"]}
+        )
+        logger.info(f"Проверка метрик выполнена: пользователей {result['total_users']}")
+        deliver_outbox.delay()
+        return result
     except Exception as e:
-        print(f"[{datetime.now()}] Ошибка при выполнении задачи check_metrics: {str(e)}")
+        job_ledger.finish_run(run_id, status="error", details={"message": str(e)})
+        logger.error(f"Ошибка при выполнении задачи check_metrics: {str(e)}")
         return {"status": "error", "message": str(e)}
 
-@app.task(name='celery_app.update_user_data')
-def update_user_data(user_id):
-    """Задача для обновления данных конкретного пользователя"""
+@app.task(name='celery_app.check_user_metrics')
+def check_user_metrics(user_id):
+    """Задача для проверки метрик одного пользователя сразу после изменения его данных"""
     try:
-        # Вызываем API endpoint для обновления данных пользователя
-        response = httpx.post(
-            f"{BACKEND_URL}/api/update_data", 
-            json={"user_id": user_id},
-            timeout=120
-        )
-        
-        if response.status_code == 200:
-            print(f"[{datetime.now()}] Данные пользователя {user_id} успешно обновлены")
-            return {"status": "success", "message": f"Данные пользователя {user_id} успешно обновлены"}
-        else:
-            print(f"[{datetime.now()}] Ошибка при обновлении данных пользователя {user_id}: {response.status_code} - {response.text}")
-            return {"status": "error", "message": f"Ошибка при обновлении данных: {response.status_code}"}
+        result = asyncio.run(services.check_metrics([user_id]))
+        if result["low_margin_alerts"] or result["low_roi_alerts"]:
+            deliver_outbox.delay()
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка при проверке метрик пользователя {user_id}: {str(e)}")
+        return {"status": "error", "user_id": user_id, "message": str(e)}
+
+@app.task(name='celery_app.deliver_outbox', soft_time_limit=outbox.OUTBOX_DRAIN_TIME_LIMIT + 30)
+def deliver_outbox():
+    """
+    Доставляет уведомления из outbox. Рассылки и доставка выполняются воркером очереди notifications,
+    поэтому отдельный процесс-отправитель не нужен
+    """
+    async def run():
+        try:
+            return await outbox.drain()
+        finally:
+            await telegram_client.close_client()
+    
+    try:
+        processed = asyncio.run(run())
+        return {"status": "success", "processed": processed}
     except Exception as e:
-        print(f"[{datetime.now()}] Ошибка при выполнении задачи update_user_data для пользователя {user_id}: {str(e)}")
+        logger.error(f"Ошибка при доставке уведомлений из outbox: {str(e)}")
         return {"status": "error", "message": str(e)}
 
+@app.task(
+    name='celery_app.update_user_data',
+    bind=True,
+    max_retries=USER_REFRESH_MAX_RETRIES,
+    rate_limit=USER_REFRESH_RATE_LIMIT,
+    soft_time_limit=USER_REFRESH_SOFT_TIME_LIMIT,
+    time_limit=USER_REFRESH_SOFT_TIME_LIMIT + 30,
+)
+def update_user_data(self, user_id, run_id=None):
+    """
+    Задача для обновления данных конкретного пользователя.
+    Если задача запущена в рамках update_all_users_data, итог попадает в журнал запусков run_id
+    """
+    started_at = time.time()
+    call_stats = start_call_tracking()
+    
+    def record(status, error=None):
+        if run_id:
+            job_ledger.record_item(run_id, user_id, status, started_at, call_stats, self.request.retries, error)
+    
+    # Если данные пользователя уже обновляются по его запросу, повторно не обновляем
+    lock_key = refresh_lock_key(user_id)
+    if not redis_store.try_acquire(lock_key, REFRESH_LOCK_TTL):
+        record("deduplicated")
+        return {"status": "success", "user_id": user_id, "deduplicated": True}
+    
+    try:
+        return _refresh_user(user_id, record)
+    except SoftTimeLimitExceeded as e:
+        logger.error(f"Превышено время обновления данных пользователя {user_id}")
+        record("error", e)
+        return {"status": "error", "user_id": user_id, "message": "Превышено время выполнения"}
+    except Exception as e:
+        # Временные ошибки повторяем с экспоненциальной задержкой
+        if is_retryable_error(e) and self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=30 * 2 ** self.request.retries)
+        logger.error(f"Ошибка при выполнении задачи update_user_data для пользователя {user_id}: {str(e)}")
+        record("error", e)
+        return {"status": "error", "user_id": user_id, "message": str(e)}
+    finally:
+        redis_store.release(lock_key)
+
+@app.task(
+    name='celery_app.refresh_user_now',
+    bind=True,
+    max_retries=1,
+    soft_time_limit=USER_REFRESH_SOFT_TIME_LIMIT,
+    time_limit=USER_REFRESH_SOFT_TIME_LIMIT + 30,
+)
+def refresh_user_now(self, user_id):
+    """
+    Обновление данных по запросу пользователя (кнопка в Mini App, /stats).
+    Блокировку обновления ставит enqueue_user_refresh, а снимает эта задача
+    """
+    retrying = False
+    try:
+        return _refresh_user(user_id)
+    except SoftTimeLimitExceeded:
+        logger.error(f"Превышено время обновления данных пользователя {user_id}")
+        return {"status": "error", "user_id": user_id, "message": "Превышено время выполнения"}
+    except Exception as e:
+        # Пользователь ждет результата, поэтому повторяем один раз и быстро
+        if is_retryable_error(e) and self.request.retries < self.max_retries:
+            retrying = True
+            raise self.retry(exc=e, countdown=5)
+        logger.error(f"Ошибка при обновлении данных пользователя {user_id} по запросу: {str(e)}")
+        return {"status": "error", "user_id": user_id, "message": str(e)}
+    finally:
+        if not retrying:
+            redis_store.release(refresh_lock_key(user_id))
+
+def _refresh_user(user_id, record=lambda status, error=None: None) -> dict:
+    """Обновляет данные пользователя и при изменении данных ставит проверку метрик"""
+    updated = asyncio.run(services.refresh_user_data(user_id))
+    
+    if not updated:
+        logger.warning(f"У пользователя {user_id} не установлены API токены")
+        record("skipped")
+        return {"status": "error", "user_id": user_id, "message": "Не установлены API токены"}
+    
+    # Метрики проверяем только если данные действительно изменились
+    if updated["data_changed"]:
+        check_user_metrics.delay(user_id)
+    
+    refresh_scheduler.mark_refreshed(user_id)
+    logger.info(f"Данные пользователя {user_id} успешно обновлены")
+    record("success")
+    return {"status": "success", "user_id": user_id, "data_changed": updated["data_changed"]}
+
+def enqueue_user_refresh(user_id) -> dict:
+    """
+    Ставит обновление данных пользователя в очередь interactive с высоким приоритетом.
+    Если обновление этого пользователя уже выполняется, новая задача не ставится
+    """
+    lock_key = refresh_lock_key(user_id)
+    if not redis_store.try_acquire(lock_key, REFRESH_LOCK_TTL):
+        return {"status": "in_progress", "user_id": user_id}
+    
+    try:
+        task = refresh_user_now.apply_async((user_id,), priority=PRIORITY_INTERACTIVE)
+    except Exception:
+        redis_store.release(lock_key)
+        raise
+    
+    refresh_progress.publish(user_id, "queued", task_id=task.id)
+    return {"status": "queued", "user_id": user_id, "task_id": task.id}
+
 if __name__ == '__main__':
     app.start() 
\ No newline at end of file
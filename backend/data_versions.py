@@ -0,0 +1,151 @@
+# Версии данных пользователей и сохраненные результаты расчетов.
+# Версия данных пользователя увеличивается, когда при обновлении из Ozon пришли другие данные,
+# сохранен новый результат расчета вне обновления или пользователь изменил себестоимость товаров. По версии фоновые задачи определяют,
+# кого нужно пересчитывать, а последние рассчитанные показатели хранятся между запусками.
+import json
+import hashlib
+import time
+from typing import Optional, Tuple
+from database import get_db, PortableCursor
+
+def init_data_versions_tables():
+    """Создает таблицы версий данных и сохраненных результатов расчетов"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_data_versions (
+                telegram_id BIGINT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                data_hash TEXT,
+                synced_at DOUBLE PRECISION,
+                updated_at DOUBLE PRECISION
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_snapshots (
+                telegram_id BIGINT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                data_version INTEGER NOT NULL DEFAULT 0,
+                computed_at DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (telegram_id, kind)
+            )
+        ''')
+        conn.commit()
+
+def compute_data_hash(*parts) -> str:
+    """Считает хеш набора данных, полученных из Ozon"""
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+def get_data_version(telegram_id: int) -> int:
+    """Возвращает текущую версию данных пользователя (0, если данные еще не загружались)"""
+    init_data_versions_tables()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('SELECT version FROM user_data_versions WHERE telegram_id = ?', (telegram_id,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+def get_data_state(telegram_id: int) -> Tuple[int, Optional[str]]:
+    """
+    Возвращает (версия данных, хеш последней синхронизации с Ozon). Версия - счетчик в базе
+    конкретного сервиса, хеш описывает сами данные, поэтому вместе они однозначно задают состояние
+    """
+    init_data_versions_tables()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('SELECT version, data_hash FROM user_data_versions WHERE telegram_id = ?', (telegram_id,))
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else (0, None)
+
+def _bump(cursor: PortableCursor, telegram_id: int, now: float):
+    cursor.execute('''
+        INSERT INTO user_data_versions (telegram_id, version, updated_at)
+        VALUES (?, 1, ?)
+        ON CONFLICT (telegram_id) DO UPDATE SET version = user_data_versions.version + 1, updated_at = excluded.updated_at
+    ''', (telegram_id, now))
+
+def bump_data_version(telegram_id: int) -> int:
+    """Увеличивает версию данных пользователя (например, после изменения себестоимости)"""
+    init_data_versions_tables()
+    now = time.time()
+    with get_db() as conn:
+        _bump(PortableCursor(conn), telegram_id, now)
+        conn.commit()
+    return get_data_version(telegram_id)
+
+def record_sync(telegram_id: int, data_hash: str) -> bool:
+    """
+    Запоминает результат синхронизации с Ozon. Если данные изменились,
+    увеличивает версию и возвращает True
+    """
+    init_data_versions_tables()
+    now = time.time()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('SELECT data_hash FROM user_data_versions WHERE telegram_id = ?', (telegram_id,))
+        row = cursor.fetchone()
+        changed = row is None or row[0] != data_hash
+
+        if changed:
+            _bump(cursor, telegram_id, now)
+        cursor.execute(
+            'UPDATE user_data_versions SET data_hash = ?, synced_at = ? WHERE telegram_id = ?',
+            (data_hash, now, telegram_id)
+        )
+        conn.commit()
+    return changed
+
+def save_snapshot(telegram_id: int, kind: str, payload, data_version: Optional[int] = None) -> int:
+    """
+    Сохраняет рассчитанный результат (аналитику, отчет и т.п.) для пользователя и возвращает
+    версию данных, к которой он относится. Результат, полученный вне обновления данных
+    (data_version не передан), увеличивает версию, если отличается от сохраненного ранее
+    """
+    init_data_versions_tables()
+    serialized = json.dumps(payload, ensure_ascii=False, default=str)
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        if data_version is None:
+            cursor.execute('SELECT payload FROM user_snapshots WHERE telegram_id = ? AND kind = ?', (telegram_id, kind))
+            row = cursor.fetchone()
+            if row is None or row[0] != serialized:
+                _bump(cursor, telegram_id, time.time())
+            cursor.execute('SELECT version FROM user_data_versions WHERE telegram_id = ?', (telegram_id,))
+            row = cursor.fetchone()
+            data_version = row[0] if row else 0
+
+        cursor.execute('''
+            INSERT INTO user_snapshots (telegram_id, kind, payload, data_version, computed_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (telegram_id, kind) DO UPDATE SET
+                payload = excluded.payload, data_version = excluded.data_version, computed_at = excluded.computed_at
+        ''', (telegram_id, kind, serialized, data_version, time.time()))
+        conn.commit()
+    return data_version
+
+def get_snapshot(telegram_id: int, kind: str) -> Optional[dict]:
+    """
+    Возвращает сохраненный результат в виде
+    {"payload", "data_version", "computed_at", "age_seconds"} или None
+    """
+    init_data_versions_tables()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            SELECT payload, data_version, computed_at
+            FROM user_snapshots
+            WHERE telegram_id = ? AND kind = ?
+        ''', (telegram_id, kind))
+        row = cursor.fetchone()
+
+    if not row:
+        return None
+
+    return {
+        "payload": json.loads(row[0]),
+        "data_version": row[1],
+        "computed_at": row[2],
+        "age_seconds": time.time() - row[2],
+    }
@@ -50,7 +50,7 @@ def init_db():
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS user_tokens (
                     user_id SERIAL PRIMARY KEY,
-                    telegram_id INTEGER UNIQUE,
+                    telegram_id BIGINT UNIQUE,
                     username TEXT,
                     ozon_api_token TEXT,
                     ozon_client_id TEXT,
@@ -59,4 +59,61 @@ def init_db():
                 )
             ''')
         
-        conn.commit() 
\ No newline at end of file
+        conn.commit()
+
+def is_postgres(conn) -> bool:
+    """Проверяет, что подключение идет к PostgreSQL (задан DATABASE_URL)"""
+    return not isinstance(conn, sqlite3.Connection)
+
+class PortableCursor:
+    """
+    Курсор, принимающий запросы с параметрами ? и для SQLite, и для PostgreSQL
+    (для psycopg2 параметры заменяются на %s)
+    """
+
+    def __init__(self, conn):
+        self._cursor = conn.cursor()
+        self.postgres = is_postgres(conn)
+
+    def _adapt(self, query: str) -> str:
+        return query.replace("?", "%s") if self.postgres else query
+
+    def execute(self, query: str, params=()):
+        self._cursor.execute(self._adapt(query), params)
+        return self
+
+    def executemany(self, query: str, params_list) -> int:
+        """Выполняет запрос для каждого набора параметров и возвращает общее число измененных строк"""
+        query = self._adapt(query)
+        changed = 0
+        for params in params_list:
+            self._cursor.execute(query, params)
+            changed += max(self._cursor.rowcount, 0)
+        return changed
+
+    def begin_write(self):
+        """
+        Начинает транзакцию записи. SQLite блокирует базу сразу (BEGIN IMMEDIATE), в PostgreSQL
+        транзакция начинается автоматически, а строки блокируются через for_update()
+        """
+        if not self.postgres:
+            self._cursor.execute('BEGIN IMMEDIATE')
+
+    def for_update(self, skip_locked: bool = False) -> str:
+        """Окончание SELECT, блокирующее выбранные строки до конца транзакции (только PostgreSQL)"""
+        if not self.postgres:
+            return ""
+        return " FOR UPDATE SKIP LOCKED" if skip_locked else " FOR UPDATE"
+
+    def insert_returning_id(self, query: str, params=()) -> int:
+        """Выполняет INSERT и возвращает id новой строки"""
+        if self.postgres:
+            return self.execute(query + " RETURNING id", params).fetchone()[0]
+        return self.execute(query, params).lastrowid
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def id_column(conn) -> str:
+    """Определение автоинкрементного первичного ключа id"""
+    return "BIGSERIAL PRIMARY KEY" if is_postgres(conn) else "INTEGER PRIMARY KEY AUTOINCREMENT"
@@ -0,0 +1,48 @@
+# Быстрая сериализация больших JSON-ответов.
+# Аналитика по товарам для больших каталогов - это списки из тысяч словарей. Стандартный путь
+# FastAPI сначала обходит весь ответ через jsonable_encoder, а затем сериализует его модулем json.
+# Для таких ответов данные сразу сериализуются через orjson (в несколько раз быстрее и без
+# промежуточных копий). Если orjson не установлен, используется стандартный json.
+# Сравнение вариантов на синтетических данных: python bench_serialization.py
+import json
+from typing import Any, Optional
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Ключи словарей могут быть числами (например, ID товаров), значения - датами
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY) if orjson else 0
+
+def dumps(content: Any) -> bytes:
+    """Сериализует данные в JSON (байты UTF-8)"""
+    if orjson is not None:
+        return orjson.dumps(content, option=ORJSON_OPTIONS, default=str)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+def loads(data: bytes) -> Any:
+    """Разбирает JSON, сериализованный dumps"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse, сериализующий ответ через orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+def json_response(content: Any, response: Optional[Response] = None, status_code: int = 200) -> FastJSONResponse:
+    """
+    Готовый ответ для больших списков и словарей без обхода через jsonable_encoder.
+    Заголовки, установленные обработчиком через параметр response (ETag, Cache-Control), переносятся
+    """
+    result = FastJSONResponse(content, status_code=status_code)
+    if response is not None:
+        for name, value in response.headers.items():
+            if name.lower() not in ("content-length", "content-type"):
+                result.headers[name] = value
+    return result
@@ -0,0 +1,57 @@
+# Условные GET-запросы для аналитики и списка товаров.
+# ETag ответа вычисляется из версии данных пользователя, хеша последней синхронизации с Ozon
+# (см. data_versions.py) и параметров запроса, поэтому его можно проверить до обращения к Ozon: если клиент прислал тот же ETag
+# в If-None-Match, он получает пустой ответ 304 и использует сохраненную копию.
+import os
+import json
+import hashlib
+from typing import Optional
+from fastapi import Request, Response
+from data_versions import get_data_state
+
+# Сколько браузер может использовать ответ без повторной проверки (секунды)
+ANALYTICS_CACHE_MAX_AGE = int(os.getenv("ANALYTICS_CACHE_MAX_AGE", "60"))
+
+def make_etag(*parts) -> str:
+    """Строгий ETag из набора значений"""
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return '"' + hashlib.sha256(serialized.encode()).hexdigest()[:32] + '"'
+
+def user_etag(resource: str, telegram_id: int, **params) -> str:
+    """
+    ETag ресурса пользователя: меняется при изменении данных или параметров запроса.
+    Хеш синхронизации отличает разные данные с одинаковым номером версии (версия - счетчик
+    в базе сервиса и после пересоздания базы начинается заново)
+    """
+    version, data_hash = get_data_state(telegram_id)
+    return make_etag(resource, telegram_id, version, data_hash, params)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Проверяет заголовок If-None-Match (список ETag через запятую или *)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [value.strip() for value in header.split(",")]
+    # Для If-None-Match используется слабое сравнение: префикс W/ не учитывается
+    return "*" in candidates or etag in [value[2:] if value.startswith("W/") else value for value in candidates]
+
+def cache_headers(etag: str, max_age: int = ANALYTICS_CACHE_MAX_AGE) -> dict:
+    """Заголовки кеширования ответа с данными конкретного пользователя"""
+    return {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={max_age}",
+        "Vary": "X-API-Key",
+    }
+
+def conditional_response(request: Request, response: Response, etag: Optional[str]) -> Optional[Response]:
+    """
+    Добавляет заголовки кеширования к ответу. Если у клиента уже есть актуальная копия,
+    возвращает ответ 304, который нужно отдать вместо расчета данных
+    """
+    if etag is None:
+        return None
+    headers = cache_headers(etag)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
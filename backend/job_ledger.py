@@ -0,0 +1,276 @@
+# Журнал запусков периодических задач.
+# Для каждого запуска (update_all_users_data, send_daily_reports, check_metrics) сохраняются
+# время начала и окончания и итоговые счетчики, а для каждого пользователя - длительность,
+# число обращений к API Ozon, объем полученных данных, число повторов и класс ошибки.
+#
+# Просмотр из консоли:
+#   python job_ledger.py list [--job update_all_users_data] [--limit 20]
+#   python job_ledger.py show RUN_ID [--top 10]
+import json
+import time
+import argparse
+from datetime import datetime
+from typing import Optional
+from database import get_db, PortableCursor, id_column
+
+def init_job_ledger_tables():
+    """Создает таблицы запусков задач и результатов по пользователям"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS job_runs (
+                id {id_column(conn)},
+                job_name TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                started_at DOUBLE PRECISION NOT NULL,
+                finished_at DOUBLE PRECISION,
+                total_items INTEGER DEFAULT 0,
+                success_count INTEGER DEFAULT 0,
+                error_count INTEGER DEFAULT 0,
+                details TEXT
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS job_run_items (
+                id {id_column(conn)},
+                run_id BIGINT NOT NULL,
+                telegram_id BIGINT,
+                status TEXT NOT NULL,
+                started_at DOUBLE PRECISION NOT NULL,
+                duration_ms DOUBLE PRECISION NOT NULL,
+                ozon_calls INTEGER DEFAULT 0,
+                bytes_fetched INTEGER DEFAULT 0,
+                retries INTEGER DEFAULT 0,
+                error_class TEXT,
+                endpoints TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_job_runs_name ON job_runs (job_name, started_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_job_run_items_run ON job_run_items (run_id)')
+        conn.commit()
+
+def start_run(job_name: str) -> int:
+    """Регистрирует начало запуска задачи и возвращает его идентификатор"""
+    init_job_ledger_tables()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        run_id = cursor.insert_returning_id(
+            'INSERT INTO job_runs (job_name, status, started_at) VALUES (?, ?, ?)',
+            (job_name, 'running', time.time())
+        )
+        conn.commit()
+        return run_id
+
+def finish_run(run_id: int, status: str = "success", total_items: int = 0,
+               success_count: int = 0, error_count: int = 0, details: Optional[dict] = None):
+    """Отмечает окончание запуска задачи с итоговыми счетчиками"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            UPDATE job_runs
+            SET status = ?, finished_at = ?, total_items = ?, success_count = ?, error_count = ?, details = ?
+            WHERE id = ?
+        ''', (
+            status,
+            time.time(),
+            total_items,
+            success_count,
+            error_count,
+            json.dumps(details, ensure_ascii=False, default=str) if details else None,
+            run_id
+        ))
+        conn.commit()
+
+def record_item(run_id: int, telegram_id: Optional[int], status: str, started_at: float,
+                call_stats: Optional[dict] = None, retries: int = 0, error: Optional[Exception] = None):
+    """
+    Сохраняет результат обработки одного пользователя в рамках запуска.
+    call_stats - статистика обращений к Ozon из ozon_api.start_call_tracking()
+    """
+    call_stats = call_stats or {}
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            INSERT INTO job_run_items
+                (run_id, telegram_id, status, started_at, duration_ms, ozon_calls, bytes_fetched, retries, error_class, endpoints)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            run_id,
+            telegram_id,
+            status,
+            started_at,
+            (time.time() - started_at) * 1000,
+            call_stats.get("calls", 0),
+            call_stats.get("bytes", 0),
+            retries + call_stats.get("retries", 0),
+            type(error).__name__ if error is not None else None,
+            json.dumps(call_stats.get("endpoints", {})),
+        ))
+        conn.commit()
+
+def _run_to_dict(row) -> dict:
+    started_at, finished_at = row[3], row[4]
+    return {
+        "id": row[0],
+        "job_name": row[1],
+        "status": row[2],
+        "started_at": datetime.fromtimestamp(started_at).isoformat(),
+        "finished_at": datetime.fromtimestamp(finished_at).isoformat() if finished_at else None,
+        "duration_seconds": round(finished_at - started_at, 2) if finished_at else None,
+        "total_items": row[5],
+        "success_count": row[6],
+        "error_count": row[7],
+        "details": json.loads(row[8]) if row[8] else None,
+    }
+
+def list_runs(job_name: Optional[str] = None, limit: int = 20) -> list:
+    """Возвращает последние запуски задач (всех или одной задачи)"""
+    init_job_ledger_tables()
+    query = '''
+        SELECT id, job_name, status, started_at, finished_at, total_items, success_count, error_count, details
+        FROM job_runs
+    '''
+    params = []
+    if job_name:
+        query += ' WHERE job_name = ?'
+        params.append(job_name)
+    query += ' ORDER BY id DESC LIMIT ?'
+    params.append(limit)
+
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute(query, params)
+        return [_run_to_dict(row) for row in cursor.fetchall()]
+
+def get_run_report(run_id: int, top: int = 10) -> Optional[dict]:
+    """
+    Возвращает отчет по запуску: итоги, самых медленных пользователей,
+    статистику по эндпоинтам Ozon и распределение ошибок по классам
+    """
+    init_job_ledger_tables()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            SELECT id, job_name, status, started_at, finished_at, total_items, success_count, error_count, details
+            FROM job_runs
+            WHERE id = ?
+        ''', (run_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+
+        cursor.execute('''
+            SELECT telegram_id, status, duration_ms, ozon_calls, bytes_fetched, retries, error_class, endpoints
+            FROM job_run_items
+            WHERE run_id = ?
+            ORDER BY duration_ms DESC
+        ''', (run_id,))
+        items = cursor.fetchall()
+
+    report = _run_to_dict(row)
+
+    durations = sorted(item[2] for item in items)
+    report["items"] = {
+        "count": len(items),
+        "ozon_calls": sum(item[3] for item in items),
+        "bytes_fetched": sum(item[4] for item in items),
+        "retries": sum(item[5] for item in items),
+        "avg_duration_ms": round(sum(durations) / len(durations), 1) if durations else 0,
+        "p95_duration_ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 1) if durations else 0,
+    }
+
+    report["slowest_users"] = [
+        {
+            "telegram_id": item[0],
+            "status": item[1],
+            "duration_ms": round(item[2], 1),
+            "ozon_calls": item[3],
+            "bytes_fetched": item[4],
+            "retries": item[5],
+            "error_class": item[6],
+        }
+        for item in items[:top]
+    ]
+
+    # Суммируем статистику по эндпоинтам Ozon по всем пользователям
+    endpoints = {}
+    errors = {}
+    for item in items:
+        for path, stats in json.loads(item[7] or "{}").items():
+            total = endpoints.setdefault(path, {"calls": 0, "total_ms": 0.0, "bytes": 0})
+            total["calls"] += stats["calls"]
+            total["total_ms"] += stats["total_ms"]
+            total["bytes"] += stats["bytes"]
+        if item[6]:
+            errors[item[6]] = errors.get(item[6], 0) + 1
+
+    report["slowest_endpoints"] = sorted(
+        [
+            {
+                "endpoint": path,
+                "calls": stats["calls"],
+                "total_ms": round(stats["total_ms"], 1),
+                "avg_ms": round(stats["total_ms"] / stats["calls"], 1) if stats["calls"] else 0,
+                "bytes": stats["bytes"],
+            }
+            for path, stats in endpoints.items()
+        ],
+        key=lambda e: e["total_ms"],
+        reverse=True
+    )[:top]
+    report["errors_by_class"] = errors
+
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Журнал запусков периодических задач")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="Последние запуски задач")
+    list_parser.add_argument("--job", help="Имя задачи, например update_all_users_data")
+    list_parser.add_argument("--limit", type=int, default=20)
+
+    show_parser = subparsers.add_parser("show", help="Подробный отчет по запуску")
+    show_parser.add_argument("run_id", type=int)
+    show_parser.add_argument("--top", type=int, default=10)
+
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for run in list_runs(args.job, args.limit):
+            duration = f"{run['duration_seconds']}s" if run["duration_seconds"] is not None else "-"
+            print(
+                f"#{run['id']:<6} {run['job_name']:<24} {run['status']:<8} {run['started_at']:<26} "
+                f"{duration:>10}  всего {run['total_items']}, успешно {run['success_count']}, ошибок {run['error_count']}"
+            )
+        return
+
+    report = get_run_report(args.run_id, args.top)
+    if not report:
+        print(f"Запуск #{args.run_id} не найден")
+        return
+
+    print(f"Запуск #{report['id']} {report['job_name']} ({report['status']})")
+    print(f"  начало: {report['started_at']}, окончание: {report['finished_at']}, длительность: {report['duration_seconds']}s")
+    print(f"  пользователей: {report['items']['count']}, обращений к Ozon: {report['items']['ozon_calls']}, "
+          f"получено байт: {report['items']['bytes_fetched']}, повторов: {report['items']['retries']}")
+    print(f"  среднее время: {report['items']['avg_duration_ms']} мс, p95: {report['items']['p95_duration_ms']} мс")
+
+    print("\nСамые медленные пользователи:")
+    for user in report["slowest_users"]:
+        print(f"  {user['telegram_id']:<14} {user['duration_ms']:>10} мс  {user['status']:<8} "
+              f"вызовов {user['ozon_calls']}, байт {user['bytes_fetched']}, повторов {user['retries']}"
+              + (f", ошибка {user['error_class']}" if user["error_class"] else ""))
+
+    print("\nСамые медленные эндпоинты Ozon:")
+    for endpoint in report["slowest_endpoints"]:
+        print(f"  {endpoint['endpoint']:<40} вызовов {endpoint['calls']:<6} всего {endpoint['total_ms']} мс, "
+              f"в среднем {endpoint['avg_ms']} мс, байт {endpoint['bytes']}")
+
+    if report["errors_by_class"]:
+        print("\nОшибки по классам:")
+        for error_class, count in report["errors_by_class"].items():
+            print(f"  {error_class}: {count}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# Настройка логирования для веб-сервиса, бота и воркеров.
+# Записи не пишутся в stdout из обработчика запроса: QueueHandler кладет их в очередь,
+# а отдельный поток QueueListener форматирует их в JSON и выводит. Секреты (токены Ozon
+# и Telegram) вырезаются из сообщений и полей. Для частых событий (каждое обновление
+# вебхука) можно включить выборку, чтобы в лог попадала только часть записей.
+#
+# Переменные окружения:
+#   LOG_LEVEL=INFO                                   - уровень по умолчанию
+#   LOG_LEVELS=webhook=WARNING,ozon_api=DEBUG        - уровни отдельных логгеров
+#   LOG_SAMPLING=webhook=0.1                         - доля записей INFO/DEBUG, попадающих в лог
+#   LOG_FORMAT=json|text
+import os
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+# Поля записи, значения которых никогда не выводятся
+SENSITIVE_FIELDS = {"token", "api_token", "ozon_api_token", "api_key", "password", "secret", "authorization"}
+
+# Секреты в тексте сообщений: токен бота Telegram и API-ключ Ozon (UUID)
+SENSITIVE_PATTERNS = [
+    re.compile(r"\b\d{6,12}:[A-Za-z0-9_-]{30,}\b"),
+    re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"),
+]
+
+# Стандартные атрибуты LogRecord - все остальные считаются структурированными полями (extra)
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def redact(text: str) -> str:
+    """Заменяет секреты в тексте на ***"""
+    for pattern in SENSITIVE_PATTERNS:
+        text = pattern.sub("***", text)
+    return text
+
+def _parse_mapping(value: str) -> dict:
+    result = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, setting = item.split("=", 1)
+            result[name.strip()] = setting.strip()
+    return result
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись в одну строку JSON с дополнительными полями из extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key in _RECORD_ATTRIBUTES or key.startswith("_"):
+                continue
+            entry[key] = "***" if key.lower() in SENSITIVE_FIELDS else value
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Обычный текстовый формат для локальной разработки (с вырезанием секретов)"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        return redact(super().format(record))
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только часть записей INFO/DEBUG; предупреждения и ошибки пропускаются всегда"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if random.random() >= self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись в потоке приложения"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирование (и вырезание секретов) выполняет поток QueueListener.
+        # Аргументы сообщения подставляем сразу, чтобы изменяемые объекты не поменялись до вывода
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging(service: Optional[str] = None):
+    """
+    Настраивает корневой логгер: неблокирующий вывод через очередь, JSON-формат,
+    уровни отдельных логгеров и выборку частых событий. Повторный вызов ничего не делает
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [_LazyQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    for name, level in _parse_mapping(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    for name, rate in _parse_mapping(LOG_SAMPLING).items():
+        logging.getLogger(name).addFilter(SamplingFilter(float(rate)))
+
+    # Сторонние библиотеки логируют каждый HTTP-запрос
+    for name in ("httpx", "httpcore", "telegram.ext", "apscheduler"):
+        if name not in LOG_LEVELS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    if service:
+        # Имя сервиса добавляется ко всем записям процесса
+        old_factory = logging.getLogRecordFactory()
+
+        def record_factory(*args, **kwargs):
+            record = old_factory(*args, **kwargs)
+            record.service = service
+            return record
+
+        logging.setLogRecordFactory(record_factory)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток вывода"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,186 @@
+# Конвейер доставки сообщений в Telegram.
+# Ограничивает число одновременных отправок, соблюдает лимиты Telegram
+# (около 30 сообщений в секунду на бота и 1 сообщение в секунду в один чат),
+# повторяет отправку при 429/5xx и сохраняет результат доставки каждого сообщения.
+import logging
+import os
+import asyncio
+import time
+from typing import Dict, List, Optional
+from telegram.error import RetryAfter, TimedOut, NetworkError, Forbidden, BadRequest
+from database import get_db, PortableCursor, id_column
+
+logger = logging.getLogger(__name__)
+
+# Настройки по умолчанию (можно переопределить переменными окружения)
+DELIVERY_CONCURRENCY = int(os.getenv("TELEGRAM_DELIVERY_CONCURRENCY", "20"))
+GLOBAL_RATE_LIMIT = float(os.getenv("TELEGRAM_GLOBAL_RATE_LIMIT", "25"))      # сообщений в секунду на бота
+PER_CHAT_RATE_LIMIT = float(os.getenv("TELEGRAM_PER_CHAT_RATE_LIMIT", "1"))   # сообщений в секунду в один чат
+DELIVERY_MAX_RETRIES = int(os.getenv("TELEGRAM_DELIVERY_MAX_RETRIES", "5"))
+
+class TokenBucket:
+    """Асинхронный token bucket: не более rate операций в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет, пока в ведре появится токен, и забирает его"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def init_notification_log_table():
+    """Создает таблицу с результатами доставки уведомлений"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS notification_log (
+                id {id_column(conn)},
+                chat_id BIGINT NOT NULL,
+                kind TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+
+def save_delivery_results(results: List[dict]):
+    """Сохраняет результаты доставки одним запросом"""
+    if not results:
+        return
+
+    init_notification_log_table()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.executemany('''
+            INSERT INTO notification_log (chat_id, kind, status, attempts, error)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (r["chat_id"], r.get("kind"), r["status"], r["attempts"], r.get("error"))
+            for r in results
+        ])
+        conn.commit()
+
+class DeliveryPipeline:
+    """Отправляет сообщения через бота с ограничением скорости и повторными попытками"""
+
+    def __init__(
+        self,
+        bot,
+        concurrency: int = DELIVERY_CONCURRENCY,
+        global_rate: float = GLOBAL_RATE_LIMIT,
+        per_chat_rate: float = PER_CHAT_RATE_LIMIT,
+        max_retries: int = DELIVERY_MAX_RETRIES,
+    ):
+        self.bot = bot
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.max_retries = max_retries
+        # Момент, до которого Telegram попросил не отправлять сообщения (ответ 429)
+        self.paused_until = 0.0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, capacity=1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _wait_for_pause(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def deliver(self, chat_id, text: str, parse_mode: str = "HTML", kind: Optional[str] = None) -> dict:
+        """Доставляет одно сообщение и возвращает результат доставки"""
+        attempts = 0
+        error = None
+        retryable = True
+
+        async with self.semaphore:
+            while attempts <= self.max_retries:
+                attempts += 1
+                await self._chat_bucket(chat_id).acquire()
+                await self._wait_for_pause()
+                await self.global_bucket.acquire()
+
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                    return {"chat_id": chat_id, "kind": kind, "status": "sent", "attempts": attempts}
+                except RetryAfter as e:
+                    # Telegram вернул 429 - приостанавливаем все отправки на указанное время
+                    error = f"RetryAfter: {e.retry_after}"
+                    self.paused_until = max(self.paused_until, time.monotonic() + float(e.retry_after))
+                except (Forbidden, BadRequest) as e:
+                    # Пользователь заблокировал бота или сообщение некорректно - повтор не поможет
+                    error = f"{type(e).__name__}: {str(e)}"
+                    retryable = False
+                    break
+                except (TimedOut, NetworkError) as e:
+                    # Сетевые ошибки и ответы 5xx повторяем с экспоненциальной задержкой
+                    error = f"{type(e).__name__}: {str(e)}"
+                    # После последней попытки не ждем: сообщение сразу возвращается как неудачное
+                    if attempts <= self.max_retries:
+                        await asyncio.sleep(min(2 ** attempts, 60))
+                except Exception as e:
+                    error = f"{type(e).__name__}: {str(e)}"
+                    retryable = False
+                    break
+
+        logger.error(f"Не удалось доставить сообщение в чат {chat_id}: {error}")
+        return {
+            "chat_id": chat_id,
+            "kind": kind,
+            "status": "failed",
+            "attempts": attempts,
+            "error": error,
+            "retryable": retryable,
+        }
+
+    async def deliver_many(self, messages: List[dict]) -> dict:
+        """
+        Доставляет список сообщений вида {"chat_id", "text", "kind", "parse_mode"}
+        и возвращает статистику доставки
+        """
+        results = await asyncio.gather(*[
+            self.deliver(
+                message["chat_id"],
+                message["text"],
+                parse_mode=message.get("parse_mode", "HTML"),
+                kind=message.get("kind"),
+            )
+            for message in messages
+        ])
+
+        try:
+            save_delivery_results(results)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении результатов доставки: {str(e)}")
+
+        # Ведра для чатов нужны только на время рассылки
+        self.chat_buckets.clear()
+
+        sent = sum(1 for r in results if r["status"] == "sent")
+        return {
+            "total": len(results),
+            "sent": sent,
+            "failed": len(results) - sent,
+            "results": results,
+        }
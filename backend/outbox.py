@@ -0,0 +1,295 @@
+# Надежная очередь исходящих уведомлений (outbox).
+# Производители (ежедневные отчеты, проверка метрик) пачками записывают сообщения в таблицу outbox,
+# а отправитель забирает их партиями под аренду (lease), доставляет в Telegram
+# и отмечает как отправленные или неудачные. Сообщения переживают перезапуск воркеров,
+# а ключ dedup_key не дает поставить одно и то же сообщение дважды.
+#
+# Доставку выполняет воркер Celery очереди notifications: после задач рассылки и раз в минуту
+# запускается задача deliver_outbox (drain). Веб-сервис держит фоновый отправитель (run_sender),
+# только если задано OUTBOX_SENDER_IN_WEB. Все процессы работают с общей таблицей (DATABASE_URL),
+# а аренда не дает двум отправителям доставить одно сообщение дважды.
+#
+# Запуск отдельного отправителя для локальной разработки: python outbox.py
+import logging
+import os
+import asyncio
+import socket
+import time
+from typing import List, Optional
+from dotenv import load_dotenv
+import telegram_client
+from database import get_db, PortableCursor, id_column
+from notifier import DeliveryPipeline
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+# Сколько секунд задача Celery доставляет сообщения, прежде чем уступить воркер
+OUTBOX_DRAIN_TIME_LIMIT = float(os.getenv("OUTBOX_DRAIN_TIME_LIMIT", "50"))
+
+def init_outbox_table():
+    """Создает таблицу исходящих уведомлений"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id {id_column(conn)},
+                chat_id BIGINT NOT NULL,
+                kind TEXT,
+                text TEXT NOT NULL,
+                parse_mode TEXT DEFAULT 'HTML',
+                dedup_key TEXT UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                lease_owner TEXT,
+                lease_until DOUBLE PRECISION,
+                available_at DOUBLE PRECISION NOT NULL,
+                last_error TEXT,
+                created_at DOUBLE PRECISION NOT NULL,
+                sent_at DOUBLE PRECISION
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, available_at)')
+        conn.commit()
+
+def enqueue_messages(messages: List[dict]) -> int:
+    """
+    Ставит сообщения вида {"chat_id", "text", "kind", "parse_mode", "dedup_key"} в очередь.
+    Сообщения с уже известным dedup_key пропускаются. Возвращает число добавленных сообщений.
+    """
+    if not messages:
+        return 0
+
+    init_outbox_table()
+    now = time.time()
+    with get_db() as conn:
+        added = insert_messages(PortableCursor(conn), messages, now)
+        conn.commit()
+        return added
+
+def insert_messages(cursor: PortableCursor, messages: List[dict], now: Optional[float] = None) -> int:
+    """
+    Добавляет сообщения в очередь в текущей транзакции (фиксирует ее вызывающий код).
+    Так производитель может сохранить свое состояние и сообщения атомарно
+    """
+    now = now or time.time()
+    return cursor.executemany('''
+        INSERT INTO outbox (chat_id, kind, text, parse_mode, dedup_key, status, available_at, created_at)
+        VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
+        ON CONFLICT DO NOTHING
+    ''', [
+        (
+            message["chat_id"],
+            message.get("kind"),
+            message["text"],
+            message.get("parse_mode", "HTML"),
+            message.get("dedup_key"),
+            now,
+            now,
+        )
+        for message in messages
+    ])
+
+def claim_batch(worker_id: str, limit: int = OUTBOX_BATCH_SIZE, lease_seconds: int = OUTBOX_LEASE_SECONDS) -> List[dict]:
+    """
+    Забирает партию сообщений под аренду. Сообщения, аренда которых истекла
+    (отправитель упал, не успев их обработать), забираются повторно.
+    """
+    now = time.time()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        # Блокируем выбранные сообщения, чтобы два отправителя не забрали одни и те же
+        cursor.begin_write()
+        cursor.execute('''
+            SELECT id, chat_id, kind, text, parse_mode, attempts
+            FROM outbox
+            WHERE (status = 'pending' AND available_at <= ?)
+               OR (status = 'sending' AND lease_until < ?)
+            ORDER BY id
+            LIMIT ?
+        ''' + cursor.for_update(skip_locked=True), (now, now, limit))
+        rows = cursor.fetchall()
+
+        if rows:
+            cursor.executemany('''
+                UPDATE outbox
+                SET status = 'sending', lease_owner = ?, lease_until = ?, attempts = attempts + 1
+                WHERE id = ?
+            ''', [(worker_id, now + lease_seconds, row[0]) for row in rows])
+        conn.commit()
+
+    return [
+        {
+            "id": row[0],
+            "chat_id": row[1],
+            "kind": row[2],
+            "text": row[3],
+            "parse_mode": row[4] or "HTML",
+            "attempts": row[5] + 1,
+        }
+        for row in rows
+    ]
+
+def mark_sent(message_ids: List[int]):
+    """Отмечает сообщения как доставленные"""
+    if not message_ids:
+        return
+
+    now = time.time()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.executemany('''
+            UPDATE outbox
+            SET status = 'sent', sent_at = ?, lease_owner = NULL, lease_until = NULL, last_error = NULL
+            WHERE id = ?
+        ''', [(now, message_id) for message_id in message_ids])
+        conn.commit()
+
+def mark_failed(message: dict, error: str, retryable: bool = True):
+    """
+    Возвращает сообщение в очередь с экспоненциальной задержкой
+    или окончательно помечает его неудачным
+    """
+    now = time.time()
+    final = not retryable or message["attempts"] >= OUTBOX_MAX_ATTEMPTS
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            UPDATE outbox
+            SET status = ?, available_at = ?, last_error = ?, lease_owner = NULL, lease_until = NULL
+            WHERE id = ?
+        ''', (
+            'failed' if final else 'pending',
+            now + min(30 * 2 ** message["attempts"], 3600),
+            error,
+            message["id"]
+        ))
+        conn.commit()
+
+def release_leases(worker_id: str) -> int:
+    """Возвращает в очередь сообщения, арендованные указанным отправителем"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            UPDATE outbox
+            SET status = 'pending', lease_owner = NULL, lease_until = NULL
+            WHERE status = 'sending' AND lease_owner = ?
+        ''', (worker_id,))
+        conn.commit()
+        return cursor.rowcount
+
+def get_outbox_metrics() -> dict:
+    """Возвращает глубину очереди по статусам и возраст самого старого ожидающего сообщения"""
+    init_outbox_table()
+    now = time.time()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status')
+        by_status = {row[0]: row[1] for row in cursor.fetchall()}
+
+        cursor.execute("SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')")
+        oldest = cursor.fetchone()[0]
+
+    return {
+        "pending": by_status.get("pending", 0),
+        "sending": by_status.get("sending", 0),
+        "sent": by_status.get("sent", 0),
+        "failed": by_status.get("failed", 0),
+        "depth": by_status.get("pending", 0) + by_status.get("sending", 0),
+        "oldest_pending_age_seconds": round(now - oldest, 1) if oldest else 0,
+    }
+
+async def send_batch(pipeline: DeliveryPipeline, worker_id: str, limit: int = OUTBOX_BATCH_SIZE) -> int:
+    """Забирает и доставляет одну партию сообщений. Возвращает размер партии"""
+    batch = claim_batch(worker_id, limit)
+    if not batch:
+        return 0
+
+    delivery = await pipeline.deliver_many(batch)
+
+    sent_ids = []
+    for message, result in zip(batch, delivery["results"]):
+        if result["status"] == "sent":
+            sent_ids.append(message["id"])
+        else:
+            mark_failed(message, result.get("error") or "unknown error", result.get("retryable", True))
+    mark_sent(sent_ids)
+
+    logger.info(f"Outbox: доставлено {delivery['sent']} из {delivery['total']} сообщений")
+    return len(batch)
+
+def has_due_messages() -> bool:
+    """Есть ли сообщения, которые можно отправить сейчас"""
+    now = time.time()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            SELECT 1 FROM outbox
+            WHERE (status = 'pending' AND available_at <= ?)
+               OR (status = 'sending' AND lease_until < ?)
+            LIMIT 1
+        ''', (now, now))
+        return cursor.fetchone() is not None
+
+async def run_sender(poll_interval: float = OUTBOX_POLL_INTERVAL):
+    """
+    Бесконечный цикл отправителя уведомлений (фоновая задача веб-сервиса).
+    Пул соединений с Telegram не закрывается - его закрывает владелец процесса
+    """
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    init_outbox_table()
+    logger.info(f"Запуск отправителя уведомлений {worker_id}")
+
+    async with telegram_client.create_bot(TELEGRAM_BOT_TOKEN) as bot:
+        # Повторы внутри конвейера короткие - долгие повторы выполняет сама очередь
+        pipeline = DeliveryPipeline(bot, max_retries=2)
+        try:
+            while True:
+                processed = await send_batch(pipeline, worker_id)
+                if not processed:
+                    await asyncio.sleep(poll_interval)
+        finally:
+            release_leases(worker_id)
+
+async def drain(time_limit: float = OUTBOX_DRAIN_TIME_LIMIT) -> int:
+    """
+    Доставляет сообщения, пока очередь не опустеет или не выйдет время (задача Celery).
+    Возвращает число обработанных сообщений
+    """
+    init_outbox_table()
+    if not has_due_messages():
+        return 0
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-drain"
+    deadline = time.monotonic() + time_limit
+    processed = 0
+    async with telegram_client.create_bot(TELEGRAM_BOT_TOKEN) as bot:
+        pipeline = DeliveryPipeline(bot, max_retries=2)
+        try:
+            while time.monotonic() < deadline:
+                count = await send_batch(pipeline, worker_id)
+                if not count:
+                    break
+                processed += count
+        finally:
+            release_leases(worker_id)
+    return processed
+
+async def main():
+    try:
+        await run_sender()
+    finally:
+        await telegram_client.close_client()
+
+if __name__ == "__main__":
+    from logging_setup import setup_logging
+    setup_logging("sender")
+    asyncio.run(main())
@@ -0,0 +1,498 @@
+# Функции для работы с API Ozon Seller.
+# Модуль не зависит от FastAPI-приложения, поэтому его используют и веб-сервис, и воркеры Celery.
+import logging
+import os
+import json
+import time
+import asyncio
+import requests
+import aiohttp
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# Максимум одновременных соединений с API Ozon в общей сессии
+OZON_MAX_CONNECTIONS = int(os.getenv("OZON_MAX_CONNECTIONS", "20"))
+
+# Общие HTTP-сессии с keep-alive. Асинхронная открывается веб-сервисом при запуске (open_session)
+# и привязана к его циклу событий; задачи Celery, у которых свой цикл на каждый запуск,
+# используют временные сессии. Синхронная сессия создается при первом запросе
+_session: Optional[Tuple[asyncio.AbstractEventLoop, aiohttp.ClientSession]] = None
+_sync_session: Optional[requests.Session] = None
+
+# Статистика обращений к API Ozon в рамках текущей задачи (см. start_call_tracking)
+_call_stats: ContextVar[Optional[dict]] = ContextVar("ozon_call_stats", default=None)
+
+class OzonAPIError(HTTPException):
+    """
+    API Ozon ответил ошибкой. Клиенту сервиса возвращается 400, а настоящий код ответа Ozon
+    хранится в ozon_status: по нему задачи Celery решают, имеет ли смысл повторить запрос
+    """
+
+    def __init__(self, ozon_status: int, body: str):
+        super().__init__(status_code=400, detail=f"Ошибка API Ozon: HTTP {ozon_status}: {body}")
+        self.ozon_status = ozon_status
+
+    @property
+    def retryable(self) -> bool:
+        """Повторяем ошибки сервера Ozon и превышение лимита запросов, но не неверные токены"""
+        return self.ozon_status >= 500 or self.ozon_status == 429
+
+def start_call_tracking() -> dict:
+    """
+    Начинает учет обращений к API Ozon в текущем контексте и возвращает словарь статистики:
+    {"calls", "bytes", "retries", "endpoints": {путь: {"calls", "total_ms", "bytes"}}}
+    """
+    stats = {"calls": 0, "bytes": 0, "retries": 0, "endpoints": {}}
+    _call_stats.set(stats)
+    return stats
+
+def record_call(url: str, started: float, size: int, retry: bool = False):
+    """Учитывает одно обращение к API Ozon, если учет включен"""
+    stats = _call_stats.get()
+    if stats is None:
+        return
+
+    path = urlparse(url).path
+    endpoint = stats["endpoints"].setdefault(path, {"calls": 0, "total_ms": 0.0, "bytes": 0})
+    endpoint["calls"] += 1
+    endpoint["total_ms"] += (time.monotonic() - started) * 1000
+    endpoint["bytes"] += size
+
+    stats["calls"] += 1
+    stats["bytes"] += size
+    if retry:
+        stats["retries"] += 1
+
+async def open_session():
+    """Открывает общую сессию aiohttp в текущем цикле событий"""
+    global _session
+    if _session is None:
+        connector = aiohttp.TCPConnector(limit=OZON_MAX_CONNECTIONS)
+        _session = (asyncio.get_running_loop(), aiohttp.ClientSession(connector=connector))
+
+async def close_sessions():
+    """Закрывает общие сессии (при остановке процесса)"""
+    global _session, _sync_session
+    if _session is not None:
+        _, session = _session
+        _session = None
+        await session.close()
+    if _sync_session is not None:
+        _sync_session.close()
+        _sync_session = None
+
+@asynccontextmanager
+async def client_session():
+    """Общая сессия aiohttp, если она открыта в текущем цикле событий, иначе временная"""
+    if _session is not None and _session[0] is asyncio.get_running_loop() and not _session[1].closed:
+        yield _session[1]
+    else:
+        async with aiohttp.ClientSession() as session:
+            yield session
+
+def get_sync_session() -> requests.Session:
+    """Общая синхронная сессия requests (переиспользует соединения)"""
+    global _sync_session
+    if _sync_session is None:
+        _sync_session = requests.Session()
+    return _sync_session
+
+def post_json(url: str, headers: dict, payload: dict, retry: bool = False) -> requests.Response:
+    """Синхронный POST-запрос к API Ozon с учетом обращения"""
+    started = time.monotonic()
+    response = get_sync_session().post(url, headers=headers, json=payload)
+    record_call(url, started, len(response.content), retry=retry)
+    return response
+
+async def get_ozon_products(api_token: str, client_id: str):
+    """Получает список товаров из API Ozon"""
+    
+    # Проверка на тестовые токены
+    if (api_token.lower().startswith('test') or api_token.lower().startswith('demo')):
+        # Возвращаем тестовые данные
+        test_products = {
+            "result": {
+                "items": [
+                    {
+                        "product_id": 123456789,
+                        "offer_id": "TEST-001",
+                        "name": "Тестовый товар 1",
+                        "price": "2990",
+                        "stock": 10,
+                        "status": "active"
+                    },
+                    {
+                        "product_id": 987654321,
+                        "offer_id": "TEST-002",
+                        "name": "Тестовый товар 2",
+                        "price": "4500",
+                        "stock": 5,
+                        "status": "active"
+                    },
+                    {
+                        "product_id": 555555555,
+                        "offer_id": "TEST-003",
+                        "name": "Тестовый товар 3",
+                        "price": "1200",
+                        "stock": 0,
+                        "status": "inactive"
+                    }
+                ],
+                "total": 3
+            }
+        }
+        
+        return test_products
+    
+    # Для реальных токенов делаем запрос к API
+    url = "https://api-seller.ozon.ru/v2/product/list"
+    headers = {
+        "Client-Id": client_id,
+        "Api-Key": api_token,
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "filter": {},
+        "limit": 100,
+        "offset": 0
+    }
+    
+    try:
+        # Используем aiohttp для асинхронного запроса
+        async with client_session() as session:
+            started = time.monotonic()
+            async with session.post(url, json=payload, headers=headers) as response:
+                body = await response.read()
+                record_call(url, started, len(body))
+                if response.status == 200:
+                    return json.loads(body)
+                else:
+                    # Получаем тело ответа с ошибкой
+                    raise OzonAPIError(response.status, body.decode(errors="replace"))
+    except OzonAPIError:
+        # Ozon ответил: повторный запрос другим клиентом даст тот же ответ
+        raise
+    except Exception as e:
+        # Запасной вариант - синхронный запрос через requests (если не удалось соединиться)
+        try:
+            response = post_json(url, headers, payload, retry=True)
+            if response.status_code == 200:
+                return response.json()
+            else:
+                raise OzonAPIError(response.status_code, response.text)
+        except OzonAPIError:
+            raise
+        except Exception as inner_e:
+            raise HTTPException(status_code=500, detail=f"Ошибка при получении товаров: {str(inner_e)}")
+
+async def get_ozon_analytics(api_token: str, client_id: str, period: str = "month"):
+    """Получает аналитику продаж из API Ozon"""
+    
+    # Для тестовых токенов возвращаем тестовые данные
+    if api_token.lower().startswith('test') or api_token.lower().startswith('demo'):
+        logger.info("Используем тестовые данные для аналитики")
+        
+        # Возвращаем тестовые данные для демонстрации
+    return {
+            "status": "success",
+            "period": period,
+            "sales": 24500,
+            "margin": 23.5,
+            "roi": 42.8,
+            "profit": 8250,
+            "total_products": 36,
+            "active_products": 28,
+            "orders": 52,
+            "average_order": 3100,
+            "marketplace_fees": 3675,
+            "advertising_costs": 2200,
+            "sales_data": [15000, 18000, 22000, 24500, 20000, 23000, 24500],
+            "margin_data": [18.5, 20.2, 22.8, 24.1, 23.5, 24.0, 23.5],
+            "roi_data": [33.2, 38.5, 41.2, 43.7, 42.1, 42.5, 42.8]
+        }
+    
+    # Настройка периода для запроса
+    current_date = datetime.now()
+    
+    if period == "week":
+        # Последние 7 дней
+        date_from = (current_date - timedelta(days=7)).strftime("%Y-%m-%d")
+    elif period == "month":
+        # Последние 30 дней
+        date_from = (current_date - timedelta(days=30)).strftime("%Y-%m-%d")
+    elif period == "year":
+        # Последний год
+        date_from = (current_date - timedelta(days=365)).strftime("%Y-%m-%d")
+    else:
+        # По умолчанию - последние 30 дней
+        date_from = (current_date - timedelta(days=30)).strftime("%Y-%m-%d")
+    
+    date_to = current_date.strftime("%Y-%m-%d")
+    
+    # Получаем данные о финансах из Ozon API
+    try:
+        financial_data = await get_ozon_financial_data(api_token, client_id, period)
+        
+        # Формируем ответ на основе финансовых данных
+        return {
+            "status": "success",
+            "period": period,
+            "sales": financial_data.get("sales", 0),
+            "margin": financial_data.get("margin", 0),
+            "roi": financial_data.get("roi", 0),
+            "profit": financial_data.get("profit", 0),
+            "total_products": financial_data.get("total_products", 0),
+            "active_products": financial_data.get("active_products", 0),
+            "orders": financial_data.get("orders", 0),
+            "average_order": financial_data.get("average_order", 0),
+            "marketplace_fees": financial_data.get("marketplace_fees", 0),
+            "advertising_costs": financial_data.get("advertising_costs", 0),
+            "sales_data": financial_data.get("sales_data", []),
+            "margin_data": financial_data.get("margin_data", []),
+            "roi_data": financial_data.get("roi_data", [])
+        }
+    except Exception as e:
+        logger.error(f"Ошибка при получении аналитики: {str(e)}")
+        
+        # В случае ошибки возвращаем базовую структуру с сообщением об ошибке
+        return {
+            "error": True,
+            "message": f"Ошибка при получении аналитики: {str(e)}",
+            "period": period,
+            "sales": 0,
+            "margin": 0,
+            "roi": 0,
+            "profit": 0,
+            "total_products": 0,
+            "active_products": 0,
+            "orders": 0,
+            "average_order": 0,
+            "marketplace_fees": 0,
+            "advertising_costs": 0,
+            "sales_data": [],
+            "margin_data": [],
+            "roi_data": []
+        }
+
+async def get_ozon_advertising_costs(api_token: str, client_id: str, period: str = "month"):
+    """Получает данные о рекламных расходах из API Ozon"""
+    try:
+        # Определяем даты для запроса в зависимости от периода
+        end_date = datetime.now()
+        
+        if period == "week":
+            start_date = end_date - timedelta(days=7)
+        elif period == "month":
+            start_date = end_date - timedelta(days=30)
+        elif period == "year":
+            start_date = end_date - timedelta(days=365)
+        else:  # По умолчанию месяц
+            start_date = end_date - timedelta(days=30)
+        
+        # Форматируем даты для API запроса
+        date_from = start_date.strftime("%Y-%m-%d")
+        date_to = end_date.strftime("%Y-%m-%d")
+        
+        # URL для запроса данных по рекламе
+        url = "https://api-seller.ozon.ru/v1/finance/campaign"
+        
+        # Заголовки запроса
+        headers = {
+            "Client-Id": client_id,
+            "Api-Key": api_token,
+            "Content-Type": "application/json"
+        }
+        
+        # Тело запроса
+        payload = {
+            "date_from": date_from,
+            "date_to": date_to,
+            "pagination": {
+                "limit": 1000,
+                "offset": 0
+            }
+        }
+        
+        # Отправляем запрос
+        response = post_json(url, headers, payload)
+        
+        if response.status_code != 200:
+            logger.error(f"Ошибка при получении данных по рекламе: {response.status_code} - {response.text}")
+            return {"total_cost": 0, "campaigns": []}
+        
+        data = response.json()
+        
+        # Считаем общие расходы на рекламу
+        total_cost = 0
+        campaigns = []
+        
+        if "result" in data and "campaigns" in data["result"]:
+            for campaign in data["result"]["campaigns"]:
+                cost = campaign.get("cost", 0)
+                total_cost += cost
+                campaigns.append({
+                    "campaign_id": campaign.get("campaign_id", ""),
+                    "name": campaign.get("name", ""),
+                    "cost": cost
+                })
+        
+        return {"total_cost": total_cost, "campaigns": campaigns}
+    
+    except Exception as e:
+        logger.error(f"Ошибка при получении данных по рекламе: {str(e)}")
+        return {"total_cost": 0, "campaigns": []}
+
+async def get_ozon_returns_data(api_token: str, client_id: str, period: str = "month"):
+    """Получает данные о возвратах из API Ozon"""
+    try:
+        # Определяем даты для запроса в зависимости от периода
+        end_date = datetime.now()
+        
+        if period == "week":
+            start_date = end_date - timedelta(days=7)
+        elif period == "month":
+            start_date = end_date - timedelta(days=30)
+        elif period == "year":
+            start_date = end_date - timedelta(days=365)
+        else:  # По умолчанию месяц
+            start_date = end_date - timedelta(days=30)
+        
+        # Форматируем даты для API запроса
+        date_from = start_date.strftime("%Y-%m-%d")
+        date_to = end_date.strftime("%Y-%m-%d")
+        
+        # URL для запроса данных по возвратам
+        url = "https://api-seller.ozon.ru/v3/returns/company/fbs"
+        
+        # Заголовки запроса
+        headers = {
+            "Client-Id": client_id,
+            "Api-Key": api_token,
+            "Content-Type": "application/json"
+        }
+        
+        # Тело запроса
+        payload = {
+            "filter": {
+                "date": {
+                    "from": date_from,
+                    "to": date_to
+                }
+            },
+            "limit": 1000,
+            "offset": 0
+        }
+        
+        # Отправляем запрос
+        response = post_json(url, headers, payload)
+        
+        if response.status_code != 200:
+            logger.error(f"Ошибка при получении данных по возвратам: {response.status_code} - {response.text}")
+            return {"total_returns": 0, "total_cost": 0, "returns": []}
+        
+        data = response.json()
+        
+        # Считаем общую сумму возвратов
+        total_returns = 0
+        total_cost = 0
+        returns = []
+        
+        if "result" in data and "returns" in data["result"]:
+            for return_item in data["result"]["returns"]:
+                price = return_item.get("price", 0)
+                total_returns += 1
+                total_cost += price
+                returns.append({
+                    "return_id": return_item.get("id", ""),
+                    "product_id": return_item.get("product_id", ""),
+                    "price": price,
+                    "reason": return_item.get("return_reason", "")
+                })
+        
+        return {
+            "total_returns": total_returns, 
+            "total_cost": total_cost,
+            "returns": returns
+        }
+    
+    except Exception as e:
+        logger.error(f"Ошибка при получении данных по возвратам: {str(e)}")
+        return {"total_returns": 0, "total_cost": 0, "returns": []}
+
+async def get_ozon_financial_data(api_token: str, client_id: str, period: str = "month"):
+    """Получает финансовые данные из API Ozon"""
+    try:
+        # Определяем даты для запроса в зависимости от периода
+        end_date = datetime.now()
+        
+        if period == "week":
+            start_date = end_date - timedelta(days=7)
+        elif period == "month":
+            start_date = end_date - timedelta(days=30)
+        elif period == "year":
+            start_date = end_date - timedelta(days=365)
+        else:  # По умолчанию месяц
+            start_date = end_date - timedelta(days=30)
+        
+        # Форматируем даты для API запроса
+        date_from = start_date.strftime("%Y-%m-%d")
+        date_to = end_date.strftime("%Y-%m-%d")
+        
+        # URL для запроса финансовых данных
+        url = "https://api-seller.ozon.ru/v1/finance/treasury/totals"
+        
+        # Заголовки запроса
+        headers = {
+            "Client-Id": client_id,
+            "Api-Key": api_token,
+            "Content-Type": "application/json"
+        }
+        
+        # Тело запроса
+        payload = {
+            "date_from": date_from,
+            "date_to": date_to
+        }
+        
+        # Отправляем запрос к API Ozon
+        response = post_json(url, headers, payload)
+        
+        # Получаем рекламные расходы
+        ad_data = await get_ozon_advertising_costs(api_token, client_id, period)
+        advertising_costs = ad_data.get("total_cost", 0)
+        
+        # Получаем данные о возвратах
+        returns_data = await get_ozon_returns_data(api_token, client_id, period)
+        returns_cost = returns_data.get("total_cost", 0)
+        
+        if response.status_code != 200:
+            return {
+                "error": True,
+                "message": f"Ошибка при получении финансовых данных: {response.status_code} - {response.text}",
+                "advertising_costs": advertising_costs,
+                "returns_cost": returns_cost
+            }
+        
+        data = response.json()
+        
+        # Дополняем данные рекламными расходами и возвратами
+        data["advertising_costs"] = advertising_costs
+        data["returns_cost"] = returns_cost
+        
+        return data
+    
+    except Exception as e:
+        logger.error(f"Ошибка при получении финансовых данных: {str(e)}")
+        return {
+            "error": True,
+            "message": f"Ошибка при получении финансовых данных: {str(e)}",
+            "advertising_costs": 0,
+            "returns_cost": 0
+        }
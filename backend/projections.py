@@ -0,0 +1,57 @@
+# Выборка полей (sparse fieldsets) для списков товаров и аналитики по товарам.
+# Проверке метрик, боту и компактному списку нужны offer_id, прибыль и маржинальность, а не
+# все поля товара со ссылками на изображения. Параметр fields= задает список полей через
+# запятую, параметр view= - готовый набор (compact или full). Лишние поля отбрасываются
+# до сериализации, поэтому уменьшается и размер ответа, и работа orjson.
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+from fastapi import HTTPException
+
+Fields = Optional[Tuple[str, ...]]
+
+# Поля строки /api/analytics/products (abc_category и profit_percent добавляет ABC-анализ)
+PRODUCT_ANALYTICS_FIELDS = {
+    "product_id", "offer_id", "name", "image", "sales_count", "revenue", "cost", "total_cost",
+    "commission", "ad_cost", "return_cost", "profit", "margin", "roi", "abc_category", "profit_percent",
+}
+
+PRODUCT_ANALYTICS_VIEWS: Dict[str, Fields] = {
+    "compact": ("product_id", "offer_id", "name", "sales_count", "profit", "margin", "roi"),
+    "full": None,
+}
+
+# Товары приходят из Ozon с произвольным набором полей, поэтому список не ограничивается
+PRODUCT_VIEWS: Dict[str, Fields] = {
+    "compact": ("product_id", "offer_id", "name", "price", "cost", "margin_percent"),
+    "full": None,
+}
+
+_FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+def parse_fields(fields: Optional[str], view: Optional[str], views: Dict[str, Fields], allowed: Optional[set] = None) -> Fields:
+    """
+    Разбирает параметры fields и view. Возвращает кортеж полей или None, если нужны все поля.
+    fields имеет приоритет над view; неизвестные поля и наборы - ошибка 400
+    """
+    if fields:
+        names = tuple(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+        invalid = [name for name in names if not _FIELD_NAME.match(name) or (allowed is not None and name not in allowed)]
+        if invalid or not names:
+            raise HTTPException(status_code=400, detail=f"Неизвестные поля: {', '.join(invalid) or fields}")
+        return names
+
+    if view is None:
+        return None
+    if view not in views:
+        raise HTTPException(status_code=400, detail=f"Неизвестный набор полей: {view}. Доступные: {', '.join(views)}")
+    return views[view]
+
+def describe(fields: Fields) -> str:
+    """Строка для ETag: ответы с разными наборами полей кешируются отдельно"""
+    return "full" if fields is None else ",".join(fields)
+
+def project(items: Iterable[dict], fields: Fields) -> List[dict]:
+    """Оставляет в каждом элементе только выбранные поля (отсутствующие пропускаются)"""
+    if fields is None:
+        return items if isinstance(items, list) else list(items)
+    return [{name: item[name] for name in fields if name in item} for item in items]
@@ -0,0 +1,80 @@
+# Общее подключение к Redis и простые блокировки на его основе.
+# Redis уже используется как брокер Celery, поэтому для коротких блокировок
+# (например, "обновление данных пользователя уже выполняется") отдельное хранилище не нужно.
+import logging
+import os
+import asyncio
+from typing import Optional, Tuple
+import redis
+import redis.asyncio
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+_client: Optional[redis.Redis] = None
+# Асинхронный клиент привязан к циклу событий, в котором создан (как пул httpx в telegram_client)
+_async_client: Optional[Tuple[asyncio.AbstractEventLoop, redis.asyncio.Redis]] = None
+
+def get_redis() -> redis.Redis:
+    """Возвращает общий клиент Redis (создается при первом обращении)"""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+    return _client
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """
+    Общий асинхронный клиент Redis для кода в цикле событий: синхронный клиент
+    блокировал бы цикл на время каждого запроса к Redis
+    """
+    global _async_client
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client[0] is not loop:
+        _async_client = (loop, redis.asyncio.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2))
+    return _async_client[1]
+
+def close():
+    """Закрывает подключения к Redis (при остановке процесса)"""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+async def close_async():
+    """Закрывает асинхронный клиент Redis (при остановке веб-процесса)"""
+    global _async_client
+    if _async_client is None:
+        return
+    _, client = _async_client
+    _async_client = None
+    await client.aclose()
+
+def try_acquire(key: str, ttl: int, value: str = "1") -> bool:
+    """
+    Атомарно занимает ключ на ttl секунд (SET NX EX). Возвращает False, если ключ уже занят.
+    Если Redis недоступен, блокировка считается полученной, чтобы не останавливать работу
+    """
+    try:
+        return bool(get_redis().set(key, value, nx=True, ex=ttl))
+    except redis.RedisError as e:
+        logger.info(f"Redis недоступен, блокировка {key} не проверяется: {str(e)}")
+        return True
+
+def release(key: str):
+    """Освобождает ключ, занятый try_acquire"""
+    try:
+        get_redis().delete(key)
+    except redis.RedisError as e:
+        logger.error(f"Не удалось освободить блокировку {key}: {str(e)}")
+
+def is_locked(key: str) -> bool:
+    """Проверяет, занят ли ключ"""
+    try:
+        return bool(get_redis().exists(key))
+    except redis.RedisError:
+        return False
@@ -0,0 +1,174 @@
+# Ход обновления данных пользователя для Mini App (Server-Sent Events).
+# Обновление выполняется в воркере Celery или в веб-процессе, поэтому этапы публикуются
+# в канал Redis пользователя, а события текущего обновления сохраняются списком: клиент,
+# подключившийся в середине обновления, сразу получает уже пройденные этапы.
+# Если Redis недоступен, события доставляются только подписчикам в том же процессе.
+#
+# Этапы: queued -> started -> catalog -> analytics -> abc -> top_product -> done (или error)
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+import redis
+import redis.asyncio
+import redis_store
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранятся события последнего обновления (секунды)
+REFRESH_PROGRESS_TTL = int(os.getenv("REFRESH_PROGRESS_TTL", "600"))
+# Интервал пустых сообщений, чтобы прокси не закрывали соединение без событий
+REFRESH_EVENTS_KEEPALIVE = float(os.getenv("REFRESH_EVENTS_KEEPALIVE", "15"))
+# Максимальная длительность одного подключения к потоку событий
+REFRESH_EVENTS_TIMEOUT = float(os.getenv("REFRESH_EVENTS_TIMEOUT", "300"))
+
+FINAL_STAGES = {"done", "error"}
+
+# Подписчики и события в этом процессе (используются, если Redis недоступен)
+_local_subscribers: Dict[int, Set[asyncio.Queue]] = {}
+_local_events: Dict[int, List[dict]] = {}
+
+def channel_name(telegram_id: int) -> str:
+    return f"refresh:progress:{telegram_id}"
+
+def events_key(telegram_id: int) -> str:
+    return f"refresh:progress:{telegram_id}:events"
+
+def _starts_new_run(stage: str, previous: Optional[dict]) -> bool:
+    """queued всегда начинает новое обновление, started - если ему не предшествовала постановка в очередь"""
+    if stage == "queued":
+        return True
+    return stage == "started" and (previous is None or previous.get("stage") != "queued")
+
+def publish(telegram_id: int, stage: str, **data):
+    """Сообщает подписчикам о завершении этапа обновления данных пользователя"""
+    event = {"stage": stage, "ts": time.time(), **data}
+    payload = json.dumps(event, ensure_ascii=False, default=str)
+    try:
+        client = redis_store.get_redis()
+        key = events_key(telegram_id)
+        last = client.lindex(key, -1)
+        pipe = client.pipeline()
+        if _starts_new_run(stage, json.loads(last) if last else None):
+            pipe.delete(key)
+        pipe.rpush(key, payload)
+        pipe.expire(key, REFRESH_PROGRESS_TTL)
+        pipe.publish(channel_name(telegram_id), payload)
+        pipe.execute()
+        return
+    except redis.RedisError as e:
+        logger.info(f"Redis недоступен, ход обновления {telegram_id} передается только в этом процессе: {str(e)}")
+
+    events = _local_events.setdefault(telegram_id, [])
+    if _starts_new_run(stage, events[-1] if events else None):
+        events.clear()
+    events.append(event)
+    for subscriber in _local_subscribers.get(telegram_id, ()):
+        subscriber.put_nowait(event)
+
+def get_events(telegram_id: int) -> List[dict]:
+    """События текущего (или последнего завершенного) обновления"""
+    try:
+        return [json.loads(item) for item in redis_store.get_redis().lrange(events_key(telegram_id), 0, -1)]
+    except redis.RedisError:
+        return list(_local_events.get(telegram_id, []))
+
+def _replayed(events: List[dict], skip_finished: bool) -> List[dict]:
+    """Уже пройденные этапы для нового подписчика (завершенное обновление - только по запросу)"""
+    if skip_finished and events and events[-1]["stage"] in FINAL_STAGES:
+        return []
+    return events
+
+OnSubscribed = Optional[Callable[[], Awaitable[None]]]
+
+async def _redis_events(telegram_id: int, deadline: float, skip_finished: bool,
+                        on_subscribed: OnSubscribed) -> AsyncIterator[Optional[dict]]:
+    client = redis.asyncio.Redis.from_url(redis_store.REDIS_URL, socket_connect_timeout=2)
+    pubsub = client.pubsub()
+    try:
+        # Подписываемся до чтения сохраненных событий, чтобы не пропустить этап между ними
+        await pubsub.subscribe(channel_name(telegram_id))
+        if on_subscribed is not None:
+            await on_subscribed()
+        seen = set()
+        for event in _replayed(get_events(telegram_id), skip_finished):
+            seen.add((event["stage"], event["ts"]))
+            yield event
+            if event["stage"] in FINAL_STAGES:
+                return
+
+        while time.monotonic() < deadline:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=REFRESH_EVENTS_KEEPALIVE)
+            if message is None:
+                yield None
+                continue
+            event = json.loads(message["data"])
+            if (event["stage"], event["ts"]) in seen:
+                continue
+            yield event
+            if event["stage"] in FINAL_STAGES:
+                return
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
+
+async def _local_events_stream(telegram_id: int, deadline: float, skip_finished: bool,
+                               on_subscribed: OnSubscribed) -> AsyncIterator[Optional[dict]]:
+    subscriber: asyncio.Queue = asyncio.Queue()
+    _local_subscribers.setdefault(telegram_id, set()).add(subscriber)
+    try:
+        if on_subscribed is not None:
+            await on_subscribed()
+        for event in _replayed(list(_local_events.get(telegram_id, [])), skip_finished):
+            yield event
+            if event["stage"] in FINAL_STAGES:
+                return
+
+        while time.monotonic() < deadline:
+            try:
+                event = await asyncio.wait_for(subscriber.get(), timeout=REFRESH_EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            yield event
+            if event["stage"] in FINAL_STAGES:
+                return
+    finally:
+        subscribers = _local_subscribers.get(telegram_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del _local_subscribers[telegram_id]
+
+async def subscribe(telegram_id: int, skip_finished: bool = False,
+                    on_subscribed: OnSubscribed = None) -> AsyncIterator[Optional[dict]]:
+    """
+    События обновления данных пользователя: сначала уже пройденные этапы, затем новые
+    до done/error. None означает, что за REFRESH_EVENTS_KEEPALIVE секунд событий не было.
+    skip_finished - не повторять уже завершенное обновление, а ждать следующего
+    (клиент подписывается до того, как запросить обновление).
+    on_subscribed вызывается, как только подписка начала принимать события, - в нем
+    можно запросить обновление, не рискуя пропустить его этапы
+    """
+    deadline = time.monotonic() + REFRESH_EVENTS_TIMEOUT
+    try:
+        redis_store.get_redis().ping()
+    except redis.RedisError:
+        stream = _local_events_stream(telegram_id, deadline, skip_finished, on_subscribed)
+    else:
+        stream = _redis_events(telegram_id, deadline, skip_finished, on_subscribed)
+
+    try:
+        async for event in stream:
+            yield event
+    finally:
+        # Клиент мог отключиться раньше: закрываем подписку сразу, а не при сборке мусора
+        await stream.aclose()
+
+def format_sse(event: Optional[dict]) -> str:
+    """Сообщение в формате text/event-stream (None - комментарий для поддержания соединения)"""
+    if event is None:
+        return ": keepalive\n\n"
+    return f"event: {event['stage']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
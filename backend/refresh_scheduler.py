@@ -0,0 +1,247 @@
+# Планировщик ночного обновления данных пользователей.
+# Вместо одновременного обновления всех продавцов в 02:00 у каждого пользователя есть свое
+# сохраненное время следующего обновления. Время распределяется по ночному окну по хешу
+# Telegram ID, активные продавцы обновляются раньше и чаще, давно не заходившие - реже.
+# Подписчики ежедневных отчетов обновляются каждую ночь: их отчеты готовятся при обновлении.
+# Периодическая задача dispatch_due_refreshes (celery_app.py) раз в несколько минут
+# забирает пользователей, чье время подошло, и ставит задачи обновления.
+import os
+import time
+import sqlite3
+import hashlib
+from datetime import datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo
+import psycopg2
+from database import get_db, PortableCursor
+
+# Часовой пояс расписания; его же использует Celery beat (celery_app.conf.timezone),
+# поэтому окно обновления и рассылка отчетов считаются в одном времени независимо от сервера
+SCHEDULE_TIMEZONE_NAME = os.getenv("SCHEDULE_TIMEZONE", "Europe/Moscow")
+SCHEDULE_TIMEZONE = ZoneInfo(SCHEDULE_TIMEZONE_NAME)
+
+# Окно ночного обновления (часы в SCHEDULE_TIMEZONE); должно заканчиваться до рассылки отчетов в 09:00
+REFRESH_WINDOW_START_HOUR = int(os.getenv("REFRESH_WINDOW_START_HOUR", "1"))
+REFRESH_WINDOW_END_HOUR = int(os.getenv("REFRESH_WINDOW_END_HOUR", "7"))
+
+# Пороги активности по времени последнего входа (user_tokens.last_updated)
+REFRESH_ACTIVE_DAYS = int(os.getenv("REFRESH_ACTIVE_DAYS", "7"))
+REFRESH_IDLE_DAYS = int(os.getenv("REFRESH_IDLE_DAYS", "30"))
+
+# Интервалы обновления для групп пользователей (в днях)
+REFRESH_INTERVAL_DAYS = {
+    "active": 1,
+    "idle": int(os.getenv("REFRESH_IDLE_INTERVAL_DAYS", "2")),
+    "dormant": int(os.getenv("REFRESH_DORMANT_INTERVAL_DAYS", "7")),
+}
+
+# Доля окна, отведенная активным пользователям: они обновляются в начале окна
+ACTIVE_WINDOW_SHARE = 0.5
+
+def init_refresh_schedule_table():
+    """Создает таблицу расписания обновления данных пользователей"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS refresh_schedule (
+                telegram_id BIGINT PRIMARY KEY,
+                tier TEXT NOT NULL DEFAULT 'active',
+                next_run_at DOUBLE PRECISION NOT NULL,
+                last_dispatched_at DOUBLE PRECISION,
+                last_refreshed_at DOUBLE PRECISION
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_refresh_schedule_next ON refresh_schedule (next_run_at)')
+        conn.commit()
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+def now_local() -> datetime:
+    """Текущее время в часовом поясе расписания"""
+    return datetime.now(SCHEDULE_TIMEZONE)
+
+def get_activity_tier(last_active: Optional[datetime], now: Optional[datetime] = None) -> str:
+    """Определяет группу пользователя по времени последней активности"""
+    if last_active is None:
+        # Время активности неизвестно - считаем пользователя активным, чтобы не отстали данные
+        return "active"
+
+    # CURRENT_TIMESTAMP в базе хранится в UTC
+    idle_days = ((now or datetime.utcnow()) - last_active).total_seconds() / 86400
+    if idle_days <= REFRESH_ACTIVE_DAYS:
+        return "active"
+    if idle_days <= REFRESH_IDLE_DAYS:
+        return "idle"
+    return "dormant"
+
+def _window_offset(telegram_id: int, tier: str) -> float:
+    """Смещение пользователя от начала окна в секундах: стабильное, по хешу Telegram ID"""
+    fraction = int(hashlib.md5(str(telegram_id).encode()).hexdigest(), 16) / 16 ** 32
+    window_seconds = (REFRESH_WINDOW_END_HOUR - REFRESH_WINDOW_START_HOUR) % 24 * 3600 or 24 * 3600
+
+    if tier == "active":
+        return fraction * ACTIVE_WINDOW_SHARE * window_seconds
+    return (ACTIVE_WINDOW_SHARE + fraction * (1 - ACTIVE_WINDOW_SHARE)) * window_seconds
+
+def compute_next_run(telegram_id: int, tier: str, after: datetime, days: int = 0) -> datetime:
+    """
+    Возвращает ближайшее время обновления пользователя в ночном окне,
+    наступающее не раньше чем через days дней после after (after - время в SCHEDULE_TIMEZONE)
+    """
+    offset = timedelta(seconds=_window_offset(telegram_id, tier))
+    window_start = after.replace(hour=REFRESH_WINDOW_START_HOUR, minute=0, second=0, microsecond=0)
+    if window_start > after:
+        window_start -= timedelta(days=1)
+
+    candidate = window_start + timedelta(days=days) + offset
+    while candidate <= after:
+        candidate += timedelta(days=1)
+    return candidate
+
+def _load_user_activity() -> dict:
+    """Возвращает {telegram_id: время последней активности} для пользователей с токенами"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute("SELECT telegram_id, last_updated FROM user_tokens")
+        return {row[0]: _parse_timestamp(row[1]) for row in cursor.fetchall()}
+
+def _load_daily_report_subscribers() -> set:
+    """Telegram ID пользователей, включивших ежедневные отчеты"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        try:
+            cursor.execute("SELECT telegram_id FROM notification_settings WHERE daily_report = 1")
+        except (sqlite3.OperationalError, psycopg2.ProgrammingError):
+            # Таблица настроек еще не создана - подписчиков нет
+            return set()
+        return {row[0] for row in cursor.fetchall()}
+
+def get_user_tier(telegram_id: int, last_active: Optional[datetime], subscribers: set) -> str:
+    """
+    Группа пользователя в расписании. Подписчики ежедневных отчетов не переводятся
+    в редкие группы: отчет готовится при ночном обновлении и без него не будет отправлен
+    """
+    if telegram_id in subscribers:
+        return "active"
+    return get_activity_tier(last_active)
+
+def sync_schedule() -> dict:
+    """
+    Приводит расписание в соответствие с таблицей пользователей: добавляет новых,
+    удаляет пользователей без токенов и переводит пользователей между группами активности
+    """
+    init_refresh_schedule_table()
+    activity = _load_user_activity()
+    subscribers = _load_daily_report_subscribers()
+    now = now_local()
+
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute("SELECT telegram_id, tier, next_run_at FROM refresh_schedule")
+        scheduled = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+        added = []
+        retiered = []
+        for telegram_id, last_active in activity.items():
+            tier = get_user_tier(telegram_id, last_active, subscribers)
+            if telegram_id not in scheduled:
+                # Новый пользователь обновляется в ближайшее ночное окно
+                added.append((telegram_id, tier, compute_next_run(telegram_id, tier, now).timestamp()))
+            elif scheduled[telegram_id][0] != tier:
+                # Вернувшийся продавец не ждет окончания долгого интервала
+                next_run_at = scheduled[telegram_id][1]
+                if tier == "active":
+                    next_run_at = min(next_run_at, compute_next_run(telegram_id, tier, now).timestamp())
+                retiered.append((tier, next_run_at, telegram_id))
+
+        removed = [(telegram_id,) for telegram_id in scheduled if telegram_id not in activity]
+
+        cursor.executemany(
+            'INSERT INTO refresh_schedule (telegram_id, tier, next_run_at) VALUES (?, ?, ?)',
+            added
+        )
+        cursor.executemany(
+            'UPDATE refresh_schedule SET tier = ?, next_run_at = ? WHERE telegram_id = ?',
+            retiered
+        )
+        cursor.executemany('DELETE FROM refresh_schedule WHERE telegram_id = ?', removed)
+        conn.commit()
+
+    return {"added": len(added), "retiered": len(retiered), "removed": len(removed)}
+
+def claim_due_users(limit: int = 500) -> list:
+    """
+    Забирает пользователей, чье время обновления подошло (сначала активных),
+    и сразу переносит их следующее обновление на интервал их группы.
+    Возвращает список Telegram ID
+    """
+    init_refresh_schedule_table()
+    now = now_local()
+
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        # Блокируем записи, чтобы два диспетчера не забрали одних и тех же пользователей
+        cursor.begin_write()
+        cursor.execute('''
+            SELECT telegram_id, tier
+            FROM refresh_schedule
+            WHERE next_run_at <= ?
+            ORDER BY CASE tier WHEN 'active' THEN 0 WHEN 'idle' THEN 1 ELSE 2 END, next_run_at
+            LIMIT ?
+        ''' + cursor.for_update(skip_locked=True), (now.timestamp(), limit))
+        rows = cursor.fetchall()
+
+        cursor.executemany('''
+            UPDATE refresh_schedule
+            SET next_run_at = ?, last_dispatched_at = ?
+            WHERE telegram_id = ?
+        ''', [
+            (
+                compute_next_run(telegram_id, tier, now, REFRESH_INTERVAL_DAYS.get(tier, 1)).timestamp(),
+                now.timestamp(),
+                telegram_id
+            )
+            for telegram_id, tier in rows
+        ])
+        conn.commit()
+
+    return [row[0] for row in rows]
+
+def mark_refreshed(telegram_id: int):
+    """Запоминает время успешного обновления данных пользователя"""
+    init_refresh_schedule_table()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute(
+            'UPDATE refresh_schedule SET last_refreshed_at = ? WHERE telegram_id = ?',
+            (time.time(), telegram_id)
+        )
+        conn.commit()
+
+def get_schedule_overview() -> dict:
+    """Сводка расписания: число пользователей по группам и ближайшие обновления по часам"""
+    init_refresh_schedule_table()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('SELECT tier, COUNT(*) FROM refresh_schedule GROUP BY tier')
+        by_tier = {row[0]: row[1] for row in cursor.fetchall()}
+
+        cursor.execute('SELECT next_run_at FROM refresh_schedule WHERE next_run_at <= ?', (time.time() + 86400,))
+        by_hour = {}
+        for (next_run_at,) in cursor.fetchall():
+            hour = datetime.fromtimestamp(next_run_at, SCHEDULE_TIMEZONE).strftime("%Y-%m-%d %H:00")
+            by_hour[hour] = by_hour.get(hour, 0) + 1
+
+    return {
+        "window": f"{REFRESH_WINDOW_START_HOUR:02d}:00-{REFRESH_WINDOW_END_HOUR:02d}:00 {SCHEDULE_TIMEZONE_NAME}",
+        "users_by_tier": by_tier,
+        "next_24h_by_hour": dict(sorted(by_hour.items())),
+    }
@@ -0,0 +1,708 @@
+# Сервисные функции фоновых задач: обновление данных, ежедневные отчеты и проверка метрик.
+# Воркеры Celery вызывают их напрямую, без HTTP-запросов к веб-сервису.
+# Уведомления не отправляются отсюда напрямую, а ставятся в очередь outbox.
+import os
+import logging
+import json
+import sqlite3
+import psycopg2
+import time
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+from database import get_db, PortableCursor
+from outbox import enqueue_messages, insert_messages, init_outbox_table
+from data_versions import (
+    compute_data_hash,
+    get_data_version,
+    record_sync,
+    save_snapshot,
+    get_snapshot,
+    init_data_versions_tables,
+)
+from job_ledger import record_item
+import refresh_progress
+import refresh_scheduler
+from ozon_api import (
+    start_call_tracking,
+    get_ozon_products,
+    get_ozon_analytics,
+    get_ozon_advertising_costs,
+    get_ozon_returns_data,
+)
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Сколько дней хранятся подготовленные ежедневные отчеты
+DAILY_REPORTS_KEEP_DAYS = int(os.getenv("DAILY_REPORTS_KEEP_DAYS", "7"))
+
+def get_all_user_ids() -> list:
+    """Возвращает Telegram ID всех пользователей с сохраненными токенами"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute("SELECT telegram_id FROM user_tokens")
+        return [row[0] for row in cursor.fetchall()]
+
+def get_user_credentials(telegram_id: int) -> Optional[Tuple[str, str]]:
+    """Возвращает пару (API токен, Client ID) пользователя или None"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute(
+            "SELECT ozon_api_token, ozon_client_id FROM user_tokens WHERE telegram_id = ?",
+            (telegram_id,)
+        )
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else None
+
+def product_items(products_data) -> list:
+    """Список товаров из ответа Ozon /v2/product/list (или уже готовый список)"""
+    if isinstance(products_data, dict):
+        return products_data.get("result", {}).get("items", [])
+    return products_data or []
+
+def product_sales(analytics, product_id) -> Tuple[int, float]:
+    """
+    Продажи товара за период (количество, выручка). Сводная аналитика Ozon (словарь)
+    разбивки по товарам не содержит - тогда продаж товара нет
+    """
+    rows = analytics if isinstance(analytics, list) else []
+    sales_data = next((item for item in rows if item.get("product_id") == product_id), None)
+    if not sales_data:
+        return 0, 0
+    return sales_data.get("sales_count", 0), sales_data.get("revenue", 0)
+
+def product_profit(revenue: float, sales_count: int, cost: float, commission: float = 0,
+                   ad_cost: float = 0, return_cost: float = 0) -> dict:
+    """
+    Прибыль и рентабельность товара за период с учетом себестоимости проданных единиц,
+    комиссий, рекламы и возвратов. Общий расчет для /api/analytics/products и главного экрана
+    """
+    total_costs = (cost * sales_count) + commission + ad_cost + return_cost
+    profit = revenue - total_costs
+    return {
+        "total_cost": cost * sales_count,
+        "profit": profit,
+        "margin": (profit / revenue * 100) if revenue > 0 else 0,
+        "roi": (profit / total_costs * 100) if total_costs > 0 else 0,
+    }
+
+# Функция для проведения ABC-анализа товаров
+async def perform_abc_analysis(products_data: list) -> list:
+    """
+    Классифицирует товары по их вкладу в прибыль:
+    A - топ 20% товаров (высокий вклад в прибыль)
+    B - средние 30% товаров
+    C - остальные 50% товаров
+    """
+    if not products_data:
+        return []
+    
+    # Сортируем товары по прибыли в порядке убывания
+    sorted_products = sorted(products_data, key=lambda x: x.get('profit', 0), reverse=True)
+    
+    # Считаем общую прибыль
+    total_profit = sum(p.get('profit', 0) for p in sorted_products)
+    
+    # Если общая прибыль нулевая, всё в категории C
+    if total_profit <= 0:
+        for product in sorted_products:
+            product['abc_category'] = 'C'
+            product['profit_percent'] = 0
+        return sorted_products
+    
+    cumulative_profit = 0
+    cumulative_percent = 0
+    
+    # Проходим по всем товарам и присваиваем категории
+    for product in sorted_products:
+        profit = product.get('profit', 0)
+        profit_percent = (profit / total_profit) * 100 if total_profit > 0 else 0
+        cumulative_profit += profit
+        cumulative_percent = (cumulative_profit / total_profit) * 100 if total_profit > 0 else 0
+        
+        # Присваиваем категорию ABC
+        if cumulative_percent <= 20:
+            category = 'A'
+        elif cumulative_percent <= 50:
+            category = 'B'
+        else:
+            category = 'C'
+        
+        # Добавляем информацию в объект товара
+        product['abc_category'] = category
+        product['profit_percent'] = profit_percent
+        product['cumulative_percent'] = cumulative_percent
+    
+    return sorted_products
+
+async def build_dashboard(api_token: str, client_id: str, period: str = "month", costs: Optional[dict] = None,
+                          page_size: int = 50, summary: Optional[dict] = None) -> dict:
+    """
+    Данные главного экрана Mini App за один запрос: сводка, первая страница товаров,
+    самый прибыльный товар и ABC-статистика. costs - себестоимость по offer_id.
+    summary - сохраненная при обновлении данных сводка за период (снимок analytics_*).
+    Без нее сводка запрашивается у Ozon вторым запросом: снимков нет у ключей, не связанных
+    с пользователем Telegram, и для периодов, которые не обновляются в фоне.
+    Прибыль товаров считается так же, как в /api/analytics/products (product_profit)
+    """
+    costs = costs or {}
+    if summary is None:
+        products_data, summary = await asyncio.gather(
+            get_ozon_products(api_token, client_id),
+            get_ozon_analytics(api_token, client_id, period),
+        )
+    else:
+        products_data = await get_ozon_products(api_token, client_id)
+    items = product_items(products_data)
+    
+    # Реклама в аналитике по товарам распределяется поровну между всеми товарами
+    ad_cost = float(summary.get("advertising_costs", 0) or 0) / len(items) if items else 0
+    
+    rows = []
+    top_product = None
+    for item in items:
+        cost = float(costs.get(item.get("offer_id", ""), 0) or 0)
+        price = float(item.get("price", 0) or 0)
+        sales_count, revenue = product_sales(summary, item.get("product_id"))
+        row = {
+            **item,
+            "cost": cost,
+            "margin_percent": round((price - cost) / price * 100, 2) if price > 0 and cost > 0 else 0,
+            "sales_count": sales_count,
+            "revenue": revenue,
+            "ad_cost": ad_cost,
+            **product_profit(revenue, sales_count, cost, ad_cost=ad_cost),
+        }
+        rows.append(row)
+        if top_product is None or row["profit"] > top_product["profit"]:
+            top_product = row
+    
+    # ABC-анализ добавляет категорию к строкам товаров (в том числе на первой странице)
+    classified = await perform_abc_analysis(rows)
+    total_profit = sum(row["profit"] for row in classified)
+    abc = {category: {"count": 0, "profit": 0.0, "profit_percent": 0.0} for category in ("A", "B", "C")}
+    for row in classified:
+        stats = abc[row["abc_category"]]
+        stats["count"] += 1
+        stats["profit"] += row["profit"]
+    for stats in abc.values():
+        stats["profit_percent"] = stats["profit"] / total_profit * 100 if total_profit > 0 else 0
+    
+    if top_product is not None:
+        top_product = {
+            **top_product,
+            "profit_percent": top_product["profit"] / total_profit * 100 if total_profit > 0 else 0,
+        }
+    
+    return {
+        "period": period,
+        "summary": summary,
+        "products": {"items": rows[:page_size], "total": len(rows), "page_size": page_size},
+        "top_product": top_product,
+        "abc": {**abc, "total_products": len(rows), "total_profit": total_profit},
+    }
+
+async def update_top_product(user_id: int):
+    """Обновляет информацию о 'Товаре дня' - самом прибыльном товаре пользователя"""
+    try:
+        conn = sqlite3.connect("ozon.db")
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        # Получаем товар с наибольшей прибылью за последние 30 дней
+        cursor.execute("""
+            SELECT 
+                p.id, p.name, p.offer_id, p.product_id, p.image_url, p.price, p.commission_amount,
+                p.category, p.cost, COUNT(DISTINCT t.id) as sales_count,
+                SUM(t.price) as total_sales,
+                SUM(t.commission_amount) as total_commission,
+                SUM(p.cost) as total_cost,
+                (SUM(t.price) - SUM(t.commission_amount) - (COUNT(DISTINCT t.id) * p.cost)) as profit,
+                ((SUM(t.price) - SUM(t.commission_amount) - (COUNT(DISTINCT t.id) * p.cost)) / SUM(t.price) * 100) as profit_percent,
+                ((SUM(t.price) - SUM(t.commission_amount) - (COUNT(DISTINCT t.id) * p.cost)) / (COUNT(DISTINCT t.id) * p.cost) * 100) as roi
+            FROM products p
+            JOIN transactions t ON p.product_id = t.product_id AND p.user_id = t.user_id
+            WHERE p.user_id = ? AND t.transaction_date >= date('now', '-30 day')
+            GROUP BY p.id
+            ORDER BY profit DESC
+            LIMIT 1
+        """, (user_id,))
+        
+        top_product = cursor.fetchone()
+        
+        if top_product:
+            # Преобразуем строку в словарь
+            top_product_dict = dict(top_product)
+            
+            # Сохраняем информацию о "Товаре дня" в отдельную таблицу
+            cursor.execute("""
+                INSERT OR REPLACE INTO top_product (
+                    user_id, product_id, offer_id, name, image_url, price, 
+                    sales_count, total_sales, profit, profit_percent, roi, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            """, (
+                user_id, top_product_dict["product_id"], top_product_dict["offer_id"],
+                top_product_dict["name"], top_product_dict["image_url"], top_product_dict["price"],
+                top_product_dict["sales_count"], top_product_dict["total_sales"],
+                top_product_dict["profit"], top_product_dict["profit_percent"], top_product_dict["roi"]
+            ))
+            
+            conn.commit()
+        
+        conn.close()
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении 'Товара дня': {str(e)}")
+        return False
+
+async def refresh_user_data(telegram_id: int) -> Optional[dict]:
+    """
+    Обновляет данные одного пользователя и сохраняет рассчитанные показатели.
+    Возвращает None, если у пользователя нет токенов, иначе {"data_changed", "data_version"}.
+    Завершение каждого этапа публикуется для Mini App (см. refresh_progress.py)
+    """
+    # Получаем токены пользователя
+    credentials = get_user_credentials(telegram_id)
+    if not credentials:
+        return None
+    api_token, client_id = credentials
+    
+    refresh_progress.publish(telegram_id, "started")
+    try:
+        result = await _refresh_user_data(telegram_id, api_token, client_id)
+    except Exception as e:
+        refresh_progress.publish(telegram_id, "error", message=str(e))
+        raise
+    
+    refresh_progress.publish(telegram_id, "done", **result)
+    return result
+
+async def _refresh_user_data(telegram_id: int, api_token: str, client_id: str) -> dict:
+    # Обновляем данные о товарах
+    products = await get_ozon_products(api_token, client_id)
+    product_items = products.get("result", {}).get("items", []) if isinstance(products, dict) else products
+    refresh_progress.publish(telegram_id, "catalog", total_products=len(product_items))
+    
+    # Обновляем аналитику за месяц и за день (дневная используется для проверки метрик)
+    analytics = await get_ozon_analytics(api_token, client_id)
+    analytics_day = await get_ozon_analytics(api_token, client_id, "day")
+    refresh_progress.publish(telegram_id, "analytics", summary=analytics)
+    
+    # Обновляем данные о рекламе
+    ad_data = await get_ozon_advertising_costs(api_token, client_id)
+    
+    # Обновляем данные о возвратах
+    returns_data = await get_ozon_returns_data(api_token, client_id)
+    
+    # Обновляем ABC-анализ
+    abc_analysis = await perform_abc_analysis(product_items)
+    abc_counts = {category: 0 for category in ("A", "B", "C")}
+    for product in abc_analysis:
+        abc_counts[product.get("abc_category", "C")] += 1
+    refresh_progress.publish(telegram_id, "abc", counts=abc_counts)
+    
+    # Обновляем топовый товар
+    await update_top_product(telegram_id)
+    refresh_progress.publish(telegram_id, "top_product")
+    
+    # Версия данных увеличивается, только если из Ozon пришли другие данные
+    data_changed = record_sync(
+        telegram_id,
+        compute_data_hash(product_items, analytics, analytics_day, ad_data, returns_data)
+    )
+    data_version = get_data_version(telegram_id)
+    
+    save_snapshot(telegram_id, "analytics_month", analytics, data_version)
+    save_snapshot(telegram_id, "analytics_day", analytics_day, data_version)
+    
+    # Готовим ежедневный отчет заранее, чтобы утренняя рассылка не обращалась к Ozon
+    if is_daily_report_subscriber(telegram_id):
+        render_daily_report(telegram_id, analytics_day)
+    
+    return {"data_changed": data_changed, "data_version": data_version}
+
+async def refresh_all_users() -> dict:
+    """Последовательно обновляет данные всех пользователей"""
+    users = get_all_user_ids()
+    
+    # Счетчики успешных и неудачных обновлений
+    success_count = 0
+    error_count = 0
+    
+    for telegram_id in users:
+        try:
+            if await refresh_user_data(telegram_id):
+                success_count += 1
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении данных для пользователя {telegram_id}: {str(e)}")
+            error_count += 1
+    
+    return {
+        "status": "success",
+        "total_users": len(users),
+        "success_count": success_count,
+        "error_count": error_count
+    }
+
+def format_daily_report(analytics_data: dict) -> str:
+    """Форматирует текст ежедневного отчета"""
+    total_revenue = analytics_data.get("revenue", 0)
+    total_profit = analytics_data.get("profit", 0)
+    margin = analytics_data.get("margin", 0)
+    roi = analytics_data.get("roi", 0)
+    
+    return (
+        f"📊 *Ежедневный отчет*\n\n"
+        f"Выручка: {total_revenue:.2f} ₽\n"
+        f"Прибыль: {total_profit:.2f} ₽\n"
+        f"Маржинальность: {margin:.2f}%\n"
+        f"ROI: {roi:.2f}%\n\n"
+        f"Для более подробной информации откройте приложение."
+    )
+
+def format_data_age(age_seconds: float) -> str:
+    """Возвращает возраст данных в виде "5 мин назад", "3 ч назад" и т.п."""
+    if age_seconds < 60:
+        return "только что"
+    if age_seconds < 3600:
+        return f"{int(age_seconds // 60)} мин назад"
+    if age_seconds < 86400:
+        return f"{int(age_seconds // 3600)} ч назад"
+    return f"{int(age_seconds // 86400)} дн назад"
+
+def format_stats_message(analytics_data: dict, age_seconds: float) -> str:
+    """Форматирует ответ на /stats по сохраненной аналитике (Markdown)"""
+    return (
+        f"*📊 Статистика вашего магазина Ozon*\n\n"
+        f"📆 *Период:* последние 30 дней\n\n"
+        f"• *Продажи:* {analytics_data.get('sales', 0):,.0f} ₽\n"
+        f"• *Прибыль:* {analytics_data.get('profit', 0):,.0f} ₽\n"
+        f"• *Маржинальность:* {analytics_data.get('margin', 0):.1f}%\n"
+        f"• *ROI:* {analytics_data.get('roi', 0):.1f}%\n"
+        f"• *Заказы:* {analytics_data.get('orders', 0)}\n"
+        f"• *Средний чек:* {analytics_data.get('average_order', 0):,.0f} ₽\n"
+        f"• *Комиссии маркетплейса:* {analytics_data.get('marketplace_fees', 0):,.0f} ₽\n"
+        f"• *Реклама:* {analytics_data.get('advertising_costs', 0):,.0f} ₽\n\n"
+        f"🕒 Данные обновлены {format_data_age(age_seconds)}"
+    ).replace(",", " ")
+
+def init_daily_reports_table():
+    """Создает таблицу заранее подготовленных ежедневных отчетов"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_reports (
+                telegram_id BIGINT NOT NULL,
+                report_date TEXT NOT NULL,
+                text TEXT NOT NULL,
+                metrics TEXT,
+                rendered_at DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (telegram_id, report_date)
+            )
+        ''')
+        conn.commit()
+
+def is_daily_report_subscriber(telegram_id: int) -> bool:
+    """Проверяет, включил ли пользователь ежедневные отчеты"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        try:
+            cursor.execute(
+                'SELECT daily_report FROM notification_settings WHERE telegram_id = ?',
+                (telegram_id,)
+            )
+        except (sqlite3.OperationalError, psycopg2.ProgrammingError):
+            # Таблица настроек еще не создана - подписчиков нет
+            return False
+        row = cursor.fetchone()
+        return bool(row and row[0])
+
+def today_report_date() -> str:
+    """Дата отчета в часовом поясе расписания: ночное обновление и утренняя рассылка видят одну дату"""
+    return refresh_scheduler.now_local().strftime("%Y-%m-%d")
+
+def render_daily_report(telegram_id: int, analytics_data: dict, report_date: Optional[str] = None):
+    """Готовит текст ежедневного отчета и сохраняет его для утренней рассылки"""
+    report_date = report_date or today_report_date()
+    # Даты хранятся строками ГГГГ-ММ-ДД, поэтому сравниваются как строки
+    cutoff = (datetime.strptime(report_date, "%Y-%m-%d") - timedelta(days=DAILY_REPORTS_KEEP_DAYS)).strftime("%Y-%m-%d")
+    metrics = {key: analytics_data.get(key, 0) for key in ("revenue", "profit", "margin", "roi")}
+    
+    init_daily_reports_table()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            INSERT INTO daily_reports (telegram_id, report_date, text, metrics, rendered_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (telegram_id, report_date) DO UPDATE SET
+                text = excluded.text, metrics = excluded.metrics, rendered_at = excluded.rendered_at
+        ''', (telegram_id, report_date, format_daily_report(analytics_data), json.dumps(metrics), time.time()))
+        # Старые отчеты больше не нужны
+        cursor.execute(
+            "DELETE FROM daily_reports WHERE telegram_id = ? AND report_date < ?",
+            (telegram_id, cutoff)
+        )
+        conn.commit()
+
+async def send_daily_reports() -> dict:
+    """
+    Ставит в очередь отправки ежедневные отчеты, подготовленные ночным обновлением данных.
+    Обращений к Ozon здесь нет, поэтому время рассылки зависит только от скорости отправки в Telegram
+    """
+    report_date = today_report_date()
+    init_daily_reports_table()
+    
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        # Подписчики ежедневных отчетов и их подготовленные на сегодня отчеты (если есть)
+        cursor.execute('''
+            SELECT n.telegram_id, r.text
+            FROM notification_settings n
+            JOIN user_tokens u ON n.telegram_id = u.telegram_id
+            LEFT JOIN daily_reports r ON r.telegram_id = n.telegram_id AND r.report_date = ?
+            WHERE n.daily_report = 1
+        ''', (report_date,))
+        
+        users = cursor.fetchall()
+    
+    messages = [
+        {
+            "chat_id": telegram_id,
+            "text": text,
+            "kind": "daily_report",
+            "dedup_key": f"daily_report:{telegram_id}:{report_date}"
+        }
+        for telegram_id, text in users
+        if text
+    ]
+    missing_count = len(users) - len(messages)
+    
+    if missing_count:
+        logger.info(f"Не подготовлено ежедневных отчетов: {missing_count} (данные этих пользователей не обновились ночью)")
+    
+    # Ставим все отчеты в очередь одной пачкой
+    queued = enqueue_messages(messages)
+    
+    return {
+        "status": "success",
+        "total_users": len(users),
+        "success_count": queued,
+        "error_count": missing_count
+    }
+
+def init_metric_state_tables():
+    """Создает таблицы состояния проверки метрик"""
+    init_data_versions_tables()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        # Последняя проверка: по какой версии данных и с какими порогами
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS metric_evaluations (
+                telegram_id BIGINT PRIMARY KEY,
+                data_version INTEGER NOT NULL,
+                margin_threshold DOUBLE PRECISION,
+                roi_threshold DOUBLE PRECISION,
+                evaluated_at DOUBLE PRECISION
+            )
+        ''')
+        # Текущее состояние уведомлений: находится ли метрика ниже порога
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS metric_alert_state (
+                telegram_id BIGINT NOT NULL,
+                metric TEXT NOT NULL,
+                in_alert INTEGER NOT NULL DEFAULT 0,
+                value DOUBLE PRECISION,
+                threshold DOUBLE PRECISION,
+                updated_at DOUBLE PRECISION,
+                PRIMARY KEY (telegram_id, metric)
+            )
+        ''')
+        conn.commit()
+
+def get_users_for_metric_check(telegram_ids: Optional[list] = None) -> list:
+    """
+    Возвращает пользователей, у которых изменились данные, себестоимость или пороги
+    с момента последней проверки метрик. Можно ограничить проверку списком пользователей
+    """
+    init_metric_state_tables()
+    query = '''
+        SELECT n.telegram_id, n.margin_threshold, n.roi_threshold, COALESCE(v.version, 0)
+        FROM notification_settings n
+        JOIN user_tokens u ON n.telegram_id = u.telegram_id
+        LEFT JOIN user_data_versions v ON v.telegram_id = n.telegram_id
+        LEFT JOIN metric_evaluations e ON e.telegram_id = n.telegram_id
+        WHERE (e.telegram_id IS NULL
+               OR COALESCE(v.version, 0) > e.data_version
+               OR n.margin_threshold != e.margin_threshold
+               OR n.roi_threshold != e.roi_threshold)
+    '''
+    params = []
+    if telegram_ids is not None:
+        query += f" AND n.telegram_id IN ({', '.join('?' for _ in telegram_ids)})"
+        params = list(telegram_ids)
+    
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+def get_alert_states(telegram_id: int) -> dict:
+    """Возвращает {метрика: находится ли ниже порога} для пользователя"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('SELECT metric, in_alert FROM metric_alert_state WHERE telegram_id = ?', (telegram_id,))
+        return {row[0]: bool(row[1]) for row in cursor.fetchall()}
+
+def save_metric_evaluation(cursor: PortableCursor, telegram_id: int, data_version: int, margin_threshold: float, roi_threshold: float, states: dict):
+    """Сохраняет результат проверки метрик пользователя в текущей транзакции (фиксирует ее вызывающий код)"""
+    now = time.time()
+    cursor.executemany('''
+        INSERT INTO metric_alert_state (telegram_id, metric, in_alert, value, threshold, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (telegram_id, metric) DO UPDATE SET
+            in_alert = excluded.in_alert, value = excluded.value,
+            threshold = excluded.threshold, updated_at = excluded.updated_at
+    ''', [
+        (telegram_id, metric, int(in_alert), value, threshold, now)
+        for metric, (in_alert, value, threshold) in states.items()
+    ])
+    cursor.execute('''
+        INSERT INTO metric_evaluations (telegram_id, data_version, margin_threshold, roi_threshold, evaluated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (telegram_id) DO UPDATE SET
+            data_version = excluded.data_version, margin_threshold = excluded.margin_threshold,
+            roi_threshold = excluded.roi_threshold, evaluated_at = excluded.evaluated_at
+    ''', (telegram_id, data_version, margin_threshold, roi_threshold, now))
+
+def queue_metric_alerts(telegram_id: int, data_version: int, margin_threshold: float, roi_threshold: float, messages: list, states: dict) -> int:
+    """
+    Ставит уведомления пользователя в очередь и сохраняет новое состояние метрик одной транзакцией:
+    при сбое между этими шагами уведомление не потеряется и не будет отправлено повторно
+    """
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        queued = insert_messages(cursor, messages)
+        save_metric_evaluation(cursor, telegram_id, data_version, margin_threshold, roi_threshold, states)
+        conn.commit()
+        return queued
+
+def build_metric_alerts(telegram_id: int, data_version: int, margin_threshold: float, roi_threshold: float, analytics: dict) -> Tuple[list, dict]:
+    """
+    Сравнивает метрики с порогами и возвращает уведомления только о переходах
+    (метрика опустилась ниже порога или вернулась к норме) и новое состояние метрик
+    """
+    current_margin = analytics.get("margin", 0)
+    current_roi = analytics.get("roi", 0)
+    previous = get_alert_states(telegram_id)
+    
+    states = {
+        "margin": (current_margin < margin_threshold, current_margin, margin_threshold),
+        "roi": (current_roi < roi_threshold, current_roi, roi_threshold),
+    }
+    
+    messages = []
+    
+    margin_alert = states["margin"][0]
+    if margin_alert != previous.get("margin", False):
+        if margin_alert:
+            text = (
+                f"⚠️ *Внимание! Низкая маржинальность*\n\n"
+                f"Текущая маржинальность: {current_margin:.2f}%\n"
+                f"Ваш порог: {margin_threshold:.2f}%\n\n"
+                f"Рекомендуем проверить цены и себестоимость товаров."
+            )
+        else:
+            text = (
+                f"✅ *Маржинальность вернулась к норме*\n\n"
+                f"Текущая маржинальность: {current_margin:.2f}%\n"
+                f"Ваш порог: {margin_threshold:.2f}%"
+            )
+        messages.append({
+            "chat_id": telegram_id,
+            "kind": "low_margin" if margin_alert else "margin_recovered",
+            "dedup_key": f"margin:{telegram_id}:{data_version}:{int(margin_alert)}",
+            "text": text
+        })
+    
+    roi_alert = states["roi"][0]
+    if roi_alert != previous.get("roi", False):
+        if roi_alert:
+            text = (
+                f"⚠️ *Внимание! Низкий ROI*\n\n"
+                f"Текущий ROI: {current_roi:.2f}%\n"
+                f"Ваш порог: {roi_threshold:.2f}%\n\n"
+                f"Рекомендуем пересмотреть стратегию продаж и ценообразование."
+            )
+        else:
+            text = (
+                f"✅ *ROI вернулся к норме*\n\n"
+                f"Текущий ROI: {current_roi:.2f}%\n"
+                f"Ваш порог: {roi_threshold:.2f}%"
+            )
+        messages.append({
+            "chat_id": telegram_id,
+            "kind": "low_roi" if roi_alert else "roi_recovered",
+            "dedup_key": f"roi:{telegram_id}:{data_version}:{int(roi_alert)}",
+            "text": text
+        })
+    
+    return messages, states
+
+async def check_metrics(telegram_ids: Optional[list] = None, run_id: Optional[int] = None) -> dict:
+    """
+    Проверяет метрики пользователей, у которых изменились данные с прошлой проверки,
+    и ставит в очередь уведомления о пересечении порогов.
+    Если передан run_id, время проверки каждого пользователя сохраняется в журнал запусков
+    """
+    if telegram_ids is not None and not telegram_ids:
+        return {"status": "success", "total_users": 0, "low_margin_alerts": 0, "low_roi_alerts": 0}
+    
+    users = get_users_for_metric_check(telegram_ids)
+    init_outbox_table()
+    
+    messages = []
+    
+    for telegram_id, margin_threshold, roi_threshold, data_version in users:
+        started_at = time.time()
+        call_stats = start_call_tracking()
+        try:
+            # Используем показатели, рассчитанные при последнем обновлении данных
+            snapshot = get_snapshot(telegram_id, "analytics_day")
+            
+            if snapshot:
+                analytics = snapshot["payload"]
+            else:
+                # Данные пользователя еще не обновлялись - получаем их один раз и сохраняем
+                credentials = get_user_credentials(telegram_id)
+                if not credentials:
+                    continue
+                analytics = await get_ozon_analytics(credentials[0], credentials[1], "day")
+                # Данные получены вне обновления - версия увеличивается, если они новые
+                data_version = save_snapshot(telegram_id, "analytics_day", analytics)
+            
+            if not analytics:
+                continue
+            
+            alerts, states = build_metric_alerts(telegram_id, data_version, margin_threshold, roi_threshold, analytics)
+            queue_metric_alerts(telegram_id, data_version, margin_threshold, roi_threshold, alerts, states)
+            messages.extend(alerts)
+            
+            if run_id:
+                record_item(run_id, telegram_id, "success", started_at, call_stats)
+            
+        except Exception as e:
+            logger.error(f"Ошибка при проверке метрик пользователя {telegram_id}: {str(e)}")
+            if run_id:
+                record_item(run_id, telegram_id, "error", started_at, call_stats, error=e)
+            continue
+    
+    return {
+        "status": "success",
+        "total_users": len(users),
+        "low_margin_alerts": sum(1 for m in messages if m["kind"] == "low_margin"),
+        "low_roi_alerts": sum(1 for m in messages if m["kind"] == "low_roi")
+    }
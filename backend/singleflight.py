@@ -0,0 +1,156 @@
+# Объединение одинаковых тяжелых расчетов (single-flight).
+# Если пользователь открыл Mini App на двух устройствах или бот и приложение одновременно
+# запросили ABC-анализ, аналитика по товарам считается один раз: одновременные запросы с тем же
+# ключом (пользователь, расчет, период) ждут уже идущего расчета и получают его результат.
+# Внутри процесса запросы ждут общего future. Между процессами (несколько воркеров uvicorn)
+# расчет выполняет тот, кто занял короткую аренду в Redis; остальные забирают опубликованный
+# им результат. Если Redis недоступен, объединяются только запросы внутри процесса.
+import os
+import copy
+import time
+import uuid
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+import redis
+import redis.asyncio
+import redis_store
+import fast_json
+
+logger = logging.getLogger(__name__)
+
+# Сколько держится аренда расчета в Redis (секунды) - не меньше длительности расчета
+SINGLEFLIGHT_LEASE_TTL = int(os.getenv("SINGLEFLIGHT_LEASE_TTL", "30"))
+# Сколько хранится результат для ожидающих воркеров (секунды)
+SINGLEFLIGHT_RESULT_TTL = int(os.getenv("SINGLEFLIGHT_RESULT_TTL", "10"))
+# Как часто ожидающий воркер проверяет результат (секунды)
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", "0.1"))
+
+# Снимает аренду, только если она все еще принадлежит этому расчету
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class _Call:
+    """Расчет, который сейчас выполняется в этом процессе"""
+
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+
+_inflight: Dict[str, _Call] = {}
+
+_metrics = {
+    "computed": 0,       # расчет выполнен этим процессом
+    "shared_local": 0,   # запрос дождался расчета в этом же процессе
+    "shared_remote": 0,  # результат получен от другого воркера
+    "lease_lost": 0,     # другой воркер не опубликовал результат, расчет выполнен повторно
+}
+
+def lease_key(key: str) -> str:
+    return f"singleflight:lease:{key}"
+
+def result_key(key: str, token: str) -> str:
+    return f"singleflight:result:{key}:{token}"
+
+def get_metrics() -> dict:
+    """Счетчики объединенных расчетов и число расчетов, выполняющихся сейчас"""
+    return {**_metrics, "inflight": len(_inflight)}
+
+async def run(key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Выполняет compute() или дожидается такого же расчета, уже начатого с тем же ключом.
+    Результат должен сериализоваться в JSON. Каждый участник получает свою копию результата,
+    поэтому его можно изменять (например, добавлять категории ABC)
+    """
+    call = _inflight.get(key)
+    if call is not None:
+        call.waiters += 1
+        _metrics["shared_local"] += 1
+        # asyncio.wait не отменяет расчет, если отменен только этот запрос
+        await asyncio.wait({call.future})
+        if call.future.cancelled():
+            # Запрос, который выполнял расчет, отменен (клиент отключился) - считаем заново
+            return await run(key, compute)
+        return copy.deepcopy(call.future.result())
+
+    call = _Call()
+    _inflight[key] = call
+    try:
+        result = await _run_shared(key, compute)
+    except asyncio.CancelledError:
+        call.future.cancel()
+        raise
+    except Exception as e:
+        call.future.set_exception(e)
+        # Ошибка передается ожидающим запросам; без них future не должен жаловаться в лог
+        call.future.exception()
+        raise
+    else:
+        call.future.set_result(result)
+    finally:
+        if _inflight.get(key) is call:
+            del _inflight[key]
+
+    # Ожидающие запросы получат копии, а исходный объект может быть изменен вызывающим кодом
+    return copy.deepcopy(result) if call.waiters else result
+
+async def _run_shared(key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+    """Выполняет расчет под арендой в Redis или забирает результат другого воркера"""
+    token = uuid.uuid4().hex
+    try:
+        client = redis_store.get_async_redis()
+        acquired = await client.set(lease_key(key), token, nx=True, ex=SINGLEFLIGHT_LEASE_TTL)
+    except redis.RedisError as e:
+        logger.info(f"Redis недоступен, расчет {key} объединяется только внутри процесса: {str(e)}")
+        _metrics["computed"] += 1
+        return await compute()
+
+    if not acquired:
+        found, result = await _wait_for_remote(client, key)
+        if found:
+            _metrics["shared_remote"] += 1
+            return result
+        _metrics["lease_lost"] += 1
+        _metrics["computed"] += 1
+        return await compute()
+
+    try:
+        _metrics["computed"] += 1
+        result = await compute()
+        try:
+            await client.set(result_key(key, token), fast_json.dumps(result), ex=SINGLEFLIGHT_RESULT_TTL)
+        except redis.RedisError as e:
+            logger.warning(f"Не удалось опубликовать результат расчета {key}: {str(e)}")
+        return result
+    finally:
+        try:
+            await client.eval(_RELEASE_SCRIPT, 1, lease_key(key), token)
+        except redis.RedisError as e:
+            logger.warning(f"Не удалось снять аренду расчета {key}: {str(e)}")
+
+async def _wait_for_remote(client: redis.asyncio.Redis, key: str) -> tuple:
+    """
+    Ждет результата расчета, который выполняет другой воркер. Возвращает (True, результат)
+    или (False, None), если воркер завершился без результата (ошибка) или аренда истекла
+    """
+    deadline = time.monotonic() + SINGLEFLIGHT_LEASE_TTL
+    try:
+        holder = await client.get(lease_key(key))
+        while holder is not None and time.monotonic() < deadline:
+            token = holder.decode()
+            payload = await client.get(result_key(key, token))
+            if payload is None and await client.get(lease_key(key)) != holder:
+                # Аренда снята: результат мог быть записан перед этим - проверяем еще раз
+                payload = await client.get(result_key(key, token))
+                if payload is None:
+                    break
+            if payload is not None:
+                return True, fast_json.loads(payload)
+            await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+    except redis.RedisError as e:
+        logger.info(f"Redis недоступен при ожидании расчета {key}: {str(e)}")
+    return False, None
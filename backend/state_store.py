@@ -0,0 +1,148 @@
+# Хранилище состояний диалога с пользователем (например, шаги ввода токенов в /set_token).
+# Состояние общее для всех процессов веб-сервиса и переживает перезапуск: оно хранится в Redis,
+# а если Redis недоступен - в таблице conversation_states. У каждого состояния есть время жизни,
+# поэтому брошенные диалоги не копятся. Отсутствие записи означает состояние "idle".
+# Состояние читается в обработчиках бота, поэтому Redis вызывается асинхронным клиентом,
+# а запросы к базе выполняются в потоке. Секреты (API токен между шагами /set_token)
+# вызывающий код кладет в состояние только в зашифрованном виде.
+import os
+import json
+import time
+import asyncio
+from typing import Optional
+import redis
+from database import get_db, PortableCursor
+from redis_store import get_async_redis
+
+# Сколько живет незавершенный диалог (секунды)
+STATE_TTL = int(os.getenv("BOT_STATE_TTL", "900"))
+
+IDLE = "idle"
+
+# Сравнение текущего состояния и замена одной операцией в Redis
+_TRANSITION_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+local name = 'idle'
+if current then
+    name = cjson.decode(current)['state']
+end
+if name ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', tonumber(ARGV[3]))
+end
+return 1
+"""
+
+def _key(user_id: int) -> str:
+    return f"bot:state:{user_id}"
+
+def init_conversation_states_table():
+    """Создает таблицу состояний диалога (используется, если Redis недоступен)"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_states (
+                user_id BIGINT PRIMARY KEY,
+                state TEXT NOT NULL,
+                expires_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.commit()
+
+def _db_get(cursor, user_id: int) -> Optional[dict]:
+    cursor.execute('SELECT state, expires_at FROM conversation_states WHERE user_id = ?', (user_id,))
+    row = cursor.fetchone()
+    if not row or row[1] < time.time():
+        return None
+    return json.loads(row[0])
+
+def _db_write(cursor, user_id: int, state: Optional[dict], ttl: int):
+    if state is None:
+        cursor.execute('DELETE FROM conversation_states WHERE user_id = ?', (user_id,))
+    else:
+        cursor.execute(
+            '''
+            INSERT INTO conversation_states (user_id, state, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at
+            ''',
+            (user_id, json.dumps(state, ensure_ascii=False), time.time() + ttl)
+        )
+    # Удаляем истекшие состояния, чтобы таблица не росла
+    cursor.execute('DELETE FROM conversation_states WHERE expires_at < ?', (time.time(),))
+
+def _db_get_state(user_id: int) -> Optional[dict]:
+    init_conversation_states_table()
+    with get_db() as conn:
+        return _db_get(PortableCursor(conn), user_id)
+
+def _db_set_state(user_id: int, state: Optional[dict], ttl: int):
+    init_conversation_states_table()
+    with get_db() as conn:
+        _db_write(PortableCursor(conn), user_id, state, ttl)
+        conn.commit()
+
+def _db_transition(user_id: int, expected: str, state: Optional[dict], ttl: int) -> bool:
+    init_conversation_states_table()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        # Блокируем запись, чтобы проверка и замена выполнились атомарно. В SQLite блокируется
+        # вся база, в PostgreSQL - ключ пользователя (строки может еще не быть, если он в idle)
+        cursor.begin_write()
+        if cursor.postgres:
+            cursor.execute('SELECT pg_advisory_xact_lock(?)', (user_id,))
+        current = _db_get(cursor, user_id)
+        if (current["state"] if current else IDLE) != expected:
+            conn.rollback()
+            return False
+        _db_write(cursor, user_id, state, ttl)
+        conn.commit()
+        return True
+
+async def get_state(user_id: int) -> Optional[dict]:
+    """Возвращает состояние диалога {"state": имя, ...данные} или None, если пользователь в состоянии idle"""
+    try:
+        value = await get_async_redis().get(_key(user_id))
+        return json.loads(value) if value else None
+    except redis.RedisError:
+        return await asyncio.to_thread(_db_get_state, user_id)
+
+async def get_state_name(user_id: int) -> str:
+    """Возвращает имя текущего состояния диалога"""
+    state = await get_state(user_id)
+    return state["state"] if state else IDLE
+
+async def set_state(user_id: int, name: str, ttl: int = STATE_TTL, **data):
+    """Устанавливает состояние диалога с дополнительными данными"""
+    if name == IDLE:
+        await clear_state(user_id)
+        return
+
+    state = {"state": name, **data}
+    try:
+        await get_async_redis().set(_key(user_id), json.dumps(state, ensure_ascii=False), ex=ttl)
+    except redis.RedisError:
+        await asyncio.to_thread(_db_set_state, user_id, state, ttl)
+
+async def clear_state(user_id: int):
+    """Возвращает пользователя в состояние idle"""
+    try:
+        await get_async_redis().delete(_key(user_id))
+    except redis.RedisError:
+        await asyncio.to_thread(_db_set_state, user_id, None, 0)
+
+async def transition(user_id: int, expected: str, name: str, ttl: int = STATE_TTL, **data) -> bool:
+    """
+    Атомарно переводит диалог из состояния expected в состояние name.
+    Возвращает False, если текущее состояние уже другое (например, то же сообщение
+    параллельно обработал другой процесс)
+    """
+    state = {"state": name, **data} if name != IDLE else None
+    payload = json.dumps(state, ensure_ascii=False) if state else ""
+    try:
+        return bool(await get_async_redis().eval(_TRANSITION_SCRIPT, 1, _key(user_id), expected, payload, ttl))
+    except redis.RedisError:
+        return await asyncio.to_thread(_db_transition, user_id, expected, state, ttl)
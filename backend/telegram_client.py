@@ -0,0 +1,166 @@
+# Общий HTTP-клиент для запросов к Telegram Bot API.
+# Бот вебхука, отправитель уведомлений и настройка при запуске (setWebhook, setMyCommands)
+# работают через один пул соединений httpx с keep-alive: соединения с api.telegram.org
+# переиспользуются, а число одновременных соединений ограничено. Для каждого метода API
+# (sendMessage, editMessageText, setWebhook, ...) собирается гистограмма времени ответа.
+import logging
+import os
+import time
+import asyncio
+from typing import Dict, Optional, Tuple
+import httpx
+import telegram
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Настройки пула соединений (можно переопределить переменными окружения)
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_MAX_CONNECTIONS", "32"))
+TELEGRAM_MAX_KEEPALIVE = int(os.getenv("TELEGRAM_MAX_KEEPALIVE", "16"))
+TELEGRAM_KEEPALIVE_EXPIRY = float(os.getenv("TELEGRAM_KEEPALIVE_EXPIRY", "60"))  # секунды
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "10"))
+TELEGRAM_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_WRITE_TIMEOUT", "10"))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "3"))
+
+# Границы корзин гистограммы времени ответа (миллисекунды)
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Клиент привязан к циклу событий, в котором создан (соединения httpx нельзя делить между циклами)
+_client: Optional[Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = None
+
+class LatencyHistogram:
+    """Гистограмма времени ответа одного метода API"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float, ok: bool = True):
+        elapsed_ms = seconds * 1000
+        index = 0
+        while index < len(LATENCY_BUCKETS_MS) and elapsed_ms > LATENCY_BUCKETS_MS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += elapsed_ms
+        self.max = max(self.max, elapsed_ms)
+        if not ok:
+            self.errors += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Оценка квантиля по границам корзин (верхняя граница корзины)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, value in enumerate(self.buckets):
+            seen += value
+            if seen >= rank:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else round(self.max, 1)
+        return round(self.max, 1)
+
+    def to_dict(self) -> dict:
+        labels = [f"le_{bound}" for bound in LATENCY_BUCKETS_MS] + ["inf"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.total / self.count, 1) if self.count else 0,
+            "max_ms": round(self.max, 1),
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+_latency: Dict[str, LatencyHistogram] = {}
+
+def record_latency(method: str, seconds: float, ok: bool = True):
+    """Учитывает время ответа метода Bot API"""
+    histogram = _latency.get(method)
+    if histogram is None:
+        histogram = _latency[method] = LatencyHistogram()
+    histogram.observe(seconds, ok)
+
+def get_latency_metrics() -> dict:
+    """Гистограммы времени ответа по методам Bot API"""
+    return {method: histogram.to_dict() for method, histogram in sorted(_latency.items())}
+
+def get_client() -> httpx.AsyncClient:
+    """Возвращает общий пул соединений к api.telegram.org (создается при первом обращении)"""
+    global _client
+    loop = asyncio.get_running_loop()
+    if _client is not None and _client[0] is loop and not _client[1].is_closed:
+        return _client[1]
+
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            connect=TELEGRAM_CONNECT_TIMEOUT,
+            read=TELEGRAM_READ_TIMEOUT,
+            write=TELEGRAM_WRITE_TIMEOUT,
+            pool=TELEGRAM_POOL_TIMEOUT,
+        ),
+        limits=httpx.Limits(
+            max_connections=TELEGRAM_MAX_CONNECTIONS,
+            max_keepalive_connections=TELEGRAM_MAX_KEEPALIVE,
+            keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY,
+        ),
+    )
+    _client = (loop, client)
+    return client
+
+async def close_client():
+    """Закрывает пул соединений (при остановке процесса)"""
+    global _client
+    if _client is None:
+        return
+    _, client = _client
+    _client = None
+    await client.aclose()
+
+class PooledTelegramRequest(HTTPXRequest):
+    """
+    Сетевой слой python-telegram-bot поверх общего пула соединений.
+    Остановка бота не закрывает пул - его закрывает close_client()
+    """
+
+    def __init__(self):
+        super().__init__(
+            read_timeout=TELEGRAM_READ_TIMEOUT,
+            write_timeout=TELEGRAM_WRITE_TIMEOUT,
+            connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+            pool_timeout=TELEGRAM_POOL_TIMEOUT,
+        )
+
+    def _build_client(self) -> httpx.AsyncClient:
+        try:
+            return get_client()
+        except RuntimeError:
+            # Бот создается вне цикла событий (при импорте модуля) - клиент будет получен в initialize()
+            return httpx.AsyncClient(timeout=self._client_kwargs["timeout"])
+
+    async def initialize(self) -> None:
+        self._client = get_client()
+
+    async def shutdown(self) -> None:
+        return
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # Клиент мог быть пересоздан для другого цикла событий
+        self._client = get_client()
+        # URL содержит токен бота, поэтому в метрики попадает только имя метода
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.monotonic()
+        ok = False
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+            ok = status < 400
+            return status, payload
+        finally:
+            record_latency(api_method, time.monotonic() - started, ok)
+
+def create_bot(token: str) -> telegram.Bot:
+    """Создает бота, запросы которого идут через общий пул соединений"""
+    return telegram.Bot(token=token, request=PooledTelegramRequest(), get_updates_request=PooledTelegramRequest())
@@ -0,0 +1,79 @@
+# Общие настройки тестов бэкенда.
+# Тесты запускаются из каталога backend: python -m pytest -q tests
+# Каждый тест с фикстурой db получает пустую базу: файл SQLite во временном каталоге, а если задан
+# TEST_DATABASE_URL - еще и отдельную схему PostgreSQL (тест выполняется для обеих баз).
+# Redis не нужен: модули, использующие его, продолжают работу без него.
+import os
+import sys
+import uuid
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Недоступный адрес: подключение отклоняется сразу, без ожидания таймаута
+os.environ.setdefault("REDIS_URL", "redis://127.0.0.1:1/0")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+
+import database  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+DATABASE_BACKENDS = ["sqlite"] + (["postgres"] if TEST_DATABASE_URL else [])
+
+@pytest.fixture(params=DATABASE_BACKENDS)
+def db(request, tmp_path, monkeypatch):
+    """Пустая база данных для теста; возвращает имя используемой СУБД"""
+    monkeypatch.chdir(tmp_path)
+    if request.param == "sqlite":
+        monkeypatch.setattr(database, "DATABASE_URL", None)
+        yield "sqlite"
+        return
+
+    import psycopg2
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    admin = psycopg2.connect(TEST_DATABASE_URL)
+    admin.autocommit = True
+    admin.cursor().execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+    monkeypatch.setattr(database, "DATABASE_URL", f"{TEST_DATABASE_URL}{separator}options=-csearch_path%3D{schema}")
+    try:
+        yield "postgres"
+    finally:
+        admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
+
+@pytest.fixture
+def add_user(db):
+    """
+    Создает таблицы пользователей (их создают веб-сервис и бот) и возвращает функцию,
+    добавляющую пользователя с токенами Ozon и настройками уведомлений
+    """
+    database.init_db()
+    with database.get_db() as conn:
+        cursor = database.PortableCursor(conn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notification_settings (
+                telegram_id BIGINT PRIMARY KEY,
+                margin_threshold DOUBLE PRECISION DEFAULT 15.0,
+                roi_threshold DOUBLE PRECISION DEFAULT 30.0,
+                daily_report INTEGER DEFAULT 0,
+                sales_alert INTEGER DEFAULT 1,
+                returns_alert INTEGER DEFAULT 1
+            )
+        ''')
+        conn.commit()
+
+    def add(telegram_id, margin_threshold=15.0, roi_threshold=30.0, daily_report=False):
+        with database.get_db() as conn:
+            cursor = database.PortableCursor(conn)
+            cursor.execute(
+                "INSERT INTO user_tokens (telegram_id, ozon_api_token, ozon_client_id) VALUES (?, ?, ?)",
+                (telegram_id, "token", "client"),
+            )
+            cursor.execute(
+                "INSERT INTO notification_settings (telegram_id, margin_threshold, roi_threshold, daily_report) VALUES (?, ?, ?, ?)",
+                (telegram_id, margin_threshold, roi_threshold, int(daily_report)),
+            )
+            conn.commit()
+
+    return add
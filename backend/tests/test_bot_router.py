@@ -0,0 +1,136 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from bot_router import CommandRouter
+
+def make_router():
+    router = CommandRouter()
+    for name in ("start", "stats", "delete_tokens", "set_token", "set_margin_threshold"):
+        router.command(name)(None)
+    router.command("help", "помощь")(None)
+    router.add_alias("delete_tokens", r"удалить.*токены")
+    router.add_alias("set_token", r"установить.*токены|токены")
+    router.add_alias("stats", r"статистика")
+    return router
+
+@pytest.mark.parametrize("text, expected", [
+    ("/stats", ("stats", [])),
+    ("/STATS", ("stats", [])),
+    ("/stats@OzonAnalyticsBot", ("stats", [])),
+    ("/set_margin_threshold 12.5", ("set_margin_threshold", ["12.5"])),
+    ("/set_margin_threshold@OzonAnalyticsBot 12.5", ("set_margin_threshold", ["12.5"])),
+    ("  /help  ", ("help", [])),
+    ("/помощь", ("помощь", [])),
+])
+def test_slash_commands(text, expected):
+    assert make_router().resolve(text) == expected
+
+def test_button_text_without_slash():
+    router = make_router()
+    assert router.resolve("stats") == ("stats", [])
+    assert router.resolve("помощь") == ("помощь", [])
+    # Без слеша команда с аргументами не распознается как команда
+    assert router.resolve("stats за месяц") is None
+
+def test_aliases_keep_registration_order():
+    router = make_router()
+    # "токены" встречается в обоих выражениях, но удаление добавлено раньше
+    assert router.resolve("Удалить токены") == ("delete_tokens", [])
+    assert router.resolve("Токены удалить?") == ("set_token", [])
+    assert router.resolve("Установить токены") == ("set_token", [])
+    assert router.resolve("Покажи статистику") is None
+    assert router.resolve("Моя статистика") == ("stats", [])
+
+def test_exact_match_wins_over_alias():
+    router = make_router()
+    router.add_alias("stats", r"start")
+    assert router.resolve("start") == ("start", [])
+
+def test_unknown_text_falls_through():
+    router = make_router()
+    assert router.resolve("") is None
+    assert router.resolve("привет") is None
+    assert router.resolve("/unknown") is None
+    # Неизвестная команда со слешем не ищется среди ключевых слов
+    assert router.resolve("/токены") is None
+    assert router.resolve("Удалить токены", allow_aliases=False) is None
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+def make_update(text, user_id=42):
+    return SimpleNamespace(message=FakeMessage(text), effective_user=SimpleNamespace(id=user_id))
+
+@pytest.fixture
+def app_module():
+    import app
+    return app
+
+@pytest.fixture
+def settings_store(app_module, monkeypatch):
+    """Настройки уведомлений в памяти вместо базы веб-сервиса"""
+    store = {}
+
+    async def get_settings(telegram_id):
+        return store.get(telegram_id) or app_module.NotificationSettings(telegram_id=telegram_id)
+
+    async def save_settings(settings):
+        store[settings.telegram_id] = settings
+        return True
+
+    monkeypatch.setattr(app_module, "get_notification_settings", get_settings)
+    monkeypatch.setattr(app_module, "save_notification_settings", save_settings)
+    return store
+
+def test_main_keyboard_buttons_resolve(app_module):
+    keyboard = app_module.get_main_keyboard().keyboard
+    for row in keyboard:
+        for button in row:
+            name, args = app_module.bot_router.resolve(button.text)
+            assert name == button.text.lstrip("/") and args == []
+
+@pytest.mark.parametrize("text, expected", [
+    ("Удалить токены", "delete_tokens"),
+    ("Проверить токены", "verify"),
+    ("Токены", "set_token"),
+    ("Статистика", "stats"),
+    ("Справка", "help"),
+    ("Уведомления", "notifications"),
+])
+def test_app_keywords(app_module, text, expected):
+    assert app_module.bot_router.resolve(text) == (expected, [])
+
+def test_app_unknown_text_is_not_dispatched(app_module):
+    update = make_update("просто сообщение")
+    assert asyncio.run(app_module.bot_router.dispatch(update, None)) is False
+    assert update.message.replies == []
+
+def test_set_margin_threshold(app_module, settings_store):
+    update = make_update("/set_margin_threshold@OzonAnalyticsBot 12,5")
+    assert asyncio.run(app_module.bot_router.dispatch(update, None)) is True
+    assert settings_store[42].margin_threshold == 12.5
+    assert update.message.replies == ["✅ Порог маржинальности установлен на 12.5%"]
+
+@pytest.mark.parametrize("argument", ["", " -5", " много"])
+def test_set_margin_threshold_rejects_bad_values(app_module, settings_store, argument):
+    update = make_update(f"/set_margin_threshold{argument}")
+    asyncio.run(app_module.bot_router.dispatch(update, None))
+    assert settings_store == {}
+    assert len(update.message.replies) == 1
+
+@pytest.mark.parametrize("command, field", [
+    ("toggle_daily_report", "daily_report"),
+    ("toggle_sales_alert", "sales_alert"),
+    ("toggle_returns_alert", "returns_alert"),
+])
+def test_toggle_commands(app_module, settings_store, command, field):
+    default = getattr(app_module.NotificationSettings(telegram_id=42), field)
+    asyncio.run(app_module.bot_router.dispatch(make_update(f"/{command}"), None))
+    assert getattr(settings_store[42], field) is (not default)
+    asyncio.run(app_module.bot_router.dispatch(make_update(f"/{command}"), None))
+    assert getattr(settings_store[42], field) is default
@@ -0,0 +1,45 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+import celery_app
+import services
+
+@pytest.fixture
+def refreshed(monkeypatch):
+    """Обновление данных без запросов к Ozon; возвращает список поставленных проверок метрик"""
+    checks = []
+
+    async def refresh_user_data(user_id):
+        credentials = services.get_user_credentials(user_id)
+        return {"data_changed": user_id == 1} if credentials else None
+
+    monkeypatch.setattr(services, "refresh_user_data", refresh_user_data)
+    monkeypatch.setattr(celery_app.check_user_metrics, "delay", checks.append)
+    return checks
+
+def test_user_lookup(add_user):
+    add_user(1)
+    add_user(2)
+    assert sorted(services.get_all_user_ids()) == [1, 2]
+    assert services.get_user_credentials(1) == ("token", "client")
+    assert services.get_user_credentials(3) is None
+
+def test_update_user_data_runs_in_process(add_user, refreshed):
+    add_user(1)
+    add_user(2)
+    result = celery_app.update_user_data.apply((1,)).get()
+    assert result == {"status": "success", "user_id": 1, "data_changed": True}
+    # Данные второго пользователя не изменились - метрики не проверяются
+    assert celery_app.update_user_data.apply((2,)).get()["data_changed"] is False
+    assert refreshed == [1]
+
+def test_update_user_data_without_tokens(add_user, refreshed):
+    result = celery_app.update_user_data.apply((3,)).get()
+    assert result["status"] == "error"
+    assert refreshed == []
+
+def test_retryable_errors():
+    assert celery_app.is_retryable_error(HTTPException(status_code=502))
+    assert not celery_app.is_retryable_error(HTTPException(status_code=401))
+    assert celery_app.is_retryable_error(asyncio.TimeoutError())
+    assert not celery_app.is_retryable_error(ValueError())
@@ -0,0 +1,45 @@
+import asyncio
+import outbox
+import services
+from database import get_db, PortableCursor
+
+ANALYTICS = {"revenue": 1000, "profit": 200, "margin": 20, "roi": 40}
+
+def report_dates(telegram_id):
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute("SELECT report_date FROM daily_reports WHERE telegram_id = ? ORDER BY report_date", (telegram_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+def test_subscriber_check_without_settings_table(db):
+    assert services.is_daily_report_subscriber(1) is False
+
+def test_subscriber_check(add_user):
+    add_user(1, daily_report=True)
+    add_user(2)
+    assert services.is_daily_report_subscriber(1) is True
+    assert services.is_daily_report_subscriber(2) is False
+
+def test_render_replaces_report_and_drops_old_ones(db):
+    services.render_daily_report(1, ANALYTICS, "2024-02-29")
+    services.render_daily_report(1, ANALYTICS, "2024-03-01")
+    services.render_daily_report(1, ANALYTICS, "2024-03-07")
+    services.render_daily_report(1, {**ANALYTICS, "revenue": 2000}, "2024-03-08")
+    services.render_daily_report(1, ANALYTICS, "2024-03-08")
+    assert report_dates(1) == ["2024-03-01", "2024-03-07", "2024-03-08"]
+
+def test_send_queues_prepared_reports(add_user, monkeypatch):
+    add_user(1, daily_report=True)
+    add_user(2, daily_report=True)
+    add_user(3)
+    today = services.today_report_date()
+    services.render_daily_report(1, ANALYTICS, today)
+    services.render_daily_report(3, ANALYTICS, today)
+
+    result = asyncio.run(services.send_daily_reports())
+    assert result == {"status": "success", "total_users": 2, "success_count": 1, "error_count": 1}
+    [item] = outbox.claim_batch("test")
+    assert item["chat_id"] == 1 and item["kind"] == "daily_report"
+
+    # Повторный запуск в тот же день не дублирует отчет
+    assert asyncio.run(services.send_daily_reports())["success_count"] == 0
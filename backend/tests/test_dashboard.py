@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+import services
+
+PRODUCTS = {"result": {"items": [
+    {"product_id": 1, "offer_id": "A", "name": "Товар A", "price": "1000"},
+    {"product_id": 2, "offer_id": "B", "name": "Товар B", "price": "500"},
+]}}
+SUMMARY = {"sales": 3000, "profit": 900, "advertising_costs": 200}
+COSTS = {"A": 400.0, "B": 100.0}
+
+@pytest.fixture
+def ozon_calls(monkeypatch):
+    calls = []
+
+    async def get_ozon_products(api_token, client_id):
+        calls.append("products")
+        return PRODUCTS
+
+    async def get_ozon_analytics(api_token, client_id, period="month"):
+        calls.append("analytics")
+        return SUMMARY
+
+    monkeypatch.setattr(services, "get_ozon_products", get_ozon_products)
+    monkeypatch.setattr(services, "get_ozon_analytics", get_ozon_analytics)
+    return calls
+
+def test_product_profit():
+    assert services.product_profit(1000, 2, 300, commission=100, ad_cost=50) == {
+        "total_cost": 600, "profit": 250, "margin": 25.0, "roi": 250 / 750 * 100,
+    }
+    assert services.product_profit(0, 0, 300)["margin"] == 0
+
+def test_dashboard_uses_stored_summary(ozon_calls):
+    dashboard = asyncio.run(services.build_dashboard("key", "client", "month", COSTS, summary=SUMMARY))
+    assert ozon_calls == ["products"]
+    assert dashboard["summary"] == SUMMARY
+
+    asyncio.run(services.build_dashboard("key", "client", "week", COSTS))
+    assert sorted(ozon_calls[1:]) == ["analytics", "products"]
+
+def test_dashboard_profit_matches_product_analytics(ozon_calls, monkeypatch):
+    import app
+    dashboard = asyncio.run(services.build_dashboard("key", "client", "month", COSTS, summary=SUMMARY))
+
+    async def ozon(*args, **kwargs):
+        return PRODUCTS
+
+    async def ozon_analytics(*args, **kwargs):
+        return SUMMARY
+
+    async def ozon_ads(*args, **kwargs):
+        return {"total_cost": SUMMARY["advertising_costs"], "campaigns": []}
+
+    async def ozon_report(*args, **kwargs):
+        return {"total_cost": 0, "returns": []}
+
+    async def user_tokens(telegram_id):
+        return app.UserToken(telegram_id=telegram_id, ozon_api_token="key", ozon_client_id="client")
+
+    async def product_costs(api_key):
+        return {"items": [{"offer_id": offer_id, "cost": cost} for offer_id, cost in COSTS.items()]}
+
+    monkeypatch.setattr(app, "get_ozon_products", ozon)
+    monkeypatch.setattr(app, "get_ozon_analytics", ozon_analytics)
+    monkeypatch.setattr(app, "get_ozon_financial_data", ozon_report)
+    monkeypatch.setattr(app, "get_ozon_advertising_costs", ozon_ads)
+    monkeypatch.setattr(app, "get_ozon_returns_data", ozon_report)
+    monkeypatch.setattr(app, "get_user_tokens", user_tokens)
+    monkeypatch.setattr(app, "get_product_costs", product_costs)
+    analytics = asyncio.run(app.compute_product_analytics(1, "api-key", "month"))
+
+    profits = {row["offer_id"]: (row["profit"], row["margin"], row["roi"]) for row in analytics}
+    assert profits == {row["offer_id"]: (row["profit"], row["margin"], row["roi"]) for row in dashboard["products"]["items"]}
+    assert dashboard["products"]["items"][0]["ad_cost"] == 100
@@ -0,0 +1,47 @@
+import http_cache
+from data_versions import (
+    bump_data_version,
+    get_data_state,
+    get_data_version,
+    get_snapshot,
+    record_sync,
+    save_snapshot,
+)
+
+def test_sync_bumps_version_only_for_new_data(db):
+    assert get_data_state(1) == (0, None)
+    assert record_sync(1, "hash-a") is True
+    assert get_data_state(1) == (1, "hash-a")
+    assert record_sync(1, "hash-a") is False
+    assert record_sync(1, "hash-b") is True
+    assert get_data_state(1) == (2, "hash-b")
+
+def test_cost_change_bumps_version_and_keeps_hash(db):
+    record_sync(1, "hash-a")
+    assert bump_data_version(1) == 2
+    assert get_data_state(1) == (2, "hash-a")
+
+def test_snapshot_outside_sync_bumps_version_when_changed(db):
+    assert save_snapshot(1, "analytics_day", {"margin": 10}) == 1
+    assert save_snapshot(1, "analytics_day", {"margin": 10}) == 1
+    assert save_snapshot(1, "analytics_day", {"margin": 12}) == 2
+    assert get_snapshot(1, "analytics_day")["payload"] == {"margin": 12}
+
+def test_snapshot_of_sync_keeps_given_version(db):
+    record_sync(1, "hash-a")
+    assert save_snapshot(1, "analytics_month", {"revenue": 1}, 1) == 1
+    assert save_snapshot(1, "analytics_month", {"revenue": 2}, 1) == 1
+    assert get_data_version(1) == 1
+
+def test_user_etag_follows_data(db):
+    record_sync(1, "hash-a")
+    etag = http_cache.user_etag("analytics", 1, period="month")
+    assert http_cache.user_etag("analytics", 1, period="month") == etag
+    assert http_cache.user_etag("analytics", 1, period="day") != etag
+    assert http_cache.user_etag("analytics", 2, period="month") != etag
+
+    record_sync(1, "hash-b")
+    changed = http_cache.user_etag("analytics", 1, period="month")
+    assert changed != etag
+    bump_data_version(1)
+    assert http_cache.user_etag("analytics", 1, period="month") != changed
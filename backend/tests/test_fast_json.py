@@ -0,0 +1,19 @@
+import datetime
+import json
+from fastapi import Response
+import fast_json
+
+def test_dumps_handles_numeric_keys_and_dates():
+    data = {"items": [{"offer_id": "Товар-1", "profit": 1.5}], 1: datetime.date(2024, 5, 1)}
+    assert json.loads(fast_json.dumps(data)) == {"items": [{"offer_id": "Товар-1", "profit": 1.5}], "1": "2024-05-01"}
+    assert fast_json.loads(fast_json.dumps({"a": [1, 2]})) == {"a": [1, 2]}
+
+def test_json_response_keeps_handler_headers():
+    response = Response()
+    response.headers["ETag"] = 'W/"abc"'
+    response.headers["Cache-Control"] = "private, no-cache"
+    result = fast_json.json_response({"ok": True}, response)
+    assert result.body == b'{"ok":true}'
+    assert result.headers["etag"] == 'W/"abc"'
+    assert result.headers["cache-control"] == "private, no-cache"
+    assert result.headers["content-length"] == str(len(result.body))
@@ -0,0 +1,102 @@
+import hashlib
+import pytest
+from starlette.requests import Request
+from starlette.responses import Response
+import http_cache
+from data_versions import record_sync
+
+def make_request(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers, "query_string": b""})
+
+def test_conditional_response():
+    etag = http_cache.make_etag("analytics", 1)
+    response = Response()
+    assert http_cache.conditional_response(make_request(), response, etag) is None
+    assert response.headers["etag"] == etag
+
+    not_modified = http_cache.conditional_response(make_request(f'"other", W/{etag}'), Response(), etag)
+    assert not_modified.status_code == 304
+    assert http_cache.conditional_response(make_request(etag), Response(), None) is None
+
+@pytest.fixture
+def app_module(db, monkeypatch):
+    import app
+    monkeypatch.setattr(app, "users_db", {})
+    app.update_users_db_reverse()
+    yield app
+    app.update_users_db_reverse()
+
+def register_key(app, api_key, telegram_id=None):
+    user_info = {"tokens": "", "api_key": api_key}
+    if telegram_id:
+        user_info["telegram_id"] = telegram_id
+    app.users_db[hashlib.sha256(api_key.encode()).hexdigest()] = user_info
+    app.update_users_db_reverse()
+
+def test_data_etag_for_api_key_of_telegram_user(app_module):
+    register_key(app_module, "tg-user-1-1", telegram_id=1)
+    register_key(app_module, "tg-user-1-2", telegram_id=1)
+    record_sync(1, "hash-a")
+
+    etag = app_module.data_etag("analytics", "month", None, "tg-user-1-1", "token")
+    assert etag is not None
+    assert app_module.data_etag("analytics", "month", None, "tg-user-1-1", "token") == etag
+    # У каждого ключа своя себестоимость
+    assert app_module.data_etag("analytics", "month", None, "tg-user-1-2", "token") != etag
+
+    record_sync(1, "hash-b")
+    assert app_module.data_etag("analytics", "month", None, "tg-user-1-1", "token") != etag
+
+def test_data_etag_without_data_version(app_module):
+    register_key(app_module, "user-1")
+    assert app_module.data_etag("analytics", "month", None, "user-1", "token") is None
+    assert app_module.data_etag("analytics", "month", None, "test-key", "test_token") is not None
+
+def test_dashboard_accepts_api_key_header(app_module, monkeypatch):
+    from fastapi.testclient import TestClient
+    calls = []
+
+    async def build_dashboard(api_token, client_id, period, costs, page_size, summary=None):
+        calls.append(api_token)
+        # У тестового ключа нет сохраненной сводки
+        assert summary is None
+        return {"period": period, "summary": {}, "products": {"items": [], "total": 0, "page_size": page_size}, "top_product": None, "abc": {}}
+
+    monkeypatch.setattr(app_module.services, "build_dashboard", build_dashboard)
+    client = TestClient(app_module.app)
+
+    response = client.get("/api/dashboard?period=week", headers={"X-API-Key": "test-key"})
+    assert response.status_code == 200
+    assert response.json()["period"] == "week"
+    assert calls == ["test_token"]
+    # Без ключа и Telegram ID данные не отдаются
+    assert client.get("/api/dashboard").status_code == 400
+
+def test_product_analytics_are_cached_per_api_key(app_module, monkeypatch):
+    from cryptography.fernet import Fernet
+    from fastapi.testclient import TestClient
+    monkeypatch.setattr(app_module, "_cipher_suite", Fernet(Fernet.generate_key()))
+    for api_key in ("tg-user-1-1", "tg-user-1-2"):
+        register_key(app_module, api_key, telegram_id=1)
+        app_module.users_db[hashlib.sha256(api_key.encode()).hexdigest()]["tokens"] = app_module.encrypt_tokens({"telegram_id": 1})
+    record_sync(1, "hash-a")
+
+    # Себестоимость у каждого ключа своя, поэтому и прибыль
+    async def compute_product_analytics(telegram_id, api_key, period):
+        return [{"offer_id": "A", "profit": 100 if api_key.endswith("1") else 50}]
+
+    monkeypatch.setattr(app_module, "compute_product_analytics", compute_product_analytics)
+    client = TestClient(app_module.app)
+
+    first = client.get("/api/analytics/products", headers={"X-API-Key": "tg-user-1-1"})
+    second = client.get("/api/analytics/products", headers={"X-API-Key": "tg-user-1-2"})
+    assert first.json()[0]["profit"] == 100
+    assert second.json()[0]["profit"] == 50
+    assert first.headers["etag"] != second.headers["etag"]
+
+    # ETag одного ключа не подходит для другого
+    response = client.get("/api/analytics/products", headers={"X-API-Key": "tg-user-1-2", "If-None-Match": first.headers["etag"]})
+    assert response.status_code == 200
+    assert client.get("/api/analytics/abc", headers={"X-API-Key": "tg-user-1-1"}).headers["etag"] != \
+        client.get("/api/analytics/abc", headers={"X-API-Key": "tg-user-1-2"}).headers["etag"]
@@ -0,0 +1,43 @@
+import time
+import job_ledger
+
+def call_stats(calls, endpoint_ms):
+    return {
+        "calls": calls,
+        "bytes": 100 * calls,
+        "retries": 0,
+        "endpoints": {"/v2/product/list": {"calls": calls, "total_ms": endpoint_ms, "bytes": 100 * calls}},
+    }
+
+def test_runs_are_listed_newest_first(db):
+    first = job_ledger.start_run("check_metrics")
+    second = job_ledger.start_run("send_daily_reports")
+    assert second > first
+
+    job_ledger.finish_run(first, total_items=2, success_count=1, error_count=1, details={"note": "тест"})
+    runs = job_ledger.list_runs()
+    assert [run["id"] for run in runs] == [second, first]
+    assert runs[0]["status"] == "running" and runs[0]["finished_at"] is None
+    assert runs[1]["details"] == {"note": "тест"}
+    assert [run["id"] for run in job_ledger.list_runs("check_metrics")] == [first]
+
+def test_run_report_aggregates_items(db):
+    run_id = job_ledger.start_run("update_all_users_data")
+    started_at = time.time()
+    job_ledger.record_item(run_id, 1, "success", started_at - 2, call_stats(3, 150.0))
+    job_ledger.record_item(run_id, 2, "error", started_at - 1, call_stats(1, 50.0), retries=2, error=TimeoutError())
+    job_ledger.record_item(run_id, 3, "error", started_at, error=TimeoutError())
+    job_ledger.finish_run(run_id, total_items=3, success_count=1, error_count=2)
+
+    report = job_ledger.get_run_report(run_id, top=2)
+    assert report["items"]["count"] == 3
+    assert report["items"]["ozon_calls"] == 4
+    assert report["items"]["retries"] == 2
+    assert [user["telegram_id"] for user in report["slowest_users"]] == [1, 2]
+    assert report["slowest_endpoints"] == [
+        {"endpoint": "/v2/product/list", "calls": 4, "total_ms": 200.0, "avg_ms": 50.0, "bytes": 400}
+    ]
+    assert report["errors_by_class"] == {"TimeoutError": 2}
+
+def test_unknown_run(db):
+    assert job_ledger.get_run_report(12345) is None
@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+import outbox
+import services
+from data_versions import bump_data_version, save_snapshot
+
+def queued_kinds():
+    outbox.init_outbox_table()
+    return [item["kind"] for item in outbox.claim_batch("test", limit=100)]
+
+def set_analytics(telegram_id, margin, roi=50.0):
+    save_snapshot(telegram_id, "analytics_day", {"margin": margin, "roi": roi}, bump_data_version(telegram_id))
+
+def test_alert_is_sent_once_per_transition(add_user):
+    add_user(1)
+    set_analytics(1, margin=5.0)
+
+    result = asyncio.run(services.check_metrics())
+    assert result["low_margin_alerts"] == 1
+    assert queued_kinds() == ["low_margin"]
+
+    # Без изменений данных пользователь не проверяется повторно
+    assert asyncio.run(services.check_metrics())["total_users"] == 0
+
+    # Новые данные, но метрика все еще ниже порога - повторного уведомления нет
+    set_analytics(1, margin=6.0)
+    asyncio.run(services.check_metrics())
+    assert queued_kinds() == []
+
+    set_analytics(1, margin=20.0)
+    asyncio.run(services.check_metrics())
+    assert queued_kinds() == ["margin_recovered"]
+
+def test_changed_threshold_triggers_check(add_user):
+    add_user(1, margin_threshold=15.0)
+    set_analytics(1, margin=20.0)
+    asyncio.run(services.check_metrics())
+    assert queued_kinds() == []
+
+    services.init_metric_state_tables()
+    with services.get_db() as conn:
+        services.PortableCursor(conn).execute("UPDATE notification_settings SET margin_threshold = 25 WHERE telegram_id = 1")
+        conn.commit()
+    asyncio.run(services.check_metrics([1]))
+    assert queued_kinds() == ["low_margin"]
+
+def test_messages_and_state_are_saved_together(add_user, monkeypatch):
+    add_user(1)
+    add_user(2)
+    set_analytics(1, margin=5.0)
+    set_analytics(2, margin=5.0)
+
+    save = services.save_metric_evaluation
+
+    def fail_for_second_user(cursor, telegram_id, *args):
+        if telegram_id == 2:
+            raise RuntimeError("database is locked")
+        save(cursor, telegram_id, *args)
+
+    monkeypatch.setattr(services, "save_metric_evaluation", fail_for_second_user)
+    asyncio.run(services.check_metrics())
+    # Уведомление второго пользователя не поставлено, раз его состояние не сохранилось
+    assert [item["chat_id"] for item in outbox.claim_batch("test", limit=100)] == [1]
+
+    monkeypatch.setattr(services, "save_metric_evaluation", save)
+    result = asyncio.run(services.check_metrics())
+    assert result["total_users"] == 1
+    assert [item["chat_id"] for item in outbox.claim_batch("test", limit=100)] == [2]
+
+@pytest.mark.parametrize("user_ids", [[], [3]])
+def test_check_limited_to_given_users(add_user, user_ids):
+    add_user(1)
+    set_analytics(1, margin=5.0)
+    assert asyncio.run(services.check_metrics(user_ids))["total_users"] == 0
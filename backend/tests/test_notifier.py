@@ -0,0 +1,62 @@
+import asyncio
+from telegram.error import Forbidden, NetworkError, RetryAfter
+import notifier
+from database import get_db, PortableCursor
+
+class FakeBot:
+    """Бот, который отвечает на отправку в чат заданными ошибками по очереди"""
+
+    def __init__(self, errors=None):
+        self.errors = {chat_id: list(items) for chat_id, items in (errors or {}).items()}
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        errors = self.errors.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text))
+
+def make_pipeline(bot, **kwargs):
+    options = {"global_rate": 1000, "per_chat_rate": 1000, **kwargs}
+    return notifier.DeliveryPipeline(bot, **options)
+
+def test_deliver_many_reports_and_logs_results(db):
+    bot = FakeBot({2: [Forbidden("bot was blocked by the user")]})
+    messages = [{"chat_id": chat_id, "text": f"Отчет {chat_id}", "kind": "daily_report"} for chat_id in (1, 2)]
+    stats = asyncio.run(make_pipeline(bot).deliver_many(messages))
+
+    assert (stats["total"], stats["sent"], stats["failed"]) == (2, 1, 1)
+    assert bot.sent == [(1, "Отчет 1")]
+    failed = stats["results"][1]
+    assert failed["status"] == "failed" and failed["attempts"] == 1 and failed["retryable"] is False
+
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute("SELECT chat_id, kind, status FROM notification_log ORDER BY chat_id")
+        assert [tuple(row) for row in cursor.fetchall()] == [(1, "daily_report", "sent"), (2, "daily_report", "failed")]
+
+def test_retry_after_pauses_and_retries():
+    bot = FakeBot({1: [RetryAfter(0)]})
+    pipeline = make_pipeline(bot)
+    result = asyncio.run(pipeline.deliver(1, "Текст"))
+    assert result["status"] == "sent" and result["attempts"] == 2
+    assert pipeline.paused_until > 0
+
+def test_retries_are_limited():
+    bot = FakeBot({1: [RetryAfter(0)] * 3})
+    result = asyncio.run(make_pipeline(bot, max_retries=1).deliver(1, "Текст"))
+    assert result["status"] == "failed" and result["attempts"] == 2 and result["retryable"] is True
+    assert bot.sent == []
+
+def test_network_errors_back_off_only_between_attempts(monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(notifier.asyncio, "sleep", sleep)
+    bot = FakeBot({1: [NetworkError("Bad Gateway")] * 3})
+    result = asyncio.run(make_pipeline(bot, max_retries=2).deliver(1, "Текст"))
+    assert result["status"] == "failed" and result["attempts"] == 3
+    # Короткие ожидания token bucket не учитываем, проверяем паузы между попытками
+    assert [delay for delay in delays if delay >= 1] == [2, 4]
@@ -0,0 +1,89 @@
+import asyncio
+import time
+import outbox
+from database import get_db, PortableCursor
+
+def message(chat_id, dedup_key=None, text="Текст"):
+    return {"chat_id": chat_id, "text": text, "kind": "test", "dedup_key": dedup_key}
+
+def statuses():
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute("SELECT chat_id, status FROM outbox ORDER BY id")
+        return dict(cursor.fetchall())
+
+class FakePipeline:
+    """Конвейер доставки, возвращающий заранее заданные результаты по chat_id"""
+
+    def __init__(self, failed=()):
+        self.failed = dict(failed)
+        self.delivered = []
+
+    async def deliver_many(self, batch):
+        results = []
+        for item in batch:
+            if item["chat_id"] in self.failed:
+                results.append({"status": "failed", "error": "Forbidden", "retryable": self.failed[item["chat_id"]]})
+            else:
+                self.delivered.append(item["chat_id"])
+                results.append({"status": "sent"})
+        sent = sum(1 for result in results if result["status"] == "sent")
+        return {"results": results, "sent": sent, "total": len(results)}
+
+def test_enqueue_skips_known_dedup_keys(db):
+    assert outbox.enqueue_messages([message(1, "daily:1"), message(2, "daily:2")]) == 2
+    assert outbox.enqueue_messages([message(1, "daily:1"), message(3)]) == 1
+    # Сообщения без ключа не считаются повторами
+    assert outbox.enqueue_messages([message(3)]) == 1
+    assert outbox.get_outbox_metrics()["pending"] == 4
+
+def test_insert_messages_uses_caller_transaction(db):
+    outbox.init_outbox_table()
+    with get_db() as conn:
+        assert outbox.insert_messages(PortableCursor(conn), [message(1)]) == 1
+        conn.rollback()
+    assert outbox.get_outbox_metrics()["depth"] == 0
+
+def test_claimed_messages_are_leased_to_one_worker(db):
+    outbox.enqueue_messages([message(1), message(2)])
+    first = outbox.claim_batch("worker-a")
+    assert [item["chat_id"] for item in first] == [1, 2]
+    assert all(item["attempts"] == 1 for item in first)
+    assert outbox.claim_batch("worker-b") == []
+
+def test_expired_lease_is_claimed_again(db):
+    outbox.enqueue_messages([message(1)])
+    outbox.claim_batch("worker-a", lease_seconds=-1)
+    again = outbox.claim_batch("worker-b")
+    assert [item["attempts"] for item in again] == [2]
+
+def test_release_leases_returns_messages_to_queue(db):
+    outbox.enqueue_messages([message(1), message(2)])
+    outbox.claim_batch("worker-a")
+    assert outbox.release_leases("worker-b") == 0
+    assert outbox.release_leases("worker-a") == 2
+    assert len(outbox.claim_batch("worker-b")) == 2
+
+def test_failed_message_is_retried_later_then_given_up(db, monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_ATTEMPTS", 2)
+    outbox.enqueue_messages([message(1)])
+    [item] = outbox.claim_batch("worker-a")
+    outbox.mark_failed(item, "timeout")
+    assert statuses() == {1: "pending"}
+    # Повтор откладывается
+    assert outbox.claim_batch("worker-a") == []
+
+    with get_db() as conn:
+        PortableCursor(conn).execute("UPDATE outbox SET available_at = ?", (time.time() - 1,))
+        conn.commit()
+    [item] = outbox.claim_batch("worker-a")
+    outbox.mark_failed(item, "timeout")
+    assert statuses() == {1: "failed"}
+
+def test_send_batch_marks_results(db):
+    outbox.enqueue_messages([message(1), message(2), message(3)])
+    pipeline = FakePipeline(failed={2: True, 3: False})
+    assert asyncio.run(outbox.send_batch(pipeline, "worker-a")) == 3
+    assert pipeline.delivered == [1]
+    assert statuses() == {1: "sent", 2: "pending", 3: "failed"}
+    assert not outbox.has_due_messages()
@@ -0,0 +1,89 @@
+import asyncio
+from contextlib import asynccontextmanager
+import aiohttp
+import pytest
+import celery_app
+import ozon_api
+import services
+
+class FakeResponse:
+    def __init__(self, status, body=b""):
+        self.status = status
+        self.status_code = status
+        self.content = body
+        self.text = body.decode()
+
+    async def read(self):
+        return self.content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+
+    def post(self, url, json=None, headers=None):
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response
+
+@pytest.fixture
+def ozon(monkeypatch):
+    """Подменяет HTTP-клиенты ozon_api; возвращает функцию, задающую ответы aiohttp и requests"""
+    sync_calls = []
+
+    def respond(async_response, sync_response=None):
+        @asynccontextmanager
+        async def client_session():
+            yield FakeSession(async_response)
+
+        def post_json(url, headers, payload, retry=False):
+            sync_calls.append(url)
+            return sync_response
+
+        monkeypatch.setattr(ozon_api, "client_session", client_session)
+        monkeypatch.setattr(ozon_api, "post_json", post_json)
+        return sync_calls
+
+    return respond
+
+@pytest.mark.parametrize("status", [401, 403])
+def test_invalid_tokens_are_not_retried(ozon, status):
+    sync_calls = ozon(FakeResponse(status, b'{"message": "Invalid Api-Key"}'))
+    with pytest.raises(ozon_api.OzonAPIError) as error:
+        asyncio.run(ozon_api.get_ozon_products("key", "client"))
+
+    assert error.value.ozon_status == status
+    assert error.value.status_code == 400
+    # Ответ Ozon не повторяется синхронным клиентом
+    assert sync_calls == []
+    assert not celery_app.is_retryable_error(error.value)
+
+def test_server_errors_are_retried(ozon):
+    ozon(aiohttp.ClientConnectionError(), FakeResponse(503, b"unavailable"))
+    with pytest.raises(ozon_api.OzonAPIError) as error:
+        asyncio.run(ozon_api.get_ozon_products("key", "client"))
+    assert error.value.ozon_status == 503
+    assert celery_app.is_retryable_error(error.value)
+
+def test_sync_fallback_keeps_ozon_status(ozon):
+    sync_calls = ozon(aiohttp.ClientConnectionError(), FakeResponse(401, b"unauthorized"))
+    with pytest.raises(ozon_api.OzonAPIError) as error:
+        asyncio.run(ozon_api.get_ozon_products("key", "client"))
+    assert error.value.ozon_status == 401
+    assert len(sync_calls) == 1
+
+def test_update_task_gives_up_on_invalid_tokens(ozon, monkeypatch):
+    ozon(FakeResponse(401, b"unauthorized"))
+
+    async def refresh_user_data(user_id):
+        await ozon_api.get_ozon_products("key", "client")
+
+    monkeypatch.setattr(services, "refresh_user_data", refresh_user_data)
+    result = celery_app.update_user_data.apply((1,)).get()
+    assert result["status"] == "error"
+    assert "HTTP 401" in result["message"]
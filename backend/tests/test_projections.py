@@ -0,0 +1,42 @@
+import pytest
+from fastapi import HTTPException
+import projections
+
+def parse(fields=None, view=None, allowed=projections.PRODUCT_ANALYTICS_FIELDS):
+    return projections.parse_fields(fields, view, projections.PRODUCT_ANALYTICS_VIEWS, allowed)
+
+def test_parse_fields_keeps_order_and_drops_duplicates():
+    assert parse(" offer_id, profit ,offer_id,,") == ("offer_id", "profit")
+    # fields важнее view
+    assert parse("margin", view="full") == ("margin",)
+
+def test_parse_views():
+    assert parse() is None
+    assert parse(view="full") is None
+    assert parse(view="compact") == projections.PRODUCT_ANALYTICS_VIEWS["compact"]
+
+@pytest.mark.parametrize("fields, view", [
+    ("profit,unknown", None),
+    ("name;drop", None),
+    (",", None),
+    (None, "tiny"),
+])
+def test_parse_rejects_unknown_fields_and_views(fields, view):
+    with pytest.raises(HTTPException) as error:
+        parse(fields, view)
+    assert error.value.status_code == 400
+
+def test_any_valid_name_is_accepted_without_allowed_list():
+    fields = projections.parse_fields("price,custom_field", None, projections.PRODUCT_VIEWS)
+    assert fields == ("price", "custom_field")
+
+def test_describe():
+    assert projections.describe(None) == "full"
+    assert projections.describe(("offer_id", "profit")) == "offer_id,profit"
+
+def test_project():
+    items = [{"offer_id": "A-1", "profit": 10, "images": ["a.jpg"]}, {"offer_id": "B-2"}]
+    assert projections.project(items, ("offer_id", "profit")) == [{"offer_id": "A-1", "profit": 10}, {"offer_id": "B-2"}]
+    # Без выбора полей список возвращается как есть
+    assert projections.project(items, None) is items
+    assert projections.project(iter(items), None) == items
@@ -0,0 +1,51 @@
+import asyncio
+import json
+import pytest
+import refresh_progress
+
+@pytest.fixture(autouse=True)
+def local_events(monkeypatch):
+    # Redis в тестах недоступен: события передаются внутри процесса
+    monkeypatch.setattr(refresh_progress, "_local_events", {})
+    monkeypatch.setattr(refresh_progress, "_local_subscribers", {})
+
+async def collect(telegram_id, skip_finished=False, publish=()):
+    """Подписывается на события и публикует publish после подписки"""
+    stages = []
+    stream = refresh_progress.subscribe(telegram_id, skip_finished)
+    for stage in publish:
+        asyncio.get_running_loop().call_soon(refresh_progress.publish, telegram_id, stage)
+    async for event in stream:
+        stages.append(event["stage"])
+    return stages
+
+def test_new_run_replaces_previous_events():
+    for stage in ("queued", "started", "done", "queued", "started"):
+        refresh_progress.publish(1, stage)
+    assert [event["stage"] for event in refresh_progress.get_events(1)] == ["queued", "started"]
+
+    # started без постановки в очередь (ночное обновление) тоже начинает новое обновление
+    refresh_progress.publish(1, "done")
+    refresh_progress.publish(1, "started")
+    assert [event["stage"] for event in refresh_progress.get_events(1)] == ["started"]
+
+def test_subscriber_gets_passed_stages_then_new_ones():
+    refresh_progress.publish(1, "queued")
+    refresh_progress.publish(1, "started")
+    assert asyncio.run(collect(1, publish=("catalog", "done"))) == ["queued", "started", "catalog", "done"]
+    assert 1 not in refresh_progress._local_subscribers
+
+def test_finished_run_is_replayed_unless_skipped():
+    for stage in ("queued", "done"):
+        refresh_progress.publish(1, stage)
+    assert asyncio.run(collect(1)) == ["queued", "done"]
+    # Клиент подписался до запроса на обновление и ждет следующего
+    assert asyncio.run(collect(1, skip_finished=True, publish=("queued", "error"))) == ["queued", "error"]
+
+def test_format_sse():
+    assert refresh_progress.format_sse(None) == ": keepalive\n\n"
+    message = refresh_progress.format_sse({"stage": "analytics", "ts": 1.0, "summary": {"profit": 5}})
+    name, data, end = message.split("\n", 2)
+    assert name == "event: analytics"
+    assert json.loads(data[len("data: "):]) == {"stage": "analytics", "ts": 1.0, "summary": {"profit": 5}}
+    assert end == "\n"
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+import refresh_scheduler
+from refresh_scheduler import SCHEDULE_TIMEZONE
+from database import get_db, PortableCursor
+
+def set_last_active(telegram_id, days_ago):
+    last_active = (datetime.utcnow() - timedelta(days=days_ago)).strftime("%Y-%m-%d %H:%M:%S")
+    with get_db() as conn:
+        PortableCursor(conn).execute("UPDATE user_tokens SET last_updated = ? WHERE telegram_id = ?", (last_active, telegram_id))
+        conn.commit()
+
+def schedule():
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute("SELECT telegram_id, tier, next_run_at FROM refresh_schedule ORDER BY telegram_id")
+        return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+def test_next_run_falls_into_window_in_schedule_timezone():
+    after = datetime(2024, 3, 1, 12, 0, tzinfo=SCHEDULE_TIMEZONE)
+    for telegram_id in range(1, 50):
+        for tier in ("active", "idle"):
+            run = refresh_scheduler.compute_next_run(telegram_id, tier, after)
+            assert run.tzinfo is SCHEDULE_TIMEZONE
+            assert run.date() == after.date() + timedelta(days=1)
+            assert refresh_scheduler.REFRESH_WINDOW_START_HOUR <= run.hour < refresh_scheduler.REFRESH_WINDOW_END_HOUR
+
+
+def test_active_users_come_first_in_window():
+    after = datetime(2024, 3, 1, 12, 0, tzinfo=SCHEDULE_TIMEZONE)
+    active = max(refresh_scheduler.compute_next_run(i, "active", after) for i in range(1, 50))
+    idle = min(refresh_scheduler.compute_next_run(i, "idle", after) for i in range(1, 50))
+    assert active <= idle
+
+def test_interval_skips_days():
+    after = datetime(2024, 3, 1, 12, 0, tzinfo=SCHEDULE_TIMEZONE)
+    run = refresh_scheduler.compute_next_run(1, "dormant", after, days=7)
+    assert run.date() == datetime(2024, 3, 8).date()
+
+def test_daily_report_subscribers_stay_in_active_tier(add_user):
+    add_user(1)
+    add_user(2, daily_report=True)
+    add_user(3)
+    for telegram_id in (1, 2, 3):
+        set_last_active(telegram_id, days_ago=60)
+    set_last_active(3, days_ago=10)
+
+    assert refresh_scheduler.sync_schedule() == {"added": 3, "retiered": 0, "removed": 0}
+    assert {telegram_id: tier for telegram_id, (tier, _) in schedule().items()} == {
+        1: "dormant", 2: "active", 3: "idle",
+    }
+
+def test_sync_schedule_without_settings_table(db):
+    import database
+    database.init_db()
+    with get_db() as conn:
+        PortableCursor(conn).execute("INSERT INTO user_tokens (telegram_id) VALUES (?)", (1,))
+        conn.commit()
+    assert refresh_scheduler.sync_schedule()["added"] == 1
+
+def test_claim_due_users_moves_next_run(add_user):
+    add_user(1)
+    add_user(2)
+    refresh_scheduler.sync_schedule()
+    with get_db() as conn:
+        PortableCursor(conn).execute("UPDATE refresh_schedule SET next_run_at = 0 WHERE telegram_id = 1")
+        conn.commit()
+
+    assert refresh_scheduler.claim_due_users() == [1]
+    assert refresh_scheduler.claim_due_users() == []
+    next_run = datetime.fromtimestamp(schedule()[1][1], SCHEDULE_TIMEZONE)
+    assert next_run > refresh_scheduler.now_local()
+    assert refresh_scheduler.REFRESH_WINDOW_START_HOUR <= next_run.hour < refresh_scheduler.REFRESH_WINDOW_END_HOUR
@@ -0,0 +1,125 @@
+import asyncio
+import pytest
+import fast_json
+import redis_store
+import singleflight
+
+class FakeRedis:
+    """Асинхронный Redis в памяти: SET NX, GET и скрипт снятия аренды"""
+
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value.encode() if isinstance(value, str) else value
+        return True
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def eval(self, script, numkeys, key, token):
+        if self.data.get(key) == token.encode():
+            del self.data[key]
+            return 1
+        return 0
+
+@pytest.fixture(autouse=True)
+def metrics(monkeypatch):
+    monkeypatch.setattr(singleflight, "_metrics", dict.fromkeys(singleflight._metrics, 0))
+    monkeypatch.setattr(singleflight, "SINGLEFLIGHT_POLL_INTERVAL", 0.01)
+    return singleflight._metrics
+
+def use_redis(monkeypatch, client):
+    monkeypatch.setattr(redis_store, "get_async_redis", lambda: client)
+    return client
+
+def make_compute(calls, result=None, delay=0.01, error=None):
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return {"items": [1, 2]} if result is None else result
+    return compute
+
+def test_concurrent_calls_share_one_computation_without_redis(metrics):
+    # В тестах Redis недоступен: расчеты объединяются внутри процесса
+    calls = []
+
+    async def main():
+        compute = make_compute(calls)
+        return await asyncio.gather(*(singleflight.run("dashboard:1", compute) for _ in range(3)))
+
+    results = asyncio.run(main())
+    assert calls == [1]
+    assert results == [{"items": [1, 2]}] * 3
+    # Каждый участник получает свою копию
+    assert len({id(result) for result in results}) == 3
+    assert metrics["computed"] == 1 and metrics["shared_local"] == 2
+    assert singleflight.get_metrics()["inflight"] == 0
+
+def test_error_is_passed_to_waiters():
+    calls = []
+
+    async def main():
+        compute = make_compute(calls, error=ValueError("ozon"))
+        return await asyncio.gather(*(singleflight.run("abc:1", compute) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert calls == [1]
+    assert all(isinstance(result, ValueError) for result in results)
+
+def test_waiter_recomputes_when_leader_is_cancelled():
+    calls = []
+
+    async def main():
+        compute = make_compute(calls, delay=0.05)
+        leader = asyncio.ensure_future(singleflight.run("abc:1", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(singleflight.run("abc:1", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await waiter
+
+    assert asyncio.run(main()) == {"items": [1, 2]}
+    assert calls == [1, 1]
+
+def test_result_is_published_and_lease_released(monkeypatch):
+    client = use_redis(monkeypatch, FakeRedis())
+    assert asyncio.run(singleflight.run("abc:1", make_compute([]))) == {"items": [1, 2]}
+    assert singleflight.lease_key("abc:1") not in client.data
+    [published] = [key for key in client.data if key.startswith("singleflight:result:abc:1:")]
+    assert fast_json.loads(client.data[published]) == {"items": [1, 2]}
+
+def test_result_of_other_worker_is_reused(monkeypatch, metrics):
+    client = use_redis(monkeypatch, FakeRedis({singleflight.lease_key("abc:1"): b"other"}))
+
+    async def main():
+        waiter = asyncio.ensure_future(singleflight.run("abc:1", make_compute(calls)))
+        await asyncio.sleep(0.02)
+        # Другой воркер публикует результат и снимает аренду
+        client.data[singleflight.result_key("abc:1", "other")] = fast_json.dumps({"items": [3]})
+        del client.data[singleflight.lease_key("abc:1")]
+        return await waiter
+
+    calls = []
+    assert asyncio.run(main()) == {"items": [3]}
+    assert calls == []
+    assert metrics["shared_remote"] == 1
+
+def test_lost_lease_is_computed_again(monkeypatch, metrics):
+    client = use_redis(monkeypatch, FakeRedis({singleflight.lease_key("abc:1"): b"other"}))
+
+    async def main():
+        waiter = asyncio.ensure_future(singleflight.run("abc:1", make_compute(calls)))
+        await asyncio.sleep(0.02)
+        # Другой воркер завершился с ошибкой, не опубликовав результат
+        del client.data[singleflight.lease_key("abc:1")]
+        return await waiter
+
+    calls = []
+    assert asyncio.run(main()) == {"items": [1, 2]}
+    assert calls == [1]
+    assert metrics["lease_lost"] == 1
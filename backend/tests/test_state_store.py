@@ -0,0 +1,88 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+import pytest
+from cryptography.fernet import Fernet
+import state_store
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_state_round_trip_without_redis(db):
+    assert run(state_store.get_state(1)) is None
+    assert run(state_store.get_state_name(1)) == state_store.IDLE
+
+    run(state_store.set_state(1, "waiting_for_api_token", chat_id=5))
+    assert run(state_store.get_state(1)) == {"state": "waiting_for_api_token", "chat_id": 5}
+
+    run(state_store.set_state(1, "waiting_for_client_id", api_token="token"))
+    assert run(state_store.get_state_name(1)) == "waiting_for_client_id"
+
+    run(state_store.clear_state(1))
+    assert run(state_store.get_state(1)) is None
+
+def test_expired_state_is_idle(db):
+    run(state_store.set_state(1, "waiting_for_api_token", ttl=-1))
+    assert run(state_store.get_state_name(1)) == state_store.IDLE
+
+def test_transition_compares_current_state(db):
+    assert run(state_store.transition(1, "waiting_for_api_token", "waiting_for_client_id")) is False
+    assert run(state_store.transition(1, state_store.IDLE, "waiting_for_api_token")) is True
+    assert run(state_store.transition(1, state_store.IDLE, "waiting_for_api_token")) is False
+    assert run(state_store.transition(1, "waiting_for_api_token", "waiting_for_client_id", api_token="token")) is True
+    assert run(state_store.get_state(1)) == {"state": "waiting_for_client_id", "api_token": "token"}
+    assert run(state_store.transition(1, "waiting_for_client_id", state_store.IDLE)) is True
+    assert run(state_store.get_state(1)) is None
+
+def test_concurrent_transitions_have_one_winner(db):
+    state_store.init_conversation_states_table()
+    results = []
+    barrier = threading.Barrier(8)
+
+    def worker():
+        barrier.wait()
+        results.append(run(state_store.transition(1, state_store.IDLE, "waiting_for_api_token")))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [False] * 7 + [True]
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+@pytest.fixture
+def app_module(db, monkeypatch):
+    import app
+    monkeypatch.setattr(app, "_cipher_suite", Fernet(Fernet.generate_key()))
+    return app
+
+def send(app, text, user_id=1):
+    update = SimpleNamespace(message=FakeMessage(text), effective_user=SimpleNamespace(id=user_id))
+    run(app.handle_message(update, None))
+    return update.message.replies
+
+def test_api_token_is_stored_encrypted(app_module):
+    token = "0123abcd-4567-89ef-0123-456789abcdef"
+    run(state_store.set_state(1, "waiting_for_api_token"))
+    send(app_module, token)
+
+    state = run(state_store.get_state(1))
+    assert state["state"] == "waiting_for_client_id"
+    assert token not in state["api_token"]
+    assert app_module.decrypt_tokens(state["api_token"]) == {"api_token": token}
+
+def test_unreadable_api_token_restarts_input(app_module):
+    # Состояние, сохраненное без шифрования
+    run(state_store.set_state(1, "waiting_for_client_id", api_token="0123abcd-4567-89ef"))
+    replies = send(app_module, "12345")
+    assert run(state_store.get_state_name(1)) == "waiting_for_api_token"
+    assert replies[-1].startswith("❌ Не удалось прочитать сохраненный API токен")
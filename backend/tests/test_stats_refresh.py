@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+import refresh_progress
+from data_versions import save_snapshot
+
+ANALYTICS = {"revenue": 1000, "profit": 200, "margin": 20, "roi": 40}
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+
+    async def edit_message_text(self, chat_id, message_id, text, parse_mode=None):
+        self.edits.append(text)
+
+@pytest.fixture
+def app_module(db, monkeypatch):
+    import app
+    bot = FakeBot()
+    monkeypatch.setattr(app, "get_telegram_bot", lambda: bot)
+    monkeypatch.setattr(refresh_progress, "_local_events", {})
+    app.fake_bot = bot
+    return app
+
+def test_message_is_edited_when_queued_refresh_finishes(app_module, monkeypatch):
+    import celery_app
+    queued = []
+
+    def enqueue(user_id):
+        queued.append(user_id)
+        # Воркер обновил данные и сообщил об окончании
+        save_snapshot(user_id, "analytics_month", {**ANALYTICS, "profit": 5000})
+        refresh_progress.publish(user_id, "done")
+        return {"status": "queued", "user_id": user_id}
+
+    monkeypatch.setattr(celery_app, "enqueue_user_refresh", enqueue)
+    asyncio.run(app_module.refresh_stats_message(1, 1, 10, None))
+    assert queued == [1]
+    assert len(app_module.fake_bot.edits) == 1
+    assert "Прибыль:* 5 000" in app_module.fake_bot.edits[0]
+
+def test_user_is_told_refresh_is_queued(app_module, monkeypatch):
+    import celery_app
+    monkeypatch.setattr(celery_app, "enqueue_user_refresh", lambda user_id: {"status": "in_progress", "user_id": user_id})
+    monkeypatch.setattr(app_module, "STATS_REFRESH_WAIT_SECONDS", 0.2)
+
+    asyncio.run(app_module.refresh_stats_message(2, 2, 10, None))
+    assert app_module.fake_bot.edits[-1].startswith("⏳ Обновление данных поставлено в очередь")
+
+    # Устаревшие цифры остаются в сообщении
+    save_snapshot(2, "analytics_month", ANALYTICS)
+    computed_at = app_module.get_snapshot(2, "analytics_month")["computed_at"]
+    asyncio.run(app_module.refresh_stats_message(2, 2, 10, computed_at))
+    assert "Обновление данных в очереди" in app_module.fake_bot.edits[-1]
+    assert "Прибыль:* 200" in app_module.fake_bot.edits[-1]
+
+def test_failed_refresh_reports_error(app_module, monkeypatch):
+    import celery_app
+
+    def enqueue(user_id):
+        refresh_progress.publish(user_id, "error", message="Invalid Api-Key")
+        return {"status": "queued", "user_id": user_id}
+
+    monkeypatch.setattr(celery_app, "enqueue_user_refresh", enqueue)
+    asyncio.run(app_module.refresh_stats_message(3, 3, 10, None))
+    assert app_module.fake_bot.edits[-1].startswith("❌ Не удалось получить статистику")
+
+def test_previous_finished_refresh_is_not_taken_for_new_one(app_module, monkeypatch):
+    import celery_app
+    refresh_progress.publish(4, "started")
+    refresh_progress.publish(4, "done")
+
+    def enqueue(user_id):
+        refresh_progress.publish(user_id, "queued", task_id="t")
+        return {"status": "queued", "user_id": user_id}
+
+    monkeypatch.setattr(celery_app, "enqueue_user_refresh", enqueue)
+    monkeypatch.setattr(app_module, "STATS_REFRESH_WAIT_SECONDS", 0.2)
+    asyncio.run(app_module.refresh_stats_message(4, 4, 10, None))
+    assert app_module.fake_bot.edits[-1].startswith("⏳ Обновление данных поставлено в очередь")
@@ -0,0 +1,25 @@
+import pytest
+import telegram_client
+
+@pytest.fixture(autouse=True)
+def latency(monkeypatch):
+    monkeypatch.setattr(telegram_client, "_latency", {})
+
+def test_latency_histogram_by_method():
+    for seconds in (0.01, 0.02, 0.03, 0.2):
+        telegram_client.record_latency("sendMessage", seconds)
+    telegram_client.record_latency("sendMessage", 7.0, ok=False)
+    telegram_client.record_latency("setWebhook", 0.06)
+
+    metrics = telegram_client.get_latency_metrics()
+    assert list(metrics) == ["sendMessage", "setWebhook"]
+    send = metrics["sendMessage"]
+    assert (send["count"], send["errors"], send["max_ms"]) == (5, 1, 7000.0)
+    assert send["buckets"]["le_25"] == 2 and send["buckets"]["inf"] == 1
+    assert send["p50_ms"] == 50
+    # Верхняя корзина не ограничена - квантиль оценивается максимумом
+    assert send["p95_ms"] == 7000.0
+
+def test_empty_histogram():
+    metrics = telegram_client.LatencyHistogram().to_dict()
+    assert metrics["count"] == 0 and metrics["p50_ms"] is None and metrics["avg_ms"] == 0
@@ -0,0 +1,36 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+import telegram
+
+@pytest.fixture
+def app_module(monkeypatch):
+    import app
+    monkeypatch.setattr(app, "telegram_application", None)
+    monkeypatch.setattr(app, "bot", None)
+    return app
+
+def test_bot_is_not_created_at_import(app_module):
+    with pytest.raises(RuntimeError):
+        app_module.get_telegram_bot()
+
+def test_bot_comes_from_initialized_application(app_module, monkeypatch):
+    application = SimpleNamespace(bot=object())
+
+    async def initialize():
+        pass
+
+    application.initialize = initialize
+    monkeypatch.setattr(app_module, "build_telegram_application", lambda: application)
+    asyncio.run(app_module.start_telegram_application())
+    assert app_module.telegram_application is application
+    assert app_module.get_telegram_bot() is application.bot
+
+def test_standalone_bot_when_application_fails(app_module, monkeypatch):
+    def fail():
+        raise telegram.error.NetworkError("getMe timed out")
+
+    monkeypatch.setattr(app_module, "build_telegram_application", fail)
+    asyncio.run(app_module.start_telegram_application())
+    assert app_module.telegram_application is None
+    assert isinstance(app_module.get_telegram_bot(), telegram.Bot)
@@ -0,0 +1,59 @@
+import asyncio
+import update_dedup
+
+def mark(update_id):
+    return asyncio.run(update_dedup.mark_update_seen(update_id))
+
+class FakeRedis:
+    """Асинхронный Redis в памяти: SET NX, INCR, GET и DELETE"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+def test_update_is_accepted_once_without_redis(db):
+    assert mark(101) is True
+    assert mark(101) is False
+    assert mark(102) is True
+
+    metrics = asyncio.run(update_dedup.get_dedup_metrics())
+    assert metrics["duplicates"] >= 1
+    assert metrics["duplicates_all_workers"] is None
+
+def test_forgotten_update_is_accepted_again(db):
+    assert mark(7) is True
+    asyncio.run(update_dedup.forget_update(7))
+    assert mark(7) is True
+
+def test_expired_updates_are_cleaned_up(db, monkeypatch):
+    mark(1)
+    monkeypatch.setattr(update_dedup, "UPDATE_DEDUP_TTL", -1)
+    # Очистка выполняется на каждом сотом обновлении
+    mark(100)
+    monkeypatch.setattr(update_dedup, "UPDATE_DEDUP_TTL", 86400)
+    assert mark(1) is True
+
+def test_update_is_accepted_once_with_redis(monkeypatch):
+    client = FakeRedis()
+    monkeypatch.setattr(update_dedup, "get_async_redis", lambda: client)
+
+    assert mark(5) is True
+    assert mark(5) is False
+    assert asyncio.run(update_dedup.get_dedup_metrics())["duplicates_all_workers"] == 1
+    asyncio.run(update_dedup.forget_update(5))
+    assert mark(5) is True
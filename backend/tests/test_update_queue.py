@@ -0,0 +1,55 @@
+import asyncio
+import update_queue
+from update_queue import UpdateDispatcher
+
+def message_update(update_id, chat_id):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": "hi"}}
+
+def test_pending_updates_are_taken_once_in_order(db):
+    assert update_queue.take_pending_updates() == []
+    updates = [message_update(i, 1) for i in range(3)]
+    assert update_queue.save_pending_updates(updates) == 3
+    assert update_queue.save_pending_updates([]) == 0
+
+    assert update_queue.take_pending_updates() == updates
+    assert update_queue.take_pending_updates() == []
+
+def test_updates_of_one_chat_are_processed_in_order():
+    processed = []
+
+    async def handler(update_data):
+        await asyncio.sleep(0.01 if update_data["update_id"] % 2 else 0)
+        processed.append(update_data["update_id"])
+
+    async def scenario():
+        dispatcher = UpdateDispatcher(handler, workers=4)
+        dispatcher.start()
+        for update_id in range(10):
+            assert dispatcher.submit(message_update(update_id, 7))
+        assert await dispatcher.drain(timeout=5) == []
+        return dispatcher.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert processed == list(range(10))
+    assert metrics["processed"] == 10 and metrics["failed"] == 0
+
+def test_drain_returns_unprocessed_updates():
+    async def handler(update_data):
+        await asyncio.sleep(10)
+
+    async def scenario():
+        dispatcher = UpdateDispatcher(handler, workers=1, max_queue_size=2)
+        dispatcher.start()
+        assert dispatcher.submit(message_update(1, 1))
+        await asyncio.sleep(0)
+        assert dispatcher.submit(message_update(2, 1))
+        assert dispatcher.submit(message_update(3, 1))
+        # Очередь заполнена - Telegram повторит доставку
+        assert not dispatcher.submit(message_update(4, 1))
+
+        left = await dispatcher.drain(timeout=0.05)
+        assert not dispatcher.submit(message_update(5, 1))
+        return left
+
+    left = asyncio.run(scenario())
+    assert [update["update_id"] for update in left] == [1, 2, 3]
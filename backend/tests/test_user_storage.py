@@ -0,0 +1,32 @@
+import asyncio
+import services
+
+def test_web_service_users_are_visible_to_workers(db):
+    import app
+    assert app.init_db()
+
+    app.save_user_token_db(app.UserToken(telegram_id=5_000_000_001, username="seller", ozon_api_token="t1", ozon_client_id="c1"))
+    app.save_user_token_db(app.UserToken(telegram_id=5_000_000_001, username="seller", ozon_api_token="t2", ozon_client_id="c2"))
+    app.update_token_usage(5_000_000_001)
+
+    token = asyncio.run(app.get_user_tokens(5_000_000_001))
+    assert (token.ozon_api_token, token.ozon_client_id) == ("t2", "c2")
+    # Воркеры Celery читают ту же базу
+    assert services.get_all_user_ids() == [5_000_000_001]
+    assert services.get_user_credentials(5_000_000_001) == ("t2", "c2")
+
+    assert asyncio.run(app.delete_user_tokens(5_000_000_001))
+    assert services.get_all_user_ids() == []
+
+def test_notification_settings_upsert(db):
+    import app
+    assert app.init_db()
+
+    settings = asyncio.run(app.get_notification_settings(7))
+    assert settings.margin_threshold == 15.0 and not settings.daily_report
+
+    settings.margin_threshold = 20.0
+    settings.daily_report = True
+    assert asyncio.run(app.save_notification_settings(settings))
+    saved = asyncio.run(app.get_notification_settings(7))
+    assert saved.margin_threshold == 20.0 and saved.daily_report
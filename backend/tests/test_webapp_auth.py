@@ -0,0 +1,46 @@
+import time
+from urllib.parse import urlencode
+import pytest
+from fastapi.testclient import TestClient
+import webapp_auth
+
+BOT_TOKEN = "123456:TEST"
+
+def make_init_data(user_id=1, auth_date=None, bot_token=BOT_TOKEN):
+    fields = {
+        "auth_date": str(int(auth_date if auth_date is not None else time.time())),
+        "query_id": "AAE",
+        "user": f'{{"id":{user_id},"first_name":"Тест"}}',
+    }
+    return urlencode({**fields, "hash": webapp_auth.sign_init_data(fields, bot_token)})
+
+def test_valid_init_data_returns_user():
+    assert webapp_auth.validate_init_data(make_init_data(42), BOT_TOKEN)["id"] == 42
+
+def test_invalid_init_data_is_rejected():
+    assert webapp_auth.validate_init_data(None, BOT_TOKEN) is None
+    assert webapp_auth.validate_init_data(make_init_data(bot_token="654321:OTHER"), BOT_TOKEN) is None
+    assert webapp_auth.validate_init_data(make_init_data().replace("%3A1%2C", "%3A2%2C"), BOT_TOKEN) is None
+    assert webapp_auth.validate_init_data(make_init_data(auth_date=time.time() - 7200), BOT_TOKEN, max_age=3600) is None
+
+@pytest.fixture
+def client(monkeypatch):
+    import app
+    monkeypatch.setattr(app, "TELEGRAM_BOT_TOKEN", BOT_TOKEN)
+    return TestClient(app.app)
+
+def test_refresh_events_require_owner(client):
+    assert client.get("/api/refresh/1/events").status_code == 401
+    assert client.get("/api/refresh/1/events", params={"init_data": make_init_data(2)}).status_code == 403
+    response = client.post("/api/refresh/1", headers={"X-Telegram-Init-Data": make_init_data(2)})
+    assert response.status_code == 403
+
+def test_owner_receives_refresh_events(client, monkeypatch):
+    import refresh_progress
+    monkeypatch.setattr(refresh_progress, "_local_events", {})
+    refresh_progress.publish(1, "queued")
+    refresh_progress.publish(1, "done")
+
+    response = client.get("/api/refresh/1/events", params={"init_data": make_init_data(1)})
+    assert response.status_code == 200
+    assert "event: queued" in response.text and "event: done" in response.text
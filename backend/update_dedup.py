@@ -0,0 +1,92 @@
+# Защита от повторной обработки обновлений Telegram.
+# Telegram повторяет доставку, если вебхук ответил медленно или с ошибкой, а повтор может
+# попасть в другой процесс gunicorn. Поэтому update_id уже принятых обновлений хранятся
+# в общем для всех процессов хранилище с ограниченным временем жизни: в Redis,
+# а если он недоступен - в таблице seen_updates.
+# Проверка выполняется в обработчике вебхука, поэтому Redis вызывается асинхронным клиентом,
+# а запросы к базе выполняются в потоке, чтобы не блокировать цикл событий.
+import os
+import time
+import asyncio
+import redis
+from database import get_db, PortableCursor
+from redis_store import get_async_redis
+
+# Сколько помнить обработанные обновления (Telegram повторяет доставку не дольше суток)
+UPDATE_DEDUP_TTL = int(os.getenv("TELEGRAM_UPDATE_DEDUP_TTL", "86400"))
+
+DUPLICATES_COUNTER_KEY = "tg:update:duplicates"
+
+# Счетчики текущего процесса
+local_stats = {"checked": 0, "duplicates": 0, "fallback": 0}
+
+def init_seen_updates_table():
+    """Создает таблицу принятых обновлений (используется, если Redis недоступен)"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS seen_updates (
+                update_id BIGINT PRIMARY KEY,
+                seen_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.commit()
+
+def _mark_seen_in_db(update_id: int) -> bool:
+    now = time.time()
+    init_seen_updates_table()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('INSERT INTO seen_updates (update_id, seen_at) VALUES (?, ?) ON CONFLICT DO NOTHING', (update_id, now))
+        first_time = cursor.rowcount == 1
+        # Удаляем устаревшие записи, чтобы таблица не росла
+        if update_id % 100 == 0:
+            cursor.execute('DELETE FROM seen_updates WHERE seen_at < ?', (now - UPDATE_DEDUP_TTL,))
+        conn.commit()
+    return first_time
+
+def _forget_in_db(update_id: int):
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute('DELETE FROM seen_updates WHERE update_id = ?', (update_id,))
+        conn.commit()
+
+async def mark_update_seen(update_id: int) -> bool:
+    """
+    Атомарно отмечает обновление как принятое.
+    Возвращает True, если обновление пришло впервые, и False для повторной доставки
+    """
+    local_stats["checked"] += 1
+    try:
+        client = get_async_redis()
+        first_time = bool(await client.set(f"tg:update:{update_id}", "1", nx=True, ex=UPDATE_DEDUP_TTL))
+        if not first_time:
+            await client.incr(DUPLICATES_COUNTER_KEY)
+    except redis.RedisError:
+        local_stats["fallback"] += 1
+        first_time = await asyncio.to_thread(_mark_seen_in_db, update_id)
+
+    if not first_time:
+        local_stats["duplicates"] += 1
+    return first_time
+
+async def forget_update(update_id: int):
+    """Снимает отметку, если обновление не удалось принять в обработку и Telegram пришлет его снова"""
+    try:
+        await get_async_redis().delete(f"tg:update:{update_id}")
+    except redis.RedisError:
+        await asyncio.to_thread(_forget_in_db, update_id)
+
+async def get_dedup_metrics() -> dict:
+    """Число проверенных и отброшенных повторных обновлений (в процессе и по всем процессам)"""
+    try:
+        total_duplicates = int(await get_async_redis().get(DUPLICATES_COUNTER_KEY) or 0)
+    except redis.RedisError:
+        total_duplicates = None
+
+    return {
+        "checked": local_stats["checked"],
+        "duplicates": local_stats["duplicates"],
+        "fallback_checks": local_stats["fallback"],
+        "duplicates_all_workers": total_duplicates,
+    }
@@ -0,0 +1,203 @@
+# Очередь обработки обновлений Telegram.
+# Вебхук только проверяет обновление, ставит его в очередь и сразу отвечает Telegram,
+# а обработку выполняет пул асинхронных обработчиков. Обновления одного чата попадают
+# в одну и ту же очередь (по хешу chat_id) и обрабатываются строго по порядку,
+# обновления разных чатов обрабатываются параллельно.
+# Обновления, которые не успели обработать до остановки процесса, сохраняются в таблицу
+# pending_updates и обрабатываются следующим запущенным процессом.
+import logging
+import os
+import json
+import time
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+from database import get_db, PortableCursor, id_column
+
+logger = logging.getLogger(__name__)
+
+# Настройки по умолчанию (можно переопределить переменными окружения)
+UPDATE_WORKERS = int(os.getenv("TELEGRAM_UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("TELEGRAM_UPDATE_QUEUE_SIZE", "1000"))  # суммарно на все очереди
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("TELEGRAM_UPDATE_DRAIN_TIMEOUT", "20"))  # секунды
+
+def get_update_chat_id(update_data: dict) -> Optional[int]:
+    """Возвращает ID чата, к которому относится обновление"""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = update_data.get(key)
+        if isinstance(message, dict):
+            return message.get("chat", {}).get("id")
+
+    callback_query = update_data.get("callback_query")
+    if isinstance(callback_query, dict):
+        message = callback_query.get("message") or {}
+        return message.get("chat", {}).get("id") or callback_query.get("from", {}).get("id")
+
+    return None
+
+class UpdateDispatcher:
+    """Пул обработчиков обновлений с упорядоченной обработкой внутри чата"""
+
+    def __init__(
+        self,
+        handler: Callable[[dict], Awaitable[None]],
+        workers: int = UPDATE_WORKERS,
+        max_queue_size: int = UPDATE_QUEUE_SIZE,
+    ):
+        self.handler = handler
+        self.queues: List[asyncio.Queue] = [
+            asyncio.Queue(maxsize=max(1, max_queue_size // workers)) for _ in range(workers)
+        ]
+        self.tasks: List[asyncio.Task] = []
+        self.accepting = False
+        # Обновления, обработка которых была прервана остановкой
+        self.interrupted: List[dict] = []
+
+        # Счетчики для метрик
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_processing = 0.0
+
+    def start(self):
+        """Запускает обработчики очередей"""
+        self.accepting = True
+        self.tasks = [asyncio.create_task(self._consume(queue)) for queue in self.queues]
+
+    def submit(self, update_data: dict) -> bool:
+        """
+        Ставит обновление в очередь его чата. Возвращает False, если очередь переполнена
+        или прием остановлен - тогда Telegram должен получить ошибку и повторить доставку позже
+        """
+        if not self.accepting:
+            self.rejected += 1
+            return False
+
+        chat_id = get_update_chat_id(update_data)
+        key = chat_id if chat_id is not None else update_data.get("update_id", 0)
+        queue = self.queues[hash(key) % len(self.queues)]
+
+        try:
+            queue.put_nowait((time.monotonic(), update_data))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+        self.accepted += 1
+        return True
+
+    async def _consume(self, queue: asyncio.Queue):
+        while True:
+            enqueued_at, update_data = await queue.get()
+            started = time.monotonic()
+            wait = started - enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.in_flight += 1
+            try:
+                await self.handler(update_data)
+                self.processed += 1
+            except asyncio.CancelledError:
+                self.interrupted.append(update_data)
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Ошибка при обработке обновления: {type(e).__name__}", extra={"update_id": update_data.get('update_id')})
+            finally:
+                self.in_flight -= 1
+                self.total_processing += time.monotonic() - started
+                queue.task_done()
+
+    async def drain(self, timeout: float = UPDATE_DRAIN_TIMEOUT) -> List[dict]:
+        """
+        Прекращает прием новых обновлений и ждет обработки уже принятых, но не дольше timeout.
+        Возвращает необработанные обновления: сначала прерванные, затем не начатые
+        """
+        self.accepting = False
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[queue.join() for queue in self.queues]),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Не все обновления обработаны за {timeout:.1f} с")
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        left = self.interrupted
+        self.interrupted = []
+        for queue in self.queues:
+            while not queue.empty():
+                _, update_data = queue.get_nowait()
+                left.append(update_data)
+        return left
+
+    def metrics(self) -> dict:
+        """Метрики очереди: глубина, отклоненные обновления, задержка и время обработки"""
+        depths = [queue.qsize() for queue in self.queues]
+        finished = self.processed + self.failed
+        return {
+            "workers": len(self.queues),
+            "capacity": sum(queue.maxsize for queue in self.queues),
+            "depth": sum(depths),
+            "max_shard_depth": max(depths) if depths else 0,
+            "in_flight": self.in_flight,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_wait_ms": round(self.total_wait / finished * 1000, 1) if finished else 0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_processing_ms": round(self.total_processing / finished * 1000, 1) if finished else 0,
+        }
+
+def init_pending_updates_table():
+    """Создает таблицу обновлений, отложенных при остановке процесса"""
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS pending_updates (
+                id {id_column(conn)},
+                payload TEXT NOT NULL,
+                saved_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.commit()
+
+def save_pending_updates(updates: List[dict]) -> int:
+    """Сохраняет необработанные обновления для следующего процесса"""
+    if not updates:
+        return 0
+
+    init_pending_updates_table()
+    now = time.time()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.executemany(
+            'INSERT INTO pending_updates (payload, saved_at) VALUES (?, ?)',
+            [(json.dumps(update_data, ensure_ascii=False), now) for update_data in updates]
+        )
+        conn.commit()
+    return len(updates)
+
+def take_pending_updates() -> List[dict]:
+    """
+    Забирает отложенные обновления (в порядке сохранения) и удаляет их из таблицы.
+    Если процессов несколько, каждое обновление достается только одному из них
+    """
+    init_pending_updates_table()
+    with get_db() as conn:
+        cursor = PortableCursor(conn)
+        cursor.begin_write()
+        cursor.execute('SELECT id, payload FROM pending_updates ORDER BY id' + cursor.for_update(skip_locked=True))
+        rows = cursor.fetchall()
+        cursor.executemany('DELETE FROM pending_updates WHERE id = ?', [(row[0],) for row in rows])
+        conn.commit()
+    return [json.loads(payload) for _, payload in rows]
+
@@ -0,0 +1,44 @@
+# Проверка данных запуска Telegram Mini App (initData).
+# Telegram подписывает initData ключом, производным от токена бота, поэтому по ним сервер
+# может убедиться, что запрос пришел от Mini App, открытого этим пользователем, и что
+# пользователь запрашивает свои данные, а не подставил чужой telegram_id в адрес.
+# Алгоритм: https://core.telegram.org/bots/webapps#validating-data-received-via-the-mini-app
+import hmac
+import json
+import os
+import time
+import hashlib
+from typing import Optional
+from urllib.parse import parse_qsl
+
+# Сколько действительны данные запуска Mini App (секунды)
+WEBAPP_INIT_DATA_MAX_AGE = int(os.getenv("WEBAPP_INIT_DATA_MAX_AGE", "86400"))
+
+def sign_init_data(fields: dict, bot_token: str) -> str:
+    """Подпись (hash) для полей initData"""
+    data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    return hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+
+def validate_init_data(init_data: Optional[str], bot_token: str, max_age: Optional[int] = None) -> Optional[dict]:
+    """
+    Проверяет подпись и срок действия initData. Возвращает пользователя Telegram
+    (словарь с полем id) или None, если данные отсутствуют, подделаны или устарели
+    """
+    if not init_data or not bot_token:
+        return None
+    max_age = WEBAPP_INIT_DATA_MAX_AGE if max_age is None else max_age
+
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop("hash", "")
+    if not hmac.compare_digest(sign_init_data(fields, bot_token), received_hash):
+        return None
+
+    try:
+        auth_date = int(fields.get("auth_date", "0"))
+        user = json.loads(fields.get("user", "null"))
+    except ValueError:
+        return None
+    if time.time() - auth_date > max_age or not isinstance(user, dict) or "id" not in user:
+        return None
+    return user
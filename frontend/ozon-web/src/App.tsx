@@ -13,6 +13,30 @@ interface Product {
   images: string[];
 }
 
+// Самый прибыльный товар из данных главного экрана (/api/dashboard)
+interface TopProduct {
+  product_id: number;
+  name: string;
+  offer_id: string;
+  profit: number;
+  profit_percent: number;
+}
+
+// ABC-статистика из данных главного экрана (/api/dashboard)
+interface AbcCategoryStats {
+  count: number;
+  profit: number;
+  profit_percent: number;
+}
+
+interface AbcStats {
+  A: AbcCategoryStats;
+  B: AbcCategoryStats;
+  C: AbcCategoryStats;
+  total_products: number;
+  total_profit: number;
+}
+
 // Интерфейс для токенов API
 interface ApiTokens {
   ozon_api_token: string;
@@ -383,6 +407,7 @@ function App() {
   const [activeTab, setActiveTab] = useState('home');
   const [products, setProducts] = useState<Product[]>([]);
   const [loading, setLoading] = useState(false);
+  const [refreshStage, setRefreshStage] = useState<string | null>(null);
   const [error, setError] = useState<string | null>(null);
   const [reportStatus, setReportStatus] = useState<string | null>(null);
   const [telegramUser, setTelegramUser] = useState<{id: number, username?: string} | null>(null);
@@ -447,6 +472,8 @@ function App() {
     margin_data: [] as number[],
     roi_data: [] as number[]
   });
+  const [topProduct, setTopProduct] = useState<TopProduct | null>(null);
+  const [abcStats, setAbcStats] = useState<AbcStats | null>(null);
 
   // Функции для расчетов
   const calculateMargin = (price: number, cost: number): number => {
@@ -462,8 +489,8 @@ function App() {
   // Состояние для себестоимости товаров
   const [productCosts, setProductCosts] = useState<Array<{product_id: number, cost: number}>>([]);
 
-  // Функция для получения аналитики с API
-  const fetchAnalytics = () => {
+  // Функция для получения данных главного экрана (сводка и товары) одним запросом
+  const fetchDashboard = (options?: RequestInit) => {
     if (!isApiAvailable) {
       setError('API сервер недоступен. Невозможно получить данные аналитики.');
       return Promise.reject(new Error('API_UNAVAILABLE'));
@@ -474,17 +501,39 @@ function App() {
       return Promise.reject(new Error('NOT_AUTHENTICATED'));
     }
     
-    const apiUrl = telegramUser 
-      ? `${API_URL}/api/analytics?period=${selectedPeriod}&telegram_id=${telegramUser.id}`
-      : `${API_URL}/analytics?period=${selectedPeriod}`;
-    
-    const headers: HeadersInit = telegramUser ? {} : {
-      'X-API-Key': localStorage.getItem('apiKey') || ''
-    };
-    
-    return fetchApi(apiUrl, { headers })
+    // API ключ передается в заголовке, чтобы он не попадал в адрес запроса (логи, история, Referer)
+    const apiUrl = telegramUser
+      ? `${API_URL}/api/dashboard?period=${selectedPeriod}&telegram_id=${telegramUser.id}`
+      : `${API_URL}/api/dashboard?period=${selectedPeriod}`;
+    const headers = new Headers(options?.headers);
+    if (!telegramUser) {
+      headers.set('X-API-Key', localStorage.getItem('apiKey') || '');
+    }
+
+    return fetchApi(apiUrl, { ...options, headers })
       .then(data => {
-        setAnalyticsData(data);
+        if (!data || !data.summary || !data.products || !Array.isArray(data.products.items)) {
+          throw new Error('Неверный формат данных');
+        }
+
+        setAnalyticsData(data.summary);
+        setTopProduct(data.top_product || null);
+        setAbcStats(data.abc || null);
+        
+        const productsWithCosts = data.products.items.map((product: any) => {
+          // Ищем сохраненную себестоимость для этого товара
+          const savedCost = productCosts.find((pc: {product_id: number, cost: number}) => pc.product_id === product.product_id);
+          const cost = savedCost ? savedCost.cost : (product.cost || 0);
+          
+          return {
+            ...product,
+            cost,
+            margin: calculateMargin(product.price, cost),
+            roi: calculateROI(product.price, cost)
+          };
+        });
+        
+        setProducts(productsWithCosts);
         setError(null);
         return data;
       })
@@ -493,67 +542,13 @@ function App() {
           setIsApiAvailable(false);
           setError('API сервер недоступен. Невозможно получить данные аналитики.');
         } else {
-          console.error('Ошибка при получении аналитики:', err);
+          console.error('Ошибка при получении данных:', err);
           setError('Ошибка при получении данных аналитики. Пожалуйста, попробуйте позже.');
         }
         throw err;
       });
   };
 
-  // Функция для получения списка товаров с API
-  const fetchProducts = () => {
-    if (!isApiAvailable) {
-      setError('API сервер недоступен. Невозможно получить список товаров.');
-      return Promise.reject(new Error('API_UNAVAILABLE'));
-    }
-    
-    if (!isAuthenticated && !telegramUser) {
-      setError('Необходимо авторизоваться через Telegram для получения данных.');
-      return Promise.reject(new Error('NOT_AUTHENTICATED'));
-    }
-    
-    const apiUrl = telegramUser 
-      ? `${API_URL}/api/products?period=${selectedPeriod}&telegram_id=${telegramUser.id}`
-      : `${API_URL}/products?period=${selectedPeriod}`;
-    
-    const headers: HeadersInit = telegramUser ? {} : {
-      'X-API-Key': localStorage.getItem('apiKey') || ''
-    };
-    
-    return fetchApi(apiUrl, { headers })
-      .then(data => {
-        if (data && data.result && Array.isArray(data.result.items)) {
-          const productsWithCosts = data.result.items.map((product: any) => {
-            // Ищем сохраненную себестоимость для этого товара
-            const savedCost = productCosts.find((pc: {product_id: number, cost: number}) => pc.product_id === product.product_id);
-            
-            return {
-              ...product,
-              cost: savedCost ? savedCost.cost : 0,
-              margin: calculateMargin(product.price, savedCost ? savedCost.cost : 0),
-              roi: calculateROI(product.price, savedCost ? savedCost.cost : 0)
-            };
-          });
-          
-          setProducts(productsWithCosts);
-          setError(null);
-          return productsWithCosts;
-        } else {
-          throw new Error('Неверный формат данных');
-        }
-      })
-      .catch(err => {
-        if (err.message === 'API_UNAVAILABLE') {
-          setIsApiAvailable(false);
-          setError('API сервер недоступен. Невозможно получить список товаров.');
-        } else {
-          console.error('Ошибка при получении списка товаров:', err);
-          setError('Ошибка при получении списка товаров. Пожалуйста, попробуйте позже.');
-        }
-        throw err;
-      });
-  };
-
   // Функция для получения токенов API от бота
   const fetchUserTokensFromBot = (userId: number) => {
     setLoading(true);
@@ -667,33 +662,20 @@ function App() {
     return () => clearInterval(apiCheckInterval);
   }, []);
 
+  // Вкладки товаров и аналитики показывают данные главного экрана: /api/dashboard отдает
+  // сводку, товары, ABC-статистику и товар дня одним запросом, а повторный запрос
+  // с неизменившимися данными сервер подтверждает по ETag без пересчета
   useEffect(() => {
-    if (activeTab === 'products' && isApiAvailable) {
+    if ((activeTab === 'products' || activeTab === 'analytics') && isApiAvailable && (isAuthenticated || telegramUser)) {
       setLoading(true);
       setError(null);
       
-      // Получаем API ключ
-      const apiKey = localStorage.getItem('apiKey');
-      
-      fetchApi(`${API_URL}/products`, {
-        headers: {
-          'X-API-Key': apiKey || ''
-        }
-      })
-        .then(data => {
-          if (data.result && Array.isArray(data.result.items)) {
-            setProducts(data.result.items);
-          } else {
-            setProducts([]);
-            console.warn('Неожиданный формат данных:', data);
-          }
-        })
+      fetchDashboard()
         .catch(err => {
           if (err.message === 'API_UNAVAILABLE') {
-            setIsApiAvailable(false);
             setError('API сервер недоступен. Работаем в оффлайн режиме с демо-данными.');
             // Используем тестовые данные
-            const mockProducts = [
+            setProducts([
               {
                 product_id: 123456,
                 name: "Демо товар 1",
@@ -710,58 +692,7 @@ function App() {
                 images: ["https://via.placeholder.com/150"],
                 cost: 1250
               }
-            ];
-            setProducts(mockProducts);
-          } else {
-            console.error('Ошибка при загрузке товаров:', err);
-            setError(`Не удалось загрузить товары: ${err.message}`);
-          }
-        })
-        .finally(() => {
-          setLoading(false);
-        });
-    }
-  }, [activeTab, isApiAvailable]);
-
-  useEffect(() => {
-    if (activeTab === 'analytics' && isAuthenticated && isApiAvailable) {
-      setLoading(true);
-      setError(null);
-      
-      // Параметры запроса в зависимости от выбранного периода
-      const params = new URLSearchParams({
-        period: selectedPeriod
-      });
-      
-      fetchApi(`${API_URL}/analytics?${params.toString()}`, {
-        headers: {
-          'X-API-Key': localStorage.getItem('apiKey') || ''
-        }
-      })
-        .then(data => {
-          console.log('Получены данные аналитики:', data);
-          // Обновляем состояние аналитики
-          setAnalyticsData({
-            sales: data.sales || 0,
-            margin: data.margin || 0,
-            roi: data.roi || 0,
-            profit: data.profit || 0,
-            total_products: data.total_products || 0,
-            active_products: data.active_products || 0,
-            orders: data.orders || 0,
-            average_order: data.average_order || 0,
-            marketplace_fees: data.marketplace_fees || 0,
-            advertising_costs: data.advertising_costs || 0,
-            sales_data: data.sales_data || [15000, 18000, 22000, 24500, 20000, 23000, 24500],
-            margin_data: data.margin_data || [18.5, 20.2, 22.8, 24.1, 23.5, 24.0, 23.5],
-            roi_data: data.roi_data || [33.2, 38.5, 41.2, 43.7, 42.1, 42.5, 42.8]
-          });
-        })
-        .catch(err => {
-          if (err.message === 'API_UNAVAILABLE') {
-            setIsApiAvailable(false);
-            setError('API сервер недоступен. Работаем в оффлайн режиме с демо-данными.');
-            // Используем тестовые данные аналитики
+            ]);
             setAnalyticsData({
               sales: 24500,
               margin: 23.5,
@@ -777,16 +708,13 @@ function App() {
               margin_data: [18.5, 20.2, 22.8, 24.1, 23.5, 24.0, 23.5],
               roi_data: [33.2, 38.5, 41.2, 43.7, 42.1, 42.5, 42.8]
             });
-          } else {
-            console.error('Ошибка при загрузке аналитики:', err);
-            setError(`Не удалось загрузить аналитику: ${err.message}`);
           }
         })
         .finally(() => {
           setLoading(false);
         });
     }
-  }, [activeTab, selectedPeriod, isAuthenticated, isApiAvailable]);
+  }, [activeTab, isAuthenticated, isApiAvailable]);
 
   // Сохранение токенов в localStorage с "шифрованием"
   const saveTokens = (newTokens: ApiTokens) => {
@@ -906,9 +834,8 @@ function App() {
   const refreshData = () => {
     setLoading(true);
     
-    // Получаем аналитику и товары (последовательно)
-    fetchAnalytics()
-      .then(() => fetchProducts())
+    // Сводка и товары приходят одним запросом
+    fetchDashboard()
       .then(() => {
         setLoading(false);
       })
@@ -918,6 +845,85 @@ function App() {
       });
   };
 
+  // Этапы обновления данных на сервере (см. /api/refresh/{telegram_id}/events)
+  const refreshStageLabels: {[stage: string]: string} = {
+    queued: 'Обновление поставлено в очередь...',
+    started: 'Обновление началось...',
+    catalog: 'Каталог товаров загружен, считаем аналитику...',
+    analytics: 'Аналитика рассчитана, выполняем ABC-анализ...',
+    abc: 'ABC-анализ готов, определяем товар дня...',
+    top_product: 'Товар дня определен, сохраняем данные...'
+  };
+  
+  // Обновление данных из Ozon по кнопке: сервер обновляет данные в фоне и сообщает о ходе
+  // обновления через Server-Sent Events, а экран обновляется по мере готовности этапов
+  const requestRefresh = () => {
+    if (!telegramUser || typeof EventSource === 'undefined') {
+      refreshData();
+      return;
+    }
+    if (refreshStage) {
+      // Обновление уже идет - повторное нажатие ничего не делает
+      return;
+    }
+    
+    setRefreshStage('queued');
+    // Подписываемся на ход обновления до запроса на обновление, чтобы не пропустить этапы.
+    // EventSource не передает заголовки, поэтому данные запуска Mini App идут в параметре
+    // init_data; завершенное ранее обновление сервер не повторяет (skip_finished)
+    const initData = window.Telegram?.WebApp?.initData || '';
+    const events = new EventSource(
+      `${API_URL}/api/refresh/${telegramUser.id}/events?skip_finished=1&init_data=${encodeURIComponent(initData)}`
+    );
+    let requested = false;
+    const finish = () => {
+      events.close();
+      setRefreshStage(null);
+    };
+    
+    events.addEventListener('open', () => {
+      if (requested) {
+        return;
+      }
+      requested = true;
+      fetchApi(`${API_URL}/api/refresh/${telegramUser.id}`, {
+        method: 'POST',
+        headers: { 'X-Telegram-Init-Data': initData }
+      })
+        .catch(err => {
+          console.error('Ошибка при запуске обновления данных:', err);
+          finish();
+          refreshData();
+        });
+    });
+    Object.keys(refreshStageLabels).forEach(stage => {
+      events.addEventListener(stage, (event: MessageEvent) => {
+        setRefreshStage(stage);
+        const data = JSON.parse(event.data);
+        if (stage === 'analytics' && data.summary) {
+          setAnalyticsData(data.summary);
+        }
+      });
+    });
+    events.addEventListener('done', () => {
+      finish();
+      // Копия в кеше браузера могла устареть - просим сервер проверить ETag
+      fetchDashboard({ cache: 'no-cache' }).catch(() => undefined);
+    });
+    events.addEventListener('error', (event: Event) => {
+      const message = (event as MessageEvent).data;
+      finish();
+      if (!requested) {
+        // Поток событий недоступен - обновляем экран обычным запросом
+        refreshData();
+        return;
+      }
+      setError(message
+        ? 'Не удалось обновить данные из Ozon. Пожалуйста, попробуйте позже.'
+        : 'Соединение с сервером прервано. Данные могут быть неактуальными.');
+    });
+  };
+
   // Сохранение себестоимости товаров
   const saveCosts = () => {
     if (!isAuthenticated) {
@@ -1039,9 +1045,10 @@ function App() {
             <h1>Товары</h1>
             <div className="header-actions">
               <PeriodSelector />
-              <button className="refresh-button" onClick={refreshData}>
+              <button className="refresh-button" onClick={requestRefresh} disabled={Boolean(refreshStage)}>
                 Обновить данные
               </button>
+              {refreshStage && <span className="refresh-stage">{refreshStageLabels[refreshStage]}</span>}
             </div>
             {loading && <p>Загрузка товаров...</p>}
             {error && <p className="error">{error}</p>}
@@ -1126,9 +1133,10 @@ function App() {
             <h1>Аналитика</h1>
             <div className="header-actions">
               <PeriodSelector />
-              <button className="refresh-button" onClick={refreshData}>
+              <button className="refresh-button" onClick={requestRefresh} disabled={Boolean(refreshStage)}>
                 Обновить данные
               </button>
+              {refreshStage && <span className="refresh-stage">{refreshStageLabels[refreshStage]}</span>}
             </div>
             
             {loading && <p>Загрузка данных...</p>}
@@ -1240,6 +1248,40 @@ function App() {
                     </div>
                   </div>
                 </div>
+
+                {topProduct && (
+                  <div className="analytics-summary">
+                    <h3>Товар дня</h3>
+                    <div className="summary-metrics">
+                      <div className="metric">
+                        <span className="metric-label">{topProduct.name} ({topProduct.offer_id}):</span>
+                        <span className="metric-value">{topProduct.profit.toFixed(2)} ₽</span>
+                      </div>
+                      <div className="metric">
+                        <span className="metric-label">Доля в прибыли:</span>
+                        <span className="metric-value">{topProduct.profit_percent.toFixed(2)}%</span>
+                      </div>
+                    </div>
+                  </div>
+                )}
+
+                {abcStats && (
+                  <div className="analytics-summary">
+                    <h3>ABC-анализ</h3>
+                    <div className="summary-metrics">
+                      {(['A', 'B', 'C'] as const).map(category => (
+                        <div className="metric" key={category}>
+                          <span className="metric-label">
+                            Категория {category} ({abcStats[category].count} из {abcStats.total_products}):
+                          </span>
+                          <span className="metric-value">
+                            {abcStats[category].profit.toFixed(2)} ₽ ({abcStats[category].profit_percent.toFixed(2)}%)
+                          </span>
+                        </div>
+                      ))}
+                    </div>
+                  </div>
+                )}
               </div>
             )}
             